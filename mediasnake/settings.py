@@ -189,3 +189,70 @@ MEDIASNAKEFILES_ACCEPTED_FILE_TYPES = (
 )
 MEDIASNAKEFILES_TICKET_LIFETIME_HOURS = 5
 MEDIASNAKEFILES_FFMPEGTHUMBNAILER = "ffmpegthumbnailer"
+
+# Number of thumbnails created in parallel, and the time limit in
+# seconds for creating one
+MEDIASNAKEFILES_THUMBNAIL_WORKERS = 2
+MEDIASNAKEFILES_THUMBNAIL_TIMEOUT = 120
+
+# Program for reading the technical metadata of videos, and the number
+# of videos probed in parallel and the time limit in seconds for one
+MEDIASNAKEFILES_FFPROBE = "ffprobe"
+MEDIASNAKEFILES_PROBE_WORKERS = 2
+MEDIASNAKEFILES_PROBE_TIMEOUT = 30
+
+# Storyboards for seek previews: number of frames, frames per row in
+# the sprite sheet and frame width in pixels (FRAMES = 0: no
+# storyboards), and the number created in parallel and the time limit
+# in seconds for one. Creating one reads through the whole video, so
+# they are off by default.
+MEDIASNAKEFILES_FFMPEG = "ffmpeg"
+MEDIASNAKEFILES_STORYBOARD_FRAMES = 0
+MEDIASNAKEFILES_STORYBOARD_COLUMNS = 10
+MEDIASNAKEFILES_STORYBOARD_WIDTH = 160
+MEDIASNAKEFILES_STORYBOARD_WORKERS = 1
+MEDIASNAKEFILES_STORYBOARD_TIMEOUT = 600
+
+# Thumbnails of a folder are combined into atlas images of COLUMNS x
+# ROWS thumbnails, so that the index loads one image per page of them
+MEDIASNAKEFILES_ATLAS_COLUMNS = 10
+MEDIASNAKEFILES_ATLAS_ROWS = 10
+
+# Resource policy of scans: CPU niceness (0-19) and I/O scheduling
+# class ('idle', 'best-effort' or None) of the scanning process and
+# the thumbnailers, and limits in bytes per second on reading file
+# contents (None: unlimited). While videos are streamed, and for
+# STREAM_IDLE seconds after the last video request, the STREAMING
+# limit applies instead (0: pause the scan).
+MEDIASNAKEFILES_SCAN_NICE = 10
+MEDIASNAKEFILES_SCAN_IO_CLASS = 'best-effort'
+MEDIASNAKEFILES_SCAN_READ_RATE = None
+MEDIASNAKEFILES_SCAN_STREAMING_READ_RATE = 2 * 1024 * 1024
+MEDIASNAKEFILES_SCAN_STREAM_IDLE_SECONDS = 300
+
+# Number of threads listing directories in parallel, per video
+# directory. Can also be a dict mapping video directories to the
+# number of threads. More threads help on network mounts.
+MEDIASNAKEFILES_SCAN_THREADS = 4
+
+# Number of database rows the scanner adds or removes per transaction
+MEDIASNAKEFILES_SCAN_BATCH_SIZE = 500
+
+# Minimum interval in seconds between scan progress updates
+MEDIASNAKEFILES_SCAN_STATUS_INTERVAL = 1.0
+
+# Number of slowest items to record per scan phase in scan profiles
+MEDIASNAKEFILES_SCAN_PROFILE_SLOWEST = 10
+
+# manage.py scanworker: interval in seconds for checking for queued
+# scans. A worker started on demand by the web interface exits after
+# EXIT_IDLE seconds without scans (None: never).
+MEDIASNAKEFILES_SCAN_WORKER_POLL_SECONDS = 1.0
+MEDIASNAKEFILES_SCAN_WORKER_EXIT_IDLE = 3600
+
+# manage.py watch: rescan once changes have been quiet for SETTLE
+# seconds, but at latest MAX_DELAY seconds after the first change.
+# Without inotify, poll every POLL seconds.
+MEDIASNAKEFILES_WATCH_SETTLE_SECONDS = 2.0
+MEDIASNAKEFILES_WATCH_MAX_DELAY_SECONDS = 30.0
+MEDIASNAKEFILES_WATCH_POLL_SECONDS = 300.0
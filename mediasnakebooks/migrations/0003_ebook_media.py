@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import hashlib
+
+from django.db import models, migrations
+
+
+# Frozen copy of the code creating catalog entries for existing
+# objects, as of this migration
+
+def _path_hash(filename):
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    return hashlib.sha1(filename).hexdigest()
+
+
+def add_to_catalog(apps, schema_editor):
+    MediaFile = apps.get_model('mediasnakefiles', 'MediaFile')
+    model = apps.get_model('mediasnakebooks', 'Ebook')
+
+    last = 0
+    while True:
+        chunk = list(model.objects.filter(media=None, pk__gt=last).order_by('pk')[:500])
+        if not chunk:
+            break
+        last = chunk[-1].pk
+
+        hashes = dict((_path_hash(x.filename), x.filename) for x in chunk)
+        known = dict(MediaFile.objects.filter(path_hash__in=list(hashes))
+                                      .values_list('path_hash', 'pk'))
+
+        entries = []
+        for h, filename in hashes.items():
+            if h in known:
+                continue
+            try:
+                st = os.stat(filename)
+                size, mtime, inode = st.st_size, st.st_mtime, st.st_ino
+            except OSError:
+                size, mtime, inode = -1, 0, 0
+            entries.append(MediaFile(path_hash=h, dir_hash=_path_hash(os.path.dirname(filename)),
+                                     filename=filename, size=size, mtime=mtime,
+                                     inode=inode, kind='ebook', scan=0))
+        MediaFile.objects.bulk_create(entries)
+
+        known = dict(MediaFile.objects.filter(path_hash__in=list(hashes))
+                                      .values_list('path_hash', 'pk'))
+        for obj in chunk:
+            model.objects.filter(pk=obj.pk).update(media=known[_path_hash(obj.filename)])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0006_mediafile'),
+        ('mediasnakebooks', '0002_filename_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ebook',
+            name='media',
+            field=models.ForeignKey(to='mediasnakefiles.MediaFile', null=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(add_to_catalog, lambda apps, schema_editor: None),
+    ]
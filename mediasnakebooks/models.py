@@ -2,11 +2,15 @@ import os
 import random
 
 import django.utils.timezone
+from django.conf import settings
 from django.db import models
 from django.utils.encoding import smart_text
 from django.db import connection
 
-from mediasnakefiles.scanner import register_scanner, scan_message, asfsunicode
+from mediasnakefiles.scanner import (register_scanner, scan_message, scan_phase,
+                                     scan_item, iter_batches, get_media_ids, BulkWriter)
+from mediasnakefiles.models import MediaFile
+from mediasnakefiles.governor import throttle_read, PROBE_READ_BYTES
 from mediasnakebooks.epubtools import open_epub
 
 UNKNOWN = 5
@@ -132,6 +136,7 @@ class WordContext(models.Model):
 
 class Ebook(models.Model):
     filename = models.TextField(null=False)
+    media = models.ForeignKey(MediaFile, null=True)
     title = models.CharField(max_length=128)
     author = models.CharField(max_length=128)
 
@@ -151,40 +156,37 @@ class Bookmark(models.Model):
         ordering = ['-timestamp']
 
 
-@register_scanner
-def _book_scan(existing_files, mime_cache):
-    files_in_db = set(asfsunicode(x) for x in Ebook.objects.values_list('filename', flat=True))
-    to_add = existing_files.difference(files_in_db)
-    to_remove = files_in_db.difference(existing_files)
+@register_scanner(patterns=('*.epub', '*.txt', '*.txt.gz', '*.txt.bz2'), model=Ebook)
+def _book_scan(changes, mime_cache):
+    writer = BulkWriter(Ebook)
 
-    # Add files not yet in DB
-    scan_message("Adding books...")
-    for filename in to_add:
-        ok = (filename.endswith('.epub')
-              or filename.endswith('.txt')
-              or filename.endswith('.txt.gz')
-              or filename.endswith('.txt.bz2'))
-        if not ok:
-            continue
+    # Add new files
+    scan_phase("Adding books", total=len(changes.added))
+    for batch in iter_batches(changes.added, settings.MEDIASNAKEFILES_SCAN_BATCH_SIZE):
+        media_ids = get_media_ids(batch)
 
-        title = os.path.splitext(os.path.basename(filename))[0]
-        author = None
+        for filename in batch:
+            if filename not in media_ids:
+                continue
 
-        try:
-            pub = open_epub(filename)
-            title = pub.title[:128]
-            author = pub.author[:128]
-        except:
-            # Failed to parse
-            scan_message("Failed to open Epub file %r" % (filename,))
-            continue
-
-        scan_message("Adding book: %r" % (filename,))
-
-        ebook = Ebook(filename=filename, title=title, author=author)
-        ebook.save()
-
-    # Remove non-existent entries
-    scan_message("Cleaning up non-existing books...")
-    for filename in to_remove:
-        Ebook.objects.filter(filename=filename).delete()
+            title = os.path.splitext(os.path.basename(filename))[0]
+            author = None
+
+            try:
+                throttle_read(PROBE_READ_BYTES)
+                with scan_item(filename):
+                    pub = open_epub(filename)
+                title = pub.title[:128]
+                author = pub.author[:128]
+            except:
+                # Failed to parse
+                scan_message("Failed to open Epub file %r" % (filename,))
+                continue
+
+            scan_message("Adding book: %r" % (filename,))
+
+            ebook = Ebook(filename=filename, title=title, author=author,
+                          media_id=media_ids[filename])
+            writer.add(ebook)
+
+    writer.flush()
@@ -19,6 +19,7 @@ from mediasnakebooks.models import Ebook, Word, Language, Bookmark, WordContext
 from mediasnakebooks.epubtools import open_epub
 from mediasnakebooks.tokenize import tokenize, tokenize_context
 from mediasnakebooks._stardict import Stardict
+from mediasnakefiles.generation import cache_page_versioned, media_version
 
 
 @login_required
@@ -108,8 +109,12 @@ def _get_epub(id, chapter):
     return ebook, epub, chapters, paragraphs, chapter
 
 
+def _ebook_version(id, *args, **kwargs):
+    return media_version(Ebook, id)
+
+
 @login_required
-@cache_page(30*24*60*60)
+@cache_page_versioned(30*24*60*60, _ebook_version)
 def ebook(request, id, chapter):
     ebook, epub, chapters, paragraphs, chapter = _get_epub(id, chapter)
 
@@ -186,7 +191,7 @@ def bookmark(request, id, chapter):
 
 
 @login_required
-@cache_page(30*24*60*60)
+@cache_page_versioned(30*24*60*60, _ebook_version)
 def tokens(request, id, chapter, language):
     try:
         lang = Language.objects.get(code=language)
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# The scanner reads file names in sorted order only on SQLite, where
+# the order matches Python's. (Other backends sort by locale, and
+# MySQL cannot index TEXT columns without a prefix length.)
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        table = apps.get_model('mediasnakecomics', 'Comic')._meta.db_table
+        schema_editor.execute('CREATE INDEX "%s_filename" ON "%s" ("filename")'
+                              % (table, table))
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        table = apps.get_model('mediasnakecomics', 'Comic')._meta.db_table
+        schema_editor.execute('DROP INDEX "%s_filename"' % (table,))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakecomics', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# The SQLite index on file names added in 0002_filename_index is no
+# longer used: full scans merge-join the files on disk with the media
+# catalog instead, which has its own index on file names (see
+# mediasnakefiles 0022_mediafile_filename_index). Tables remade by
+# later migrations have lost it already.
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        table = apps.get_model('mediasnakecomics', 'Comic')._meta.db_table
+        schema_editor.execute('DROP INDEX IF EXISTS "%s_filename"' % (table,))
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        table = apps.get_model('mediasnakecomics', 'Comic')._meta.db_table
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS "%s_filename" ON "%s" ("filename")'
+                              % (table, table))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakecomics', '0003_comic_media'),
+    ]
+
+    operations = [
+        migrations.RunPython(drop_index, create_index),
+    ]
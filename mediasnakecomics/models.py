@@ -2,22 +2,36 @@ import os
 import random
 
 import django.utils.timezone
+from django.conf import settings
 from django.db import models
 from django.utils.encoding import smart_text
 from django.db import connection
 
-from mediasnakefiles.scanner import register_scanner, scan_message, asfsunicode
+from mediasnakefiles.scanner import (register_scanner, scan_message, scan_phase,
+                                     scan_item, iter_batches, get_media_ids, BulkWriter)
+from mediasnakefiles.models import MediaFile
+from mediasnakefiles.governor import throttle_read, PROBE_READ_BYTES
 from mediasnakecomics.ziptools import ImagePack
 
 
 class Comic(models.Model):
     filename = models.TextField(null=False)
+    media = models.ForeignKey(MediaFile, null=True)
     title = models.CharField(max_length=128)
     path = models.CharField(max_length=128)
 
     class Meta:
         index_together = (('path', 'title'),)
 
+    @staticmethod
+    def fields_for_filename(filename):
+        """
+        Return the values of the fields derived from a file name.
+        """
+        return dict(filename=filename,
+                    title=os.path.splitext(os.path.basename(filename))[0],
+                    path=os.path.basename(os.path.dirname(filename)))
+
 
 class Bookmark(models.Model):
     comic = models.ForeignKey(Comic, unique=True)
@@ -28,39 +42,34 @@ class Bookmark(models.Model):
         ordering = ['-timestamp']
 
 
-@register_scanner
-def _comic_scan(existing_files, mime_cache):
-    files_in_db = set(asfsunicode(x) for x in Comic.objects.values_list('filename', flat=True))
-    to_add = existing_files.difference(files_in_db)
-    to_remove = files_in_db.difference(existing_files)
+@register_scanner(patterns=('*.cbz', '*.zip', '*.rar'), model=Comic)
+def _comic_scan(changes, mime_cache):
+    writer = BulkWriter(Comic)
 
-    # Add files not yet in DB
-    scan_message("Adding comics...")
-    for filename in to_add:
-        ok = (filename.endswith('.cbz')
-              or filename.endswith('.zip')
-              or filename.endswith('.rar'))
-        if not ok:
-            continue
+    # Add new files
+    scan_phase("Adding comics", total=len(changes.added))
+    for batch in iter_batches(changes.added, settings.MEDIASNAKEFILES_SCAN_BATCH_SIZE):
+        media_ids = get_media_ids(batch)
 
-        try:
-            pages = ImagePack(filename)
-        except (IOError, ValueError):
-            continue
+        for filename in batch:
+            if filename not in media_ids:
+                continue
 
-        if len(pages) == 0:
-            # Doesn't contain any images
-            continue
+            try:
+                throttle_read(PROBE_READ_BYTES)
+                with scan_item(filename):
+                    pages = ImagePack(filename)
+            except (IOError, ValueError):
+                continue
 
-        title = os.path.splitext(os.path.basename(filename))[0]
-        path = os.path.basename(os.path.dirname(filename))
+            if len(pages) == 0:
+                # Doesn't contain any images
+                continue
 
-        scan_message("Adding comic: %r" % (filename,))
+            scan_message("Adding comic: %r" % (filename,))
 
-        comic = Comic(filename=filename, title=title, path=path)
-        comic.save()
+            comic = Comic(media_id=media_ids[filename],
+                          **Comic.fields_for_filename(filename))
+            writer.add(comic)
 
-    # Remove non-existent entries
-    scan_message("Cleaning up non-existing comics...")
-    for filename in to_remove:
-        Comic.objects.filter(filename=filename).delete()
+    writer.flush()
@@ -20,6 +20,7 @@ from django.core.urlresolvers import reverse
 from mediasnakecomics.models import Comic, Bookmark
 
 from mediasnakecomics.ziptools import ImagePack
+from mediasnakefiles.generation import cache_page_versioned, media_version
 
 
 @login_required
@@ -128,8 +129,12 @@ def comic(request, id):
     return render(request, "mediasnakecomics/comic.html", context)
 
 
+def _comic_version(id, *args, **kwargs):
+    return media_version(Comic, id)
+
+
 @login_required
-@cache_page(30*24*60*60)
+@cache_page_versioned(30*24*60*60, _comic_version)
 def image(request, id, page):
     page = int(page)
     comic, pages = _get_comic(id)
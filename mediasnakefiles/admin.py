@@ -0,0 +1,17 @@
+from django.contrib import admin
+from django.utils.html import format_html
+from mediasnakefiles.models import ScanRun
+
+class ScanRunAdmin(admin.ModelAdmin):
+    list_display = ('started', 'duration', 'full', 'success', 'phase_summary')
+    list_filter = ('full', 'success')
+    fields = ('started', 'duration', 'full', 'success', 'paths', 'report')
+    readonly_fields = fields
+
+    def report(self, obj):
+        return format_html(u"<pre>{0}</pre>", obj.format_report())
+
+    def has_add_permission(self, request):
+        return False
+
+admin.site.register(ScanRun, ScanRunAdmin)
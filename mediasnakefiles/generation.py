@@ -0,0 +1,101 @@
+"""
+Library generations, for versioning cached pages.
+
+Scans that change the library publish a new generation when they
+finish. Cached pages are keyed by versions of what they show, so that
+scans do not need to clear the cache: folder listings of the video
+index by the versions of the folders, and pages showing a single file
+by the catalog entry and the modification time and size of the file.
+"""
+
+import os
+import errno
+import threading
+
+from functools import wraps
+
+from django.conf import settings
+from django.middleware.cache import CacheMiddleware
+
+LIBRARY_GENERATION = os.path.join(settings.DATA_DIR, 'generation.txt')
+
+_generation_lock = threading.Lock()
+
+
+def get_generation():
+    try:
+        with open(LIBRARY_GENERATION, 'rb') as f:
+            return int(f.read().strip() or 0)
+    except IOError as err:
+        if err.errno == errno.ENOENT:
+            return 0
+        raise
+    except ValueError:
+        return 0
+
+
+def publish_generation():
+    """
+    Start a new library generation. Returns its number.
+    """
+    # Replace atomically, so that readers never see partial contents
+    with _generation_lock:
+        generation = get_generation() + 1
+        tmpfn = LIBRARY_GENERATION + '.new'
+        with open(tmpfn, 'wb') as f:
+            f.write(str(generation))
+        os.rename(tmpfn, LIBRARY_GENERATION)
+    return generation
+
+
+def library_version(*args, **kwargs):
+    """
+    Cache version of pages depending on the whole library.
+    """
+    return "library-%d" % (get_generation(),)
+
+
+def media_version(model, pk):
+    """
+    Cache version of pages showing the object of `model` with primary
+    key `pk`. It changes if the object is replaced by another one with
+    the same key, or if its file is modified in place. Returns None if
+    there is no such object or file.
+    """
+    rows = list(model.objects.filter(pk=pk).values_list('filename', 'media',
+                                                         'media__scan')[:1])
+    if not rows:
+        return None
+    filename, media_id, scan = rows[0]
+    try:
+        st = os.stat(filename)
+    except OSError:
+        return None
+    if media_id is None:
+        media_id, scan = 'none', library_version()
+    return "%s-%s-%s-%s-%s-%s" % (model._meta.model_name, pk, media_id, scan,
+                                  st.st_mtime, st.st_size)
+
+
+def cache_page_versioned(timeout, version):
+    """
+    Like `cache_page`, but with the cache keys prefixed by
+    ``version(*args, **kwargs)`` called with the view arguments. Pages
+    are not cached if the version is None.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            key_prefix = version(*args, **kwargs)
+            if key_prefix is None:
+                return view(request, *args, **kwargs)
+
+            middleware = CacheMiddleware(cache_timeout=timeout, key_prefix=key_prefix)
+            response = middleware.process_request(request)
+            if response is not None:
+                return response
+
+            response = view(request, *args, **kwargs)
+            return middleware.process_response(request, response)
+        return wrapper
+    return decorator
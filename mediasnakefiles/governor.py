@@ -0,0 +1,180 @@
+"""
+Resource policy for background scans.
+
+Scans lower the CPU and I/O priority of their process, which the
+thumbnailer and other subprocesses inherit, and limit the rate at
+which file contents are read. While videos are being streamed, the
+read rate is limited further, so that scans do not starve playback.
+"""
+
+import os
+import time
+import errno
+import logging
+import threading
+import subprocess
+
+from django.conf import settings
+
+logger = logging.getLogger('mediasnake')
+
+STREAM_ACTIVITY = os.path.join(settings.DATA_DIR, 'streaming.active')
+
+# Rough amounts of data read when detecting the type of a file or
+# parsing its metadata, and when creating a video thumbnail
+PROBE_READ_BYTES = 256 * 1024
+THUMBNAIL_READ_BYTES = 4 * 1024 * 1024
+
+IO_CLASSES = {
+    'idle': ['-c', '3'],
+    'best-effort': ['-c', '2', '-n', '7'],
+}
+
+_governor = None
+_governor_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    Limit the rate of some quantity to `rate` units per second, with
+    bursts of up to `burst` units.
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.burst
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def consume(self, amount, rate=None):
+        """
+        Wait until `amount` units can be used, at `rate` units per
+        second if given instead of the default rate.
+        """
+        if rate is None:
+            rate = self.rate
+
+        # Bursts are limited also by the current rate
+        burst = min(self.burst, rate)
+
+        with self._lock:
+            now = self.clock()
+            self._tokens = min(burst, self._tokens + (now - self._last) * rate)
+            self._last = now
+            self._tokens -= amount
+            wait = -self._tokens / rate if self._tokens < 0 else 0
+
+        # Waiting outside the lock: later callers queue up behind the
+        # debt this one left
+        if wait > 0:
+            self.sleep(wait)
+
+
+class ResourceGovernor(object):
+    """
+    Resource policy of scans, see the MEDIASNAKEFILES_SCAN_NICE etc.
+    settings.
+    """
+
+    def __init__(self, nice=None, io_class=None, read_rate=None, streaming_read_rate=None,
+                 stream_idle=300):
+        self.nice = nice
+        self.io_class = io_class
+        self.read_rate = read_rate
+        self.streaming_read_rate = streaming_read_rate
+        self.stream_idle = stream_idle
+
+        rates = [x for x in (read_rate, streaming_read_rate) if x]
+        self._bucket = TokenBucket(max(rates)) if rates else None
+        self._applied = False
+        self._streaming = (0, False)
+
+    def apply_priorities(self):
+        """
+        Lower the CPU and I/O priority of this process. Threads and
+        subprocesses started afterwards inherit them.
+        """
+        if self._applied:
+            return
+        self._applied = True
+
+        if self.nice is not None:
+            # os.nice is relative, and can only be lowered
+            current = os.nice(0)
+            if self.nice > current:
+                os.nice(self.nice - current)
+
+        if self.io_class is not None:
+            try:
+                subprocess.call(['ionice'] + IO_CLASSES[self.io_class]
+                                + ['-p', str(os.getpid())])
+            except OSError:
+                logger.warning("Could not run ionice to set the I/O priority of scans")
+
+    def streaming(self):
+        """
+        Return True if videos have been streamed recently.
+        """
+        now = time.time()
+        checked, active = self._streaming
+        if now - checked < 1.0:
+            return active
+
+        try:
+            active = now - os.stat(STREAM_ACTIVITY).st_mtime < self.stream_idle
+        except OSError:
+            active = False
+        self._streaming = (now, active)
+        return active
+
+    def read(self, nbytes):
+        """
+        Wait until `nbytes` of file contents can be read.
+        """
+        rate = self.read_rate
+        if self.streaming_read_rate is not None and self.streaming():
+            if self.streaming_read_rate == 0:
+                # Pause until streaming stops
+                while self.streaming():
+                    time.sleep(5)
+            else:
+                rate = self.streaming_read_rate
+
+        if rate and self._bucket is not None:
+            self._bucket.consume(nbytes, rate)
+
+
+def get_governor():
+    global _governor
+    with _governor_lock:
+        if _governor is None:
+            _governor = ResourceGovernor(
+                nice=settings.MEDIASNAKEFILES_SCAN_NICE,
+                io_class=settings.MEDIASNAKEFILES_SCAN_IO_CLASS,
+                read_rate=settings.MEDIASNAKEFILES_SCAN_READ_RATE,
+                streaming_read_rate=settings.MEDIASNAKEFILES_SCAN_STREAMING_READ_RATE,
+                stream_idle=settings.MEDIASNAKEFILES_SCAN_STREAM_IDLE_SECONDS)
+        return _governor
+
+
+def throttle_read(nbytes):
+    """
+    Wait until the scan may read `nbytes` of file contents.
+    """
+    get_governor().read(nbytes)
+
+
+def note_streaming():
+    """
+    Record that a video is being streamed.
+    """
+    try:
+        os.utime(STREAM_ACTIVITY, None)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        with open(STREAM_ACTIVITY, 'wb'):
+            pass
@@ -1,16 +1,37 @@
+from optparse import make_option
+
 from django.core.management.base import BaseCommand, CommandError
-from django.core.cache import cache
 
-from mediasnakefiles.scanner import scan, SCAN_LOCKFILE
+from mediasnakefiles.scanner import scan, check_scan_paths, SCAN_LOCKFILE
+from mediasnakefiles.models import ScanRun
 
 class Command(BaseCommand):
-    args = ''
-    help = 'Rescans the video_dirs for videos'
+    args = '[PATH...]'
+    help = ('Rescans the video_dirs for videos, or only the directory trees '
+            'under the given paths')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--full', action='store_true', dest='full', default=False,
+                    help=('List all directories (under the given paths), '
+                          'also those unchanged since the last scan')),
+        make_option('--profile', action='store_true', dest='profile', default=False,
+                    help='Print a timing report of the scan'),
+    )
 
     def handle(self, *args, **options):
-        ok = scan()
+        paths = None
+        if args:
+            try:
+                paths = check_scan_paths(args)
+            except ValueError as exc:
+                raise CommandError(str(exc))
+
+        ok = scan(full=options['full'], paths=paths)
         if not ok:
             raise CommandError(("Lock file %r exists -- another rescan is "
                                 "already running") % SCAN_LOCKFILE)
 
-        cache.clear()
+        if options['profile']:
+            run = ScanRun.objects.order_by('-started')[:1]
+            if run:
+                self.stdout.write(run[0].format_report())
@@ -0,0 +1,22 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from mediasnakefiles.scanqueue import run_worker, SCAN_WORKER_LOCKFILE
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Runs scans queued by the web interface, without starting a new process for each'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--exit-idle', action='store', type='float', dest='exit_idle', default=None,
+                    help='Exit after this many seconds without queued scans'),
+    )
+
+    def handle(self, *args, **options):
+        ok = run_worker(settings.MEDIASNAKEFILES_SCAN_WORKER_POLL_SECONDS,
+                        exit_idle=options['exit_idle'])
+        if not ok:
+            raise CommandError(("Lock file %r exists -- another scan worker is "
+                                "already running") % SCAN_WORKER_LOCKFILE)
@@ -0,0 +1,95 @@
+import time
+import logging
+
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from mediasnakefiles.scanner import scan
+from mediasnakefiles.watcher import get_watcher, PollingWatcher, WatcherError
+
+logger = logging.getLogger('mediasnake')
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Watches the video_dirs for changes, and updates the library as they occur'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--poll', action='store_true', dest='poll', default=False,
+                    help='Poll for changes instead of using change notifications'),
+    )
+
+    def handle(self, *args, **options):
+        roots = settings.MEDIASNAKEFILES_DIRS
+        settle = settings.MEDIASNAKEFILES_WATCH_SETTLE_SECONDS
+        max_delay = settings.MEDIASNAKEFILES_WATCH_MAX_DELAY_SECONDS
+        poll_interval = settings.MEDIASNAKEFILES_WATCH_POLL_SECONDS
+
+        if options['poll']:
+            watcher = PollingWatcher(roots, poll_interval)
+        else:
+            watcher = get_watcher(roots, poll_interval)
+
+        # Changed directories, or None for all of them
+        pending = set()
+        first_change = None
+        last_change = None
+        retry_after = 0
+
+        try:
+            while True:
+                try:
+                    changed = watcher.wait(settle)
+                except WatcherError as err:
+                    # Typically out of inotify watches for new directories;
+                    # changes in them would go unnoticed
+                    logger.warning("Watcher: falling back to polling: %s" % (err,))
+                    watcher.close()
+                    watcher = PollingWatcher(roots, poll_interval)
+                    changed = None
+                now = time.time()
+
+                if changed is None or changed:
+                    if changed is None or pending is None:
+                        pending = None
+                    else:
+                        pending.update(changed)
+                    if first_change is None:
+                        first_change = now
+                    last_change = now
+
+                if first_change is None:
+                    continue
+
+                # Coalesce bursts of changes
+                if now - last_change < settle and now - first_change < max_delay:
+                    continue
+                if now < retry_after:
+                    continue
+
+                try:
+                    if pending is None:
+                        logger.info("Watcher: rescanning all directories")
+                        ok = scan()
+                    else:
+                        logger.info("Watcher: rescanning %d directories" % (len(pending),))
+                        ok = scan(paths=sorted(pending))
+                except Exception:
+                    # Logged by the scanner. Try again later, scanning
+                    # all directories in case the paths were the problem
+                    logger.warning("Watcher: scan failed, retrying in %d s" % (max_delay,))
+                    pending = None
+                    retry_after = time.time() + max_delay
+                    continue
+
+                if ok:
+                    pending = set()
+                    first_change = None
+                    last_change = None
+                else:
+                    # Another scan is running; try again later
+                    last_change = now
+        finally:
+            watcher.close()
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScannedDirectory',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('path', models.TextField()),
+                ('mtime', models.FloatField()),
+                ('inode', models.BigIntegerField()),
+                ('entry_count', models.IntegerField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0002_scanneddirectory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FileMimeType',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('path_hash', models.CharField(max_length=40, db_index=True)),
+                ('filename', models.TextField()),
+                ('size', models.BigIntegerField()),
+                ('mtime', models.FloatField()),
+                ('mimetype', models.CharField(max_length=256)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0003_filemimetype'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanRun',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('started', models.DateTimeField()),
+                ('duration', models.FloatField()),
+                ('full', models.BooleanField(default=False)),
+                ('paths', models.TextField(blank=True)),
+                ('success', models.BooleanField(default=False)),
+                ('profile', models.TextField()),
+            ],
+            options={
+                'ordering': ['-started'],
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def copy_thumbnail_hashes(apps, schema_editor):
+    # Thumbnail ids are the content hashes of the videos
+    VideoFile = apps.get_model('mediasnakefiles', 'VideoFile')
+    MediaFile = apps.get_model('mediasnakefiles', 'MediaFile')
+    for media_id, thumbnail in VideoFile.objects.exclude(thumbnail='') \
+                                                .exclude(media=None) \
+                                                .values_list('media', 'thumbnail'):
+        MediaFile.objects.filter(pk=media_id).update(content_hash=thumbnail)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0006_mediafile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediafile',
+            name='content_hash',
+            field=models.CharField(max_length=40, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(copy_thumbnail_hashes, lambda apps, schema_editor: None),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0007_mediafile_content_hash'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ScanRequest',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('created', models.DateTimeField()),
+                ('full', models.BooleanField(default=False)),
+                ('paths', models.TextField(blank=True)),
+                ('started', models.DateTimeField(null=True)),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# The fields are filled in by 0011_videofolder
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0008_scanrequest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videofile',
+            name='group_base',
+            field=models.TextField(default=b''),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='relative_dirname',
+            field=models.TextField(default=b'.'),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='root',
+            field=models.IntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='sort_key',
+            field=models.CharField(default=b'', max_length=255, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='title',
+            field=models.TextField(default=b''),
+            preserve_default=True,
+        ),
+    ]
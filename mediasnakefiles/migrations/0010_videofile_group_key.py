@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# The field is filled in by 0011_videofolder
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0009_videofile_fields'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videofile',
+            name='group_key',
+            field=models.CharField(default=b'', max_length=40, db_index=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import re
+import hashlib
+
+from django.conf import settings
+from django.db import models, migrations, transaction
+
+
+# Frozen copies of the code deriving the video fields added in 0009 to
+# 0011 from the file names, and of the folder update, as of this
+# migration. The fields are filled in in a single pass.
+
+def _path_hash(filename):
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    return hashlib.sha1(filename).hexdigest()
+
+
+def _video_title(basename):
+    title = os.path.splitext(basename)[0]
+    title = re.sub(r'\[.*?\]', '', title)
+    title = re.sub(r'\(.*?\)', '', title)
+    title = re.sub(r'{.*?}', '', title)
+    title = re.sub(r'[_-]', ' ', title)
+    title = re.sub(r'\s+', ' ', title)
+    title = title.strip()
+
+    if title:
+        return title[0].upper() + title[1:]
+    else:
+        return basename
+
+
+def _video_sort_key(relative_dirname, title, basename):
+    dirname = u"\x02".join(relative_dirname.split(os.path.sep))
+    numbers = re.sub(r'[^0-9 \t]', '', title).split()
+    numbers = u"\x02".join(u"%02d%s" % (len(x), x) for x in (y.lstrip('0') for y in numbers))
+    key = u"\x01".join([dirname, numbers, title, basename])
+    return key[:255]
+
+
+def _fields_for_filename(filename):
+    for j, dn in enumerate(settings.MEDIASNAKEFILES_DIRS):
+        dn = os.path.normpath(dn)
+        if filename.startswith(dn + os.path.sep):
+            root = dn
+            break
+    else:
+        j = 0
+        root = os.path.normpath(settings.MEDIASNAKEFILES_DIRS[0])
+
+    relative_dirname = os.path.relpath(os.path.dirname(filename), root)
+    basename = os.path.basename(filename)
+    title = _video_title(basename)
+    group_base = os.path.normpath(os.path.join(relative_dirname,
+                                               os.path.splitext(basename)[0]))
+
+    return dict(root=j,
+                relative_dirname=relative_dirname,
+                folder_key=_path_hash(relative_dirname),
+                title=title,
+                group_base=group_base,
+                group_key=_path_hash(group_base),
+                sort_key=_video_sort_key(relative_dirname, title, basename))
+
+
+def fill_folders(apps, schema_editor):
+    VideoFile = apps.get_model('mediasnakefiles', 'VideoFile')
+    VideoFolder = apps.get_model('mediasnakefiles', 'VideoFolder')
+
+    counts = {}
+    last = 0
+    while True:
+        chunk = list(VideoFile.objects.filter(pk__gt=last).order_by('pk')
+                                      .only('filename')[:500])
+        if not chunk:
+            break
+        last = chunk[-1].pk
+
+        with transaction.atomic():
+            for video_file in chunk:
+                fields = _fields_for_filename(video_file.filename)
+                VideoFile.objects.filter(pk=video_file.pk).update(**fields)
+
+                path = fields['relative_dirname']
+                while True:
+                    counts[path] = counts.get(path, 0) + 1
+                    if path == u'.':
+                        break
+                    path = os.path.dirname(path) or u'.'
+
+    VideoFolder.objects.bulk_create(
+        [VideoFolder(path=path, path_key=_path_hash(path),
+                     parent_key=_path_hash(os.path.dirname(path) or u'.') if path != u'.' else '',
+                     name=os.path.basename(path) or path, video_count=count)
+         for path, count in counts.items()],
+        batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0010_videofile_group_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VideoFolder',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('path', models.TextField()),
+                ('path_key', models.CharField(max_length=40, db_index=True)),
+                ('parent_key', models.CharField(max_length=40, db_index=True)),
+                ('name', models.TextField()),
+                ('video_count', models.IntegerField()),
+            ],
+            options={
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='folder_key',
+            field=models.CharField(default=b'', max_length=40, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_folders, lambda apps, schema_editor: None),
+    ]
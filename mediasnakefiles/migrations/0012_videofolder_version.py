@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0011_videofolder'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videofolder',
+            name='version',
+            field=models.CharField(default=b'', max_length=32),
+            preserve_default=True,
+        ),
+    ]
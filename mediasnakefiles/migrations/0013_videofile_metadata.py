@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0012_videofolder_version'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videofile',
+            name='audio_codecs',
+            field=models.CharField(max_length=255, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='audio_languages',
+            field=models.CharField(max_length=255, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='bitrate',
+            field=models.IntegerField(null=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='duration',
+            field=models.FloatField(null=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='height',
+            field=models.IntegerField(null=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='probed',
+            field=models.BooleanField(default=False, db_index=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='subtitle_languages',
+            field=models.CharField(max_length=255, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='video_codec',
+            field=models.CharField(max_length=64, blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='width',
+            field=models.IntegerField(null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0013_videofile_metadata'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videofile',
+            name='storyboard',
+            field=models.CharField(max_length=256, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import random
+
+from django.db import models, migrations
+
+
+def new_versions(apps, schema_editor):
+    # Folders had an empty version, which would count as having an atlas
+    VideoFolder = apps.get_model('mediasnakefiles', 'VideoFolder')
+    VideoFolder.objects.update(version="%016x" % (random.getrandbits(64),))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0014_videofile_storyboard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videofolder',
+            name='atlas',
+            field=models.TextField(blank=True),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofolder',
+            name='atlas_version',
+            field=models.CharField(max_length=32, blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(new_versions, lambda apps, schema_editor: None),
+    ]
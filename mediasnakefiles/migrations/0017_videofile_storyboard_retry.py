@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0016_videofile_probe_retry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='videofile',
+            name='storyboard_failures',
+            field=models.IntegerField(default=0),
+            preserve_default=True,
+        ),
+        migrations.AddField(
+            model_name='videofile',
+            name='storyboard_retry',
+            field=models.DateTimeField(null=True),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,18 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0017_videofile_storyboard_retry'),
+    ]
+
+    operations = [
+        migrations.RemoveField(
+            model_name='scanneddirectory',
+            name='entry_count',
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0018_remove_scanneddirectory_entry_count'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='videofile',
+            name='sort_key',
+            field=models.CharField(default=b'', max_length=255),
+            preserve_default=True,
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0019_videofile_sort_key_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='scanrequest',
+            name='error',
+            field=models.TextField(blank=True),
+            preserve_default=True,
+        ),
+    ]
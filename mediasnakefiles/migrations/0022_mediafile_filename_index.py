@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+# Full scans read the catalog in file name order on SQLite; see
+# ScanChanges.diff. The index created in 0006_mediafile was lost when
+# 0007 remade the table, so it is created again. Migrations that remake
+# the table later must recreate it as well.
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        table = apps.get_model('mediasnakefiles', 'MediaFile')._meta.db_table
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS "%s_filename" ON "%s" ("filename")'
+                              % (table, table))
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        table = apps.get_model('mediasnakefiles', 'MediaFile')._meta.db_table
+        schema_editor.execute('DROP INDEX IF EXISTS "%s_filename"' % (table,))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0021_drop_filename_index'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import re
+
+from django.db import models, migrations
+
+
+# Frozen copy of the sort key, as of this migration, for the keys
+# that were cut to 255 characters
+
+def _video_sort_key(relative_dirname, title, basename):
+    dirname = u"\x02".join(relative_dirname.split(os.path.sep))
+    numbers = re.sub(r'[^0-9 \t]', '', title).split()
+    numbers = u"\x02".join(u"%02d%s" % (len(x), x) for x in (y.lstrip('0') for y in numbers))
+    return u"\x01".join([dirname, numbers, title, basename])
+
+
+def fill_sort_keys(apps, schema_editor):
+    VideoFile = apps.get_model('mediasnakefiles', 'VideoFile')
+    for video_file in VideoFile.objects.filter(sort_key__regex=r'^.{255}$') \
+                                       .only('filename', 'relative_dirname', 'title'):
+        sort_key = _video_sort_key(video_file.relative_dirname, video_file.title,
+                                   os.path.basename(video_file.filename))
+        VideoFile.objects.filter(pk=video_file.pk).update(sort_key=sort_key)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mediasnakefiles', '0022_mediafile_filename_index'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='videofile',
+            name='sort_key',
+            field=models.TextField(default=b''),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_sort_keys, lambda apps, schema_editor: None),
+    ]
@@ -1,6 +1,8 @@
 import os
 import sys
 import re
+import json
+import time
 import hmac
 import subprocess
 import tempfile
@@ -8,6 +10,7 @@ import hashlib
 import datetime
 import fnmatch
 import random
+import glob
 
 from django.db import models, transaction
 from django.conf import settings
@@ -19,16 +22,96 @@ import django.utils.timezone
 
 import logging
 
-from mediasnakefiles.scanner import register_scanner, scan_message, asfsunicode
+from mediasnakefiles.scanner import (register_scanner, scan_message, scan_phase, scan_step,
+                                     scan_item, iter_chunked, iter_batches, get_media_ids,
+                                     library_changed, path_hash, FileClassifier, BulkWriter)
+from mediasnakefiles.workers import WorkerPool, CommandTimeout, run_command, find_program
+from mediasnakefiles.governor import throttle_read, PROBE_READ_BYTES, THUMBNAIL_READ_BYTES
 
 logger = logging.getLogger('mediasnake')
 
+# Codecs that browsers play in the <video> element
+HTML5_VIDEO_CODECS = set(['h264', 'vp8', 'vp9', 'av1', 'theora'])
+HTML5_AUDIO_CODECS = set(['aac', 'mp3', 'opus', 'vorbis', 'flac'])
+
+# Size of the thumbnails in folder atlases, as shown on the index page
+ATLAS_CELL_SIZE = (190, 110)
+
+
+class MediaFile(models.Model):
+    """
+    Catalog entry for a file found by the scanner. The models of the
+    media apps refer to these through a `media` foreign key.
+
+    `scan` is the id of the `ScanRun` that added the entry, so that
+    ``MediaFile.objects.filter(scan__gt=n)`` are the files added since
+    scan `n`. `content_hash` is the `hash_content` of the file, if it
+    has been computed; it is used for recognizing moved files.
+
+    On SQLite, `filename` has an index made by a migration, as full
+    scans read the catalog in file name order.
+    """
+    path_hash = models.CharField(max_length=40, unique=True)
+    dir_hash = models.CharField(max_length=40, db_index=True)
+    filename = models.TextField()
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    inode = models.BigIntegerField()
+    kind = models.CharField(max_length=32, blank=True)
+    scan = models.IntegerField(db_index=True)
+    content_hash = models.CharField(max_length=40, blank=True)
+
+    def __str__(self):
+        return "MediaFile: '%s'" % (self.filename,)
+
 
 class VideoFile(models.Model):
+    """
+    Video found by the scanner.
+
+    The presentation fields `root` (index of the video directory),
+    `relative_dirname`, `folder_key` (its `path_hash`), `title`,
+    `group_base` (path without extension relative to the video
+    directory), `group_key` (its `path_hash`) and `sort_key` are
+    derived from the file name by `fields_for_filename` when the video
+    is scanned. Videos with the same `group_key` are versions of the
+    same video. Videos are ordered by `sort_video_files`.
+
+    The technical metadata `duration` (seconds), `bitrate` (kbit/s),
+    `width`, `height`, the codecs and the audio and subtitle languages
+    (comma-separated) are filled in by `probe_videos` after the video
+    is added, which sets `probed`. Videos that could not be probed are
+    tried again after `probe_retry`, later after each of the
+    `probe_failures`.
+    """
     filename = models.TextField()
+    media = models.ForeignKey(MediaFile, null=True)
 
     mimetype = models.CharField(max_length=256)
     thumbnail = models.CharField(max_length=256)
+    storyboard = models.CharField(max_length=256, blank=True)
+    storyboard_failures = models.IntegerField(default=0)
+    storyboard_retry = models.DateTimeField(null=True)
+
+    root = models.IntegerField(default=0)
+    relative_dirname = models.TextField(default='.')
+    folder_key = models.CharField(max_length=40, db_index=True, default='')
+    title = models.TextField(default='')
+    group_base = models.TextField(default='')
+    group_key = models.CharField(max_length=40, db_index=True, default='')
+    sort_key = models.TextField(default='')
+
+    probed = models.BooleanField(default=False, db_index=True)
+    probe_failures = models.IntegerField(default=0)
+    probe_retry = models.DateTimeField(null=True)
+    duration = models.FloatField(null=True)
+    bitrate = models.IntegerField(null=True)
+    width = models.IntegerField(null=True)
+    height = models.IntegerField(null=True)
+    video_codec = models.CharField(max_length=64, blank=True)
+    audio_codecs = models.CharField(max_length=255, blank=True)
+    audio_languages = models.CharField(max_length=255, blank=True)
+    subtitle_languages = models.CharField(max_length=255, blank=True)
 
     @property
     def basename(self):
@@ -39,33 +122,55 @@ class VideoFile(models.Model):
         return os.path.splitext(self.filename)[1].lstrip('.')
 
     @property
-    def relative_dirname(self):
-        for dn in settings.MEDIASNAKEFILES_DIRS:
+    def duration_text(self):
+        if self.duration is None:
+            return u""
+        minutes, seconds = divmod(int(round(self.duration)), 60)
+        hours, minutes = divmod(minutes, 60)
+        if hours:
+            return u"%d:%02d:%02d" % (hours, minutes, seconds)
+        return u"%d:%02d" % (minutes, seconds)
+
+    @property
+    def html5_playable(self):
+        """
+        Whether browsers can likely play the video without plugins.
+        Unknown if the video has not been probed.
+        """
+        if not self.video_codec:
+            return None
+        audio = [x for x in self.audio_codecs.split(u",") if x]
+        return (self.video_codec in HTML5_VIDEO_CODECS
+                and all(x in HTML5_AUDIO_CODECS for x in audio))
+
+    @staticmethod
+    def fields_for_filename(filename):
+        """
+        Return the values of the fields derived from a file name.
+        """
+        for j, dn in enumerate(settings.MEDIASNAKEFILES_DIRS):
             dn = os.path.normpath(dn)
-            if self.filename.startswith(dn + os.path.sep):
+            if filename.startswith(dn + os.path.sep):
                 root = dn
                 break
         else:
-            dn = settings.MEDIASNAKEFILES_DIRS[0]
-            root = os.path.normpath(dn)
+            j = 0
+            root = os.path.normpath(settings.MEDIASNAKEFILES_DIRS[0])
 
-        return os.path.relpath(os.path.dirname(self.filename),
-                               root)
+        relative_dirname = os.path.relpath(os.path.dirname(filename), root)
+        basename = os.path.basename(filename)
+        title = _video_title(basename)
+        group_base = os.path.normpath(os.path.join(relative_dirname,
+                                                   os.path.splitext(basename)[0]))
 
-    @property
-    def title(self):
-        title = os.path.splitext(self.basename)[0]
-        title = re.sub(r'\[.*?\]', '', title)
-        title = re.sub(r'\(.*?\)', '', title)
-        title = re.sub(r'{.*?}', '', title)
-        title = re.sub(r'[_-]', ' ', title)
-        title = re.sub(r'\s+', ' ', title)
-        title = title.strip()
-        
-        if title:
-            return title[0].upper() + title[1:]
-        else:
-            return self.basename
+        return dict(filename=filename,
+                    root=j,
+                    relative_dirname=relative_dirname,
+                    folder_key=path_hash(relative_dirname),
+                    title=title,
+                    group_base=group_base,
+                    group_key=path_hash(group_base),
+                    sort_key=_video_sort_key(relative_dirname, title, basename))
 
     @property
     def thumbnail_filename(self):
@@ -73,7 +178,13 @@ class VideoFile(models.Model):
             return None
         return get_thumbnail_filename(self.thumbnail)
 
-    def create_thumbnail(self):
+    @property
+    def storyboard_filenames(self):
+        if not self.storyboard:
+            return []
+        return [get_storyboard_filename(self.storyboard, x) for x in ('jpg', 'vtt')]
+
+    def create_thumbnail(self, timeout=None):
         thumbnail_filename = self.thumbnail_filename
         if thumbnail_filename is not None and os.path.isfile(thumbnail_filename):
             return False
@@ -81,50 +192,207 @@ class VideoFile(models.Model):
         if not os.path.isfile(self.filename):
             raise RuntimeError("Not a file")
 
-        # Create a deterministic thumbnail name
-        thumbnail = hash_content(self.filename)
-        thumbnail_filename = get_thumbnail_filename(thumbnail)
+        thumbnail, created = make_thumbnail(self.filename, timeout=timeout)
 
         if self.thumbnail != thumbnail:
             self.thumbnail = thumbnail
             self.save()
 
-        if os.path.isfile(thumbnail_filename):
-            return False
+        return created
 
-        if not os.path.isdir(settings.SENDFILE_ROOT):
-            os.makedirs(settings.SENDFILE_ROOT)
+    def get_all_versions(self):
+        return sort_video_files(VideoFile.objects.filter(group_key=self.group_key))
 
-        fd, tmpfn = tempfile.mkstemp(dir=settings.SENDFILE_ROOT, prefix='tmp-', suffix=".jpg")
-        try:
-            os.close(fd)
-            p = subprocess.Popen([settings.MEDIASNAKEFILES_FFMPEGTHUMBNAILER,
-                                  "-cjpeg", "-s320",
-                                  "-i" + self.filename,
-                                  "-o" + tmpfn],
-                                 stdin=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                 stdout=subprocess.PIPE)
-            p.communicate()
-            if p.returncode != 0:
-                return False
-
-            os.rename(tmpfn, thumbnail_filename)
-        except:
-            os.unlink(tmpfn)
+    def __str__(self):
+        return "VideoFile: '%s/%s'" % (self.relative_dirname, self.basename)
 
-        return True
+def _video_title(basename):
+    title = os.path.splitext(basename)[0]
+    title = re.sub(r'\[.*?\]', '', title)
+    title = re.sub(r'\(.*?\)', '', title)
+    title = re.sub(r'{.*?}', '', title)
+    title = re.sub(r'[_-]', ' ', title)
+    title = re.sub(r'\s+', ' ', title)
+    title = title.strip()
 
-    def get_all_versions(self):
-        base, ext = os.path.splitext(self.basename)
-        if self.relative_dirname == '.':
-            rel_base = os.path.sep + base + '.'
-        else:
-            rel_base = os.path.sep + os.path.join(self.relative_dirname, base + '.')
-        return [x for x in VideoFile.objects.filter(filename__contains=rel_base)
-                if x.relative_dirname == self.relative_dirname and x.basename.startswith(base + '.')]
+    if title:
+        return title[0].upper() + title[1:]
+    else:
+        return basename
+
+
+def sort_video_files(video_files):
+    """
+    Sort videos by `sort_key` and file name. The keys are compared
+    here by code point, as they are meant to, rather than by the
+    collation of the database, which depends on the database.
+    """
+    return sorted(video_files, key=lambda x: (x.sort_key, x.filename))
+
+
+def _video_sort_key(relative_dirname, title, basename):
+    """
+    Sort key string, ordering videos by directory, the numbers in the
+    title (so that episode 2 comes before episode 10), title, and file
+    name.
+    """
+    # Parts are terminated by \x01 and separated by \x02, so that
+    # shorter sequences sort first, as tuples do
+    dirname = u"\x02".join(relative_dirname.split(os.path.sep))
+    numbers = re.sub(r'[^0-9 \t]', '', title).split()
+    numbers = u"\x02".join(u"%02d%s" % (len(x), x) for x in (y.lstrip('0') for y in numbers))
+    return u"\x01".join([dirname, numbers, title, basename])
+
+
+class VideoFolder(models.Model):
+    """
+    Directory of the video index, relative to the video directories,
+    with the number of videos in it and its subdirectories. Maintained
+    by `update_video_folders`, so that the index can be browsed one
+    directory at a time. `version` changes whenever the listing of the
+    folder changes, for caching the listings.
+
+    The thumbnails of the folder are combined into atlas images by
+    `create_folder_atlases`, which sets `atlas_version` to the version
+    the atlas was made for and `atlas` to its manifest (see
+    `get_atlas`).
+    """
+    path = models.TextField()
+    path_key = models.CharField(max_length=40, db_index=True)
+    parent_key = models.CharField(max_length=40, db_index=True)
+    name = models.TextField()
+    video_count = models.IntegerField()
+    version = models.CharField(max_length=32, default='')
+    atlas_version = models.CharField(max_length=32, blank=True)
+    atlas = models.TextField(blank=True)
+
+    def get_atlas(self):
+        """
+        Return the atlas manifest, ``{thumbnail: [page, x, y]}``, or
+        None if there is no atlas.
+        """
+        if not self.atlas:
+            return None
+        return json.loads(self.atlas)
 
     def __str__(self):
-        return "VideoFile: '%s/%s'" % (self.relative_dirname, self.basename)
+        return "VideoFolder: '%s'" % (self.path,)
+
+
+# Keys of the folders changed since the last `update_video_folders`
+_changed_folders = set()
+
+
+class ScannedDirectory(models.Model):
+    """
+    Directory state recorded by the scanner, used for skipping
+    unchanged directories on subsequent scans.
+    """
+    path = models.TextField()
+    mtime = models.FloatField()
+    inode = models.BigIntegerField()
+
+    def __str__(self):
+        return "ScannedDirectory: '%s'" % (self.path,)
+
+
+class FileMimeType(models.Model):
+    """
+    MIME type detected by the scanner, valid while the file size and
+    modification time stay the same.
+    """
+    path_hash = models.CharField(max_length=40, db_index=True)
+    filename = models.TextField()
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    mimetype = models.CharField(max_length=256)
+
+    def __str__(self):
+        return "FileMimeType: '%s'" % (self.filename,)
+
+
+class ScanRun(models.Model):
+    """
+    Timing profile of a scan.
+    """
+    started = models.DateTimeField()
+    duration = models.FloatField()
+    full = models.BooleanField(default=False)
+    paths = models.TextField(blank=True)
+    success = models.BooleanField(default=False)
+    profile = models.TextField()
+
+    class Meta:
+        ordering = ['-started']
+
+    def get_profile(self):
+        return json.loads(self.profile)
+
+    def format_report(self):
+        """
+        Format the profile as a plain-text report.
+        """
+        profile = self.get_profile()
+        lines = []
+
+        lines.append("Scan started %s: %.2f s wall, %.2f s CPU, %.2f s CPU in subprocesses%s"
+                     % (self.started.strftime('%Y-%m-%d %H:%M:%S'),
+                        profile['wall'], profile['cpu'], profile['cpu_children'],
+                        "" if self.success else " (FAILED)"))
+
+        lines.append("")
+        lines.append("%-50s %8s %10s %10s %10s" % ("Phase", "Items", "Wall [s]", "CPU [s]", "Sub [s]"))
+        for phase in profile['phases']:
+            lines.append("%-50s %8d %10.3f %10.3f %10.3f"
+                         % (phase['name'][:50], phase['count'], phase['wall'],
+                            phase['cpu'], phase['cpu_children']))
+
+        lines.append("")
+        lines.append("%-50s %8s %10s %10s %10s" % ("Hook", "", "Wall [s]", "CPU [s]", "Sub [s]"))
+        for hook in profile['hooks']:
+            lines.append("%-50s %8s %10.3f %10.3f %10.3f"
+                         % (hook['name'][-50:], "", hook['wall'], hook['cpu'],
+                            hook['cpu_children']))
+
+        for phase in profile['phases']:
+            if not phase['slowest']:
+                continue
+            lines.append("")
+            lines.append("Slowest items: %s" % (phase['name'],))
+            for item, elapsed in phase['slowest']:
+                lines.append("  %10.3f s  %s" % (elapsed, item))
+
+        return u"\n".join(lines)
+
+    def phase_summary(self):
+        return u", ".join(u"%s %.1f s" % (phase['name'], phase['wall'])
+                          for phase in self.get_profile()['phases'])
+
+    def __str__(self):
+        return "ScanRun: %s" % (self.started,)
+
+
+class ScanRequest(models.Model):
+    """
+    Scan queued for the scan worker. `paths` are the newline-separated
+    directories to scan, or empty for the whole library. `started` is
+    set when the worker takes up the request. Requests whose scan
+    failed are kept with the `error`, until the next request.
+    """
+    created = models.DateTimeField()
+    full = models.BooleanField(default=False)
+    paths = models.TextField(blank=True)
+    started = models.DateTimeField(null=True)
+    error = models.TextField(blank=True)
+
+    def get_paths(self):
+        if not self.paths:
+            return None
+        return self.paths.split(u"\n")
+
+    def __str__(self):
+        return "ScanRequest: %s" % (self.created,)
+
 
 class StreamingTicket(models.Model):
     secret = models.CharField(max_length=128, null=False, unique=True)
@@ -189,13 +457,25 @@ class StreamingTicket(models.Model):
 @receiver(post_delete, sender=VideoFile)
 def _video_file_cleanup_thumbnails(sender, instance, using, **kwargs):
     """
-    Remove thumbnails when the video is removed from the database.
+    Remove thumbnails and storyboards when the video is removed from
+    the database.
     """
-    fn = instance.thumbnail_filename
-    if not fn:
-        return
-    if os.path.isfile(fn):
-        os.unlink(fn)
+    for fn in [instance.thumbnail_filename] + instance.storyboard_filenames:
+        if fn and os.path.isfile(fn):
+            os.unlink(fn)
+
+
+@receiver(post_delete, sender=VideoFile)
+def _video_file_folder_changed(sender, instance, using, **kwargs):
+    folder_changed(instance.folder_key)
+
+
+@receiver(post_delete, sender=VideoFolder)
+def _video_folder_cleanup_atlases(sender, instance, using, **kwargs):
+    """
+    Remove the atlas images when the folder is removed.
+    """
+    remove_folder_atlases(instance.path_key)
 
 
 @receiver(post_delete, sender=StreamingTicket)
@@ -208,48 +488,731 @@ def _streaming_ticket_cleanup_symlink(sender, instance, using, **kwargs):
         os.unlink(fn)
 
 
-@register_scanner
-def _video_scanner(existing_files, mime_cache):
-    files_in_db = set(asfsunicode(x) for x in VideoFile.objects.values_list('filename', flat=True))
-    to_add = existing_files.difference(files_in_db)
-    to_remove = files_in_db.difference(existing_files)
+@register_scanner(patterns=[x[0] for x in settings.MEDIASNAKEFILES_ACCEPTED_FILE_TYPES],
+                  model=VideoFile)
+def _video_scanner(changes, mime_cache):
+    file_types = FileClassifier((file_pattern, (mime_pattern, replacement_mimetype))
+                                for file_pattern, mime_pattern, replacement_mimetype
+                                in settings.MEDIASNAKEFILES_ACCEPTED_FILE_TYPES)
 
-    # Add files not yet in DB
-    scan_message("Adding videos...")
-    for filename in to_add:
-        basename = os.path.basename(filename)
+    writer = BulkWriter(VideoFile)
+
+    # Add new files, detecting MIME types in bulk
+    scan_phase("Adding videos", total=len(changes.added))
+    for batch in iter_batches(changes.added, settings.MEDIASNAKEFILES_SCAN_BATCH_SIZE):
+        media_ids = get_media_ids(batch)
+        mime_cache.prefetch(batch)
+
+        for filename in batch:
+            with scan_item(filename):
+                basename = os.path.basename(filename)
+                if filename not in media_ids:
+                    continue
 
-        # Check that the extension and mime type
-        # are indicative of a video file
-        for file_pattern, mime_pattern, replacement_mimetype in \
-                settings.MEDIASNAKEFILES_ACCEPTED_FILE_TYPES:
-            if (fnmatch.fnmatch(basename, file_pattern) and
-                fnmatch.fnmatch(mime_cache.get(filename), mime_pattern)):
-                if replacement_mimetype is not None:
-                    mimetype = replacement_mimetype
+                # Check that the mime type is indicative of a video file
+                detected_mimetype = mime_cache.get(filename)
+                for mime_pattern, replacement_mimetype in file_types.match(basename):
+                    if fnmatch.fnmatch(detected_mimetype, mime_pattern):
+                        if replacement_mimetype is not None:
+                            mimetype = replacement_mimetype
+                        else:
+                            mimetype = detected_mimetype
+                        break
                 else:
-                    mimetype = mime_cache.get(filename)
-                break
+                    continue
+
+                scan_message("Adding video: %r" % (filename,))
+                fields = VideoFile.fields_for_filename(filename)
+                folder_changed(fields['folder_key'])
+                writer.add(VideoFile(mimetype=mimetype, media_id=media_ids[filename],
+                                     **fields))
+
+        mime_cache.release(batch)
+
+    writer.flush()
+
+    # Moved videos leave one folder and enter another
+    for old, new in changes.moved:
+        folder_changed(VideoFile.fields_for_filename(old)['folder_key'],
+                       VideoFile.fields_for_filename(new)['folder_key'])
+
+    # The fields derived from file names change if the video
+    # directories are reconfigured
+    if changes.full:
+        scan_phase("Updating video fields")
+        update_video_fields()
+
+    # Update the folder tree and create thumbnails, if missing, after
+    # the rest of the scan, when removed videos are gone
+    def process_later():
+        scan_phase("Updating video folders")
+        update_video_folders()
+
+        unprobed = VideoFile.objects.filter(probed=False).filter(
+            models.Q(probe_retry=None) | models.Q(probe_retry__lte=django.utils.timezone.now()))
+        probe_videos(iter_chunked(unprobed), total=unprobed.count())
+
+        scan_phase("Checking video thumbnails")
+        if changes.full:
+            video_files = (x for x in iter_chunked(VideoFile.objects.all())
+                           if not x.thumbnail or not os.path.isfile(x.thumbnail_filename))
+            total = None
         else:
-            continue
-
-        scan_message("Adding video: %r" % (filename,))
-        video_file = VideoFile(filename=filename, mimetype=mimetype)
-        video_file.save()
-
-    # Remove non-existent entries
-    scan_message("Cleaning up non-existing videos...")
-    for filename in to_remove:
-        VideoFile.objects.filter(filename=filename).delete()
-
-    # Create thumbnails, if missing
-    scan_message("Processing video thumbnails...")
-    objects = VideoFile.objects.all()
-    for video_file in objects:
-        if video_file.create_thumbnail():
-            scan_message("Creating thumbnails: %r" % (video_file.filename,))
+            video_files = iter_chunked(VideoFile.objects.filter(thumbnail=''))
+            total = VideoFile.objects.filter(thumbnail='').count()
+        create_thumbnails(video_files, total=total)
+
+        scan_phase("Checking folder atlases")
+        folders = VideoFolder.objects.exclude(atlas_version=models.F('version'))
+        create_folder_atlases(iter_chunked(folders), total=folders.count())
+
+        # Storyboards need the probed duration
+        if settings.MEDIASNAKEFILES_STORYBOARD_FRAMES:
+            scan_phase("Checking video storyboards")
+            queryset = VideoFile.objects.exclude(duration=None).filter(
+                models.Q(storyboard_retry=None)
+                | models.Q(storyboard_retry__lte=django.utils.timezone.now()))
+            if changes.full:
+                video_files = (x for x in iter_chunked(queryset)
+                               if not x.storyboard
+                               or not all(os.path.isfile(y) for y in x.storyboard_filenames))
+                total = None
+            else:
+                video_files = iter_chunked(queryset.filter(storyboard=''))
+                total = queryset.filter(storyboard='').count()
+            create_storyboards(video_files, total=total)
+
+    return process_later
   
 
+def update_video_fields():
+    """
+    Update the fields of videos derived from their file names, where
+    they differ from the stored ones.
+    """
+    queryset = VideoFile.objects.only(*VideoFile.fields_for_filename(u'/').keys())
+    for batch in iter_batches(iter_chunked(queryset), 500):
+        with transaction.atomic():
+            for video_file in batch:
+                fields = VideoFile.fields_for_filename(video_file.filename)
+                if any(getattr(video_file, k) != v for k, v in fields.items()):
+                    library_changed()
+                    folder_changed(video_file.folder_key, fields['folder_key'])
+                    VideoFile.objects.filter(pk=video_file.pk).update(**fields)
+
+
+def update_video_folders():
+    """
+    Update `VideoFolder` to match the directories of the videos, and
+    give a new version to the folders whose listings changed: those
+    noted by `folder_changed`, and the parents of folders added,
+    removed, or with a changed video count.
+    """
+    # One aggregate query; there are far fewer folders than videos
+    counts = {}
+    for row in VideoFile.objects.values('relative_dirname') \
+                                .annotate(count=models.Count('pk')).order_by():
+        path = row['relative_dirname']
+        while True:
+            counts[path] = counts.get(path, 0) + row['count']
+            if path == u'.':
+                break
+            path = os.path.dirname(path) or u'.'
+
+    consumed = set(_changed_folders)
+    changed = set(consumed)
+    version = _new_folder_version()
+
+    existing = dict((x.path_key, x) for x in VideoFolder.objects.all())
+    to_add = []
+    to_update = []
+    for path, count in counts.items():
+        key = path_hash(path)
+        folder = existing.pop(key, None)
+        if folder is None:
+            parent = path_hash(os.path.dirname(path) or u'.') if path != u'.' else ''
+            to_add.append(VideoFolder(path=path, path_key=key, parent_key=parent,
+                                      name=os.path.basename(path) or path,
+                                      video_count=count, version=version))
+            changed.add(parent)
+        elif folder.video_count != count:
+            to_update.append((folder.pk, count))
+            changed.update([key, folder.parent_key])
+    changed.update(x.parent_key for x in existing.values())
+
+    with transaction.atomic():
+        stale = [x.pk for x in existing.values()]
+        for j in range(0, len(stale), 500):
+            VideoFolder.objects.filter(pk__in=stale[j:j+500]).delete()
+        for pk, count in to_update:
+            VideoFolder.objects.filter(pk=pk).update(video_count=count)
+        changed = list(changed)
+        for j in range(0, len(changed), 500):
+            VideoFolder.objects.filter(path_key__in=changed[j:j+500]).update(version=version)
+        VideoFolder.objects.bulk_create(to_add, batch_size=500)
+
+    _changed_folders.difference_update(consumed)
+    if to_add or to_update or stale:
+        library_changed()
+
+
+def folder_changed(*keys):
+    """
+    Note that the listings of the video folders with the given
+    `folder_key` values changed, so that `update_video_folders` gives
+    them a new version.
+    """
+    _changed_folders.update(keys)
+
+
+def _new_folder_version():
+    return "%016x" % (random.getrandbits(64),)
+
+
+def create_thumbnails(video_files, total=None):
+    """
+    Create missing thumbnails for the given videos, running several
+    thumbnailer processes in parallel.
+
+    `video_files` is consumed in batches, so it can be an iterator
+    over a large number of videos.
+    """
+    to_save = []
+
+    def save():
+        if to_save:
+            library_changed()
+        with transaction.atomic():
+            for video_file in to_save:
+                VideoFile.objects.filter(pk=video_file.pk).update(thumbnail=video_file.thumbnail)
+                # The thumbnail id is the content hash of the video
+                if video_file.media_id is not None:
+                    MediaFile.objects.filter(pk=video_file.media_id).update(
+                        content_hash=video_file.thumbnail)
+            keys = list(set(x.folder_key for x in to_save))
+            if keys:
+                VideoFolder.objects.filter(path_key__in=keys).update(version=_new_folder_version())
+        del to_save[:]
+
+    def job(filename):
+        start = time.time()
+        result = make_thumbnail(filename, settings.MEDIASNAKEFILES_THUMBNAIL_TIMEOUT)
+        return result, time.time() - start
+
+    done = 0
+    with WorkerPool(settings.MEDIASNAKEFILES_THUMBNAIL_WORKERS) as pool:
+        for batch in iter_batches(video_files, settings.MEDIASNAKEFILES_SCAN_BATCH_SIZE):
+            if done == 0:
+                scan_phase("Creating thumbnails", total=total)
+
+            by_filename = dict((x.filename, x) for x in batch)
+            for video_file in batch:
+                pool.submit(job, video_file.filename)
+
+            for args, result, exc_info in pool.results():
+                done += 1
+                filename = args[0]
+                if exc_info is not None:
+                    scan_step()
+                    scan_message("Failed to create thumbnail: %r: %s" % (filename, exc_info[1]))
+                    continue
+
+                (thumbnail, created), elapsed = result
+                scan_step(item=filename, elapsed=elapsed)
+                video_file = by_filename[filename]
+                if video_file.thumbnail != thumbnail:
+                    video_file.thumbnail = thumbnail
+                    to_save.append(video_file)
+                    if len(to_save) >= 50:
+                        save()
+
+                if created:
+                    scan_message("Creating thumbnails (%d/%s): %r"
+                                 % (done, total or "?", filename))
+
+    save()
+
+
+def retry_time(failures):
+    """
+    Time at which to try again work that has failed `failures` times:
+    after an hour, doubling with each failure up to a month.
+    """
+    hours = min(2 ** min(failures - 1, 10), 30 * 24)
+    return django.utils.timezone.now() + datetime.timedelta(hours=hours)
+
+
+def probe_videos(video_files, total=None):
+    """
+    Probe the technical metadata of the given videos with ffprobe,
+    running several processes in parallel, and store it.
+
+    Videos that ffprobe fails on are marked probed, without metadata.
+    Those that could not be probed at all (time limit exceeded, file
+    unreadable) are tried again on a later scan, see `retry_time`.
+    Nothing is done if ffprobe is not installed.
+    """
+    if not find_program(settings.MEDIASNAKEFILES_FFPROBE):
+        scan_message("Not probing videos: %r not found" % settings.MEDIASNAKEFILES_FFPROBE)
+        return
+
+    to_save = []
+    failed = []
+
+    def save():
+        if to_save:
+            library_changed()
+        with transaction.atomic():
+            for video_file, fields in to_save:
+                VideoFile.objects.filter(pk=video_file.pk).update(probed=True, **fields)
+            for video_file in failed:
+                failures = video_file.probe_failures + 1
+                VideoFile.objects.filter(pk=video_file.pk).update(
+                    probe_failures=failures, probe_retry=retry_time(failures))
+            keys = list(set(x.folder_key for x, fields in to_save))
+            if keys:
+                VideoFolder.objects.filter(path_key__in=keys).update(version=_new_folder_version())
+        del to_save[:]
+        del failed[:]
+
+    def job(filename):
+        start = time.time()
+        result = probe_video(filename, settings.MEDIASNAKEFILES_PROBE_TIMEOUT)
+        return result, time.time() - start
+
+    done = 0
+    with WorkerPool(settings.MEDIASNAKEFILES_PROBE_WORKERS) as pool:
+        for batch in iter_batches(video_files, settings.MEDIASNAKEFILES_SCAN_BATCH_SIZE):
+            if done == 0:
+                scan_phase("Probing videos", total=total)
+
+            by_filename = dict((x.filename, x) for x in batch)
+            for video_file in batch:
+                pool.submit(job, video_file.filename)
+
+            for args, result, exc_info in pool.results():
+                done += 1
+                filename = args[0]
+                if exc_info is not None:
+                    scan_step()
+                    scan_message("Failed to probe video: %r: %s" % (filename, exc_info[1]))
+                    failed.append(by_filename[filename])
+                else:
+                    fields, elapsed = result
+                    scan_step(item=filename, elapsed=elapsed)
+                    to_save.append((by_filename[filename], fields))
+                if len(to_save) + len(failed) >= 50:
+                    save()
+
+    save()
+
+
+def probe_video(filename, timeout=None):
+    """
+    Get the technical metadata of a video file with ffprobe, as a dict
+    of `VideoFile` field values, empty if ffprobe fails on the file.
+    Does not touch the database.
+    """
+    throttle_read(PROBE_READ_BYTES)
+
+    # Quiet, as the error output is mixed with the JSON
+    returncode, out = run_command([settings.MEDIASNAKEFILES_FFPROBE, '-v', 'quiet',
+                                   '-of', 'json', '-show_format', '-show_streams',
+                                   filename],
+                                  timeout=timeout)
+    if returncode != 0:
+        return {}
+
+    try:
+        data = json.loads(out.decode('utf-8'))
+    except UnicodeDecodeError:
+        data = json.loads(out.decode('latin-1'))
+    except ValueError:
+        return {}
+
+    return parse_probe(data, size=os.path.getsize(filename))
+
+
+def parse_probe(data, size=None):
+    """
+    Convert ffprobe JSON output (``-show_format -show_streams``) to a
+    dict of `VideoFile` field values. `size` is the file size, for
+    estimating the bitrate if ffprobe does not report it.
+    """
+    fields = {}
+    fmt = data.get('format', {})
+
+    try:
+        fields['duration'] = float(fmt['duration'])
+    except (ValueError, KeyError):
+        pass
+
+    try:
+        fields['bitrate'] = int(float(fmt['bit_rate']) / 1000)
+    except (ValueError, KeyError):
+        if size and fields.get('duration'):
+            fields['bitrate'] = int(size * 8 / (1000 * fields['duration']))
+
+    audio_codecs = []
+    audio_languages = []
+    subtitle_languages = []
+
+    for stream in data.get('streams', []):
+        tags = stream.get('tags', {})
+        language = (tags.get('language') or tags.get('LANGUAGE') or u'').lower()
+        if language == u'und':
+            language = u''
+
+        codec_type = stream.get('codec_type')
+        codec = stream.get('codec_name', u'')
+        if codec_type == 'video':
+            # Cover art in audio and Matroska files shows up as video
+            if stream.get('disposition', {}).get('attached_pic'):
+                continue
+            if 'video_codec' not in fields:
+                fields['video_codec'] = codec
+                fields['width'] = stream.get('width')
+                fields['height'] = stream.get('height')
+        elif codec_type == 'audio':
+            audio_codecs.append(codec)
+            audio_languages.append(language)
+        elif codec_type == 'subtitle':
+            subtitle_languages.append(language)
+
+    fields['audio_codecs'] = _join_unique(audio_codecs)
+    fields['audio_languages'] = _join_unique(audio_languages)
+    fields['subtitle_languages'] = _join_unique(subtitle_languages)
+    return fields
+
+
+def _join_unique(items):
+    seen = []
+    for item in items:
+        if item and item not in seen:
+            seen.append(item)
+    return u",".join(seen)[:255]
+
+
+def make_thumbnail(filename, timeout=None):
+    """
+    Create a thumbnail for a video file.
+
+    Returns ``(thumbnail, created)``: the thumbnail id, and whether a
+    new thumbnail file was created. Does not touch the database.
+    """
+    # Create a deterministic thumbnail name
+    thumbnail = hash_content(filename)
+    thumbnail_filename = get_thumbnail_filename(thumbnail)
+
+    if os.path.isfile(thumbnail_filename):
+        return thumbnail, False
+
+    throttle_read(THUMBNAIL_READ_BYTES)
+
+    if not os.path.isdir(settings.SENDFILE_ROOT):
+        try:
+            os.makedirs(settings.SENDFILE_ROOT)
+        except OSError:
+            # Created by another worker
+            pass
+
+    fd, tmpfn = tempfile.mkstemp(dir=settings.SENDFILE_ROOT, prefix='tmp-', suffix=".jpg")
+    try:
+        os.close(fd)
+        returncode, out = run_command([settings.MEDIASNAKEFILES_FFMPEGTHUMBNAILER,
+                                       "-cjpeg", "-s320",
+                                       "-i" + filename,
+                                       "-o" + tmpfn],
+                                      timeout=timeout)
+        if returncode != 0:
+            return thumbnail, False
+
+        os.rename(tmpfn, thumbnail_filename)
+    finally:
+        if os.path.exists(tmpfn):
+            os.unlink(tmpfn)
+
+    return thumbnail, True
+
+
+def create_storyboards(video_files, total=None):
+    """
+    Create missing storyboards for the given videos, running several
+    ffmpeg processes in parallel. Videos without a known duration are
+    skipped. Failed videos are tried again later, as in `probe_videos`.
+    """
+    if not find_program(settings.MEDIASNAKEFILES_FFMPEG):
+        scan_message("Not creating storyboards: %r not found" % settings.MEDIASNAKEFILES_FFMPEG)
+        return
+
+    to_save = []
+    failed = []
+
+    def save():
+        with transaction.atomic():
+            for video_file in to_save:
+                VideoFile.objects.filter(pk=video_file.pk).update(
+                    storyboard=video_file.storyboard)
+            for video_file in failed:
+                failures = video_file.storyboard_failures + 1
+                VideoFile.objects.filter(pk=video_file.pk).update(
+                    storyboard_failures=failures, storyboard_retry=retry_time(failures))
+        del to_save[:]
+        del failed[:]
+
+    def job(video_file):
+        start = time.time()
+        result = make_storyboard(video_file.filename, video_file.duration,
+                                 width=video_file.width, height=video_file.height,
+                                 timeout=settings.MEDIASNAKEFILES_STORYBOARD_TIMEOUT)
+        return result, time.time() - start
+
+    done = 0
+    with WorkerPool(settings.MEDIASNAKEFILES_STORYBOARD_WORKERS) as pool:
+        for batch in iter_batches(video_files, settings.MEDIASNAKEFILES_SCAN_BATCH_SIZE):
+            if done == 0:
+                scan_phase("Creating storyboards", total=total)
+
+            for video_file in batch:
+                pool.submit(job, video_file)
+
+            for args, result, exc_info in pool.results():
+                done += 1
+                video_file = args[0]
+                if exc_info is not None:
+                    scan_step()
+                    scan_message("Failed to create storyboard: %r: %s"
+                                 % (video_file.filename, exc_info[1]))
+                    failed.append(video_file)
+                else:
+                    (storyboard, ok), elapsed = result
+                    scan_step(item=video_file.filename, elapsed=elapsed)
+                    if not ok:
+                        failed.append(video_file)
+                    elif video_file.storyboard != storyboard:
+                        video_file.storyboard = storyboard
+                        to_save.append(video_file)
+                if len(to_save) + len(failed) >= 50:
+                    save()
+
+    save()
+
+
+def make_storyboard(filename, duration, width=None, height=None, timeout=None):
+    """
+    Create a storyboard for a video file: a JPEG sprite sheet of
+    frames at fixed intervals, and a WebVTT track pointing to the
+    frames, for seek previews.
+
+    Returns ``(storyboard, ok)``: the storyboard id, which is the
+    content hash of the video like the thumbnail id, and whether the
+    storyboard exists. Does not touch the database.
+    """
+    storyboard = hash_content(filename)
+    sprite_filename = get_storyboard_filename(storyboard, 'jpg')
+    track_filename = get_storyboard_filename(storyboard, 'vtt')
+
+    # The track is written last
+    if os.path.isfile(track_filename):
+        return storyboard, True
+
+    frames = settings.MEDIASNAKEFILES_STORYBOARD_FRAMES
+    columns = settings.MEDIASNAKEFILES_STORYBOARD_COLUMNS
+    rows = (frames + columns - 1) // columns
+    frame_width = settings.MEDIASNAKEFILES_STORYBOARD_WIDTH
+    frame_height = frame_width * 9 // 16
+    if width and height:
+        frame_height = max(2, int(round(float(frame_width) * height / width / 2)) * 2)
+    interval = float(duration) / frames
+
+    throttle_read(os.path.getsize(filename))
+
+    if not os.path.isdir(settings.SENDFILE_ROOT):
+        try:
+            os.makedirs(settings.SENDFILE_ROOT)
+        except OSError:
+            # Created by another worker
+            pass
+
+    # A single pass over the video, decoding only the keyframes, from
+    # which one frame per interval is taken
+    filters = 'fps=1/%.6f,scale=%d:%d,setsar=1,tile=%dx%d' % (
+        interval, frame_width, frame_height, columns, rows)
+    cmd = [settings.MEDIASNAKEFILES_FFMPEG, '-v', 'error', '-y',
+           '-skip_frame', 'nokey', '-i', filename, '-an', '-sn',
+           '-vf', filters, '-frames:v', '1', '-q:v', '5']
+
+    fd, tmpfn = tempfile.mkstemp(dir=settings.SENDFILE_ROOT, prefix='tmp-', suffix=".jpg")
+    try:
+        os.close(fd)
+        returncode, out = run_command(cmd + [tmpfn], timeout=timeout)
+        if returncode != 0:
+            return storyboard, False
+        os.rename(tmpfn, sprite_filename)
+    finally:
+        if os.path.exists(tmpfn):
+            os.unlink(tmpfn)
+
+    # Cues refer to the sprite relative to the URL of the track
+    sprite_url = storyboard + ".jpg"
+    cues = [u"WEBVTT", u""]
+    for j in range(frames):
+        x = (j % columns) * frame_width
+        y = (j // columns) * frame_height
+        cues.append(u"%s --> %s" % (_vtt_timestamp(j * interval),
+                                    _vtt_timestamp((j + 1) * interval)))
+        cues.append(u"%s#xywh=%d,%d,%d,%d" % (sprite_url, x, y, frame_width, frame_height))
+        cues.append(u"")
+
+    fd, tmpfn = tempfile.mkstemp(dir=settings.SENDFILE_ROOT, prefix='tmp-', suffix=".vtt")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(u"\n".join(cues).encode('utf-8'))
+        os.rename(tmpfn, track_filename)
+    finally:
+        if os.path.exists(tmpfn):
+            os.unlink(tmpfn)
+
+    return storyboard, True
+
+
+def _vtt_timestamp(seconds):
+    millis = int(round(seconds * 1000))
+    seconds, millis = divmod(millis, 1000)
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(minutes, 60)
+    return u"%02d:%02d:%02d.%03d" % (hours, minutes, seconds, millis)
+
+
+def get_storyboard_filename(storyboard, ext):
+    storyboard = re.sub('[^a-f0-9]', '', storyboard)
+    return os.path.join(settings.SENDFILE_ROOT, storyboard) + "-storyboard." + ext
+
+
+def create_folder_atlases(folders, total=None):
+    """
+    Create the thumbnail atlases of the given folders, for their
+    current versions, and remove the atlases of older versions.
+    """
+    if not find_program(settings.MEDIASNAKEFILES_FFMPEG):
+        scan_message("Not creating folder atlases: %r not found"
+                     % settings.MEDIASNAKEFILES_FFMPEG)
+        return
+
+    done = 0
+    for folder in folders:
+        if done == 0:
+            scan_phase("Creating folder atlases", total=total)
+        done += 1
+
+        with scan_item(folder.path):
+            # The first thumbnail of each group, as in the listing
+            thumbnails = []
+            groups = set()
+            rows = sorted(VideoFile.objects.filter(folder_key=folder.path_key)
+                                           .values_list('sort_key', 'filename',
+                                                        'group_key', 'thumbnail'))
+            for sort_key, filename, group_key, thumbnail in rows:
+                if group_key in groups:
+                    continue
+                groups.add(group_key)
+                if (thumbnail and thumbnail not in thumbnails
+                        and os.path.isfile(get_thumbnail_filename(thumbnail))):
+                    thumbnails.append(thumbnail)
+
+            try:
+                cells = make_folder_atlas(folder.path_key, folder.version, thumbnails,
+                                          timeout=settings.MEDIASNAKEFILES_THUMBNAIL_TIMEOUT)
+            except (OSError, CommandTimeout) as exc:
+                cells = None
+                scan_message("Failed to create folder atlas: %r: %s" % (folder.path, exc))
+            if cells is None:
+                continue
+
+            # Unless the folder changed meanwhile
+            VideoFolder.objects.filter(pk=folder.pk, version=folder.version).update(
+                atlas_version=folder.version, atlas=json.dumps(cells))
+            remove_folder_atlases(folder.path_key, keep=folder.version)
+
+
+def make_folder_atlas(path_key, version, thumbnails, timeout=None):
+    """
+    Tile the given thumbnails into atlas images of the folder, with
+    MEDIASNAKEFILES_ATLAS_COLUMNS x MEDIASNAKEFILES_ATLAS_ROWS cells of
+    `ATLAS_CELL_SIZE` each.
+
+    Returns the manifest ``{thumbnail: [page, x, y]}``, or None if
+    ffmpeg failed. Does not touch the database.
+    """
+    width, height = ATLAS_CELL_SIZE
+    columns = settings.MEDIASNAKEFILES_ATLAS_COLUMNS
+    page_size = columns * settings.MEDIASNAKEFILES_ATLAS_ROWS
+
+    if not os.path.isdir(settings.SENDFILE_ROOT):
+        try:
+            os.makedirs(settings.SENDFILE_ROOT)
+        except OSError:
+            # Created by another worker
+            pass
+
+    cells = {}
+    for page, start in enumerate(range(0, len(thumbnails), page_size)):
+        chunk = thumbnails[start:start + page_size]
+        page_columns = min(columns, len(chunk))
+        page_rows = (len(chunk) + page_columns - 1) // page_columns
+
+        throttle_read(len(chunk) * 32 * 1024)
+
+        # The images are read with the concat demuxer and cropped to
+        # the cell size. Without -reinit_filter 0, an image of another
+        # size than the previous one would restart the filters, and
+        # the tile with them.
+        fd, listfn = tempfile.mkstemp(dir=settings.SENDFILE_ROOT, prefix='tmp-', suffix=".txt")
+        fd2, tmpfn = tempfile.mkstemp(dir=settings.SENDFILE_ROOT, prefix='tmp-', suffix=".jpg")
+        try:
+            os.close(fd2)
+            with os.fdopen(fd, 'wb') as f:
+                for thumbnail in chunk:
+                    fn = get_thumbnail_filename(thumbnail)
+                    f.write("file '%s'\n" % (fn.replace("'", "'\\''"),))
+
+            cmd = [settings.MEDIASNAKEFILES_FFMPEG, '-v', 'error', '-y',
+                   '-f', 'concat', '-safe', '0', '-reinit_filter', '0', '-i', listfn,
+                   '-vf', ('scale=%d:%d:force_original_aspect_ratio=increase,crop=%d:%d,'
+                           'setsar=1,tile=%dx%d' % (width, height, width, height,
+                                                    page_columns, page_rows)),
+                   '-frames:v', '1', '-q:v', '5', tmpfn]
+            returncode, out = run_command(cmd, timeout=timeout)
+            if returncode != 0:
+                return None
+
+            os.rename(tmpfn, get_atlas_filename(path_key, version, page))
+        finally:
+            for fn in (listfn, tmpfn):
+                if os.path.exists(fn):
+                    os.unlink(fn)
+
+        for j, thumbnail in enumerate(chunk):
+            cells[thumbnail] = [page, (j % page_columns) * width, (j // page_columns) * height]
+
+    return cells
+
+
+def remove_folder_atlases(path_key, keep=None):
+    """
+    Remove the atlas images of a folder, except those of version `keep`.
+    """
+    for fn in glob.glob(get_atlas_filename(path_key, '*', '*')):
+        version = os.path.basename(fn).split('-')[2]
+        if version != keep:
+            os.unlink(fn)
+
+
+def get_atlas_filename(path_key, version, page):
+    return os.path.join(settings.SENDFILE_ROOT,
+                        "atlas-%s-%s-%s.jpg" % (path_key, version, page))
+
+
 def get_thumbnail_filename(thumbnail):
     thumbnail = re.sub('[^a-f0-9]', '', thumbnail)
     return os.path.join(settings.SENDFILE_ROOT, thumbnail) + ".jpg"
@@ -261,6 +1224,8 @@ def hash_content(filename):
     """
     block_size = 65536
 
+    throttle_read(3 * block_size)
+
     content_hash = hashlib.sha1()
 
     with open(filename, 'rb') as f:
@@ -268,7 +1233,7 @@ def hash_content(filename):
         content_hash.update(block)
 
         f.seek(0, 2)
-        f.seek(f.tell() - block_size)
+        f.seek(max(0, f.tell() - block_size))
         block = f.read(65536)
         content_hash.update(block)
 
@@ -0,0 +1,133 @@
+"""
+Compact sets of file paths.
+
+Scans of large libraries deal with sets of millions of paths. Stored
+as full unicode strings, most of the memory goes to repeating the
+directory part of each path. Here, each directory name is stored once,
+together with a sorted tuple of the base names in it. ASCII base names
+are stored as byte strings, which in Python 2 compare and hash equal
+to the corresponding unicode strings, but take a quarter of the space.
+"""
+
+import os
+import heapq
+import bisect
+import collections
+
+
+class PathSet(collections.Set):
+    """
+    Set of paths, grouped by directory.
+
+    Supports the usual read-only set operations, plus `add`,
+    `add_names`, `update` and a `difference` that works directory by
+    directory. Iteration is in sorted order of the full paths.
+    """
+
+    def __init__(self, paths=()):
+        # dirname -> sorted tuple of base names, or an unsorted list
+        # while names are being added
+        self._dirs = {}
+        for path in paths:
+            self.add(path)
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return cls(it)
+
+    def add(self, path):
+        dirname, basename = os.path.split(path)
+        self.add_names(dirname, [basename])
+
+    def add_names(self, dirname, basenames):
+        """
+        Add the paths of `basenames` in the directory `dirname`.
+        """
+        names = self._dirs.get(dirname)
+        if names is None:
+            names = []
+        elif isinstance(names, tuple):
+            names = list(names)
+        names.extend(_compact(x) for x in basenames)
+        self._dirs[dirname] = names
+
+    def update(self, paths):
+        if isinstance(paths, PathSet):
+            for dirname in paths._dirs:
+                self.add_names(dirname, paths._names(dirname))
+        else:
+            for path in paths:
+                self.add(path)
+
+    def difference(self, other):
+        """
+        Return the paths in this set but not in `other`.
+        """
+        result = PathSet()
+        if isinstance(other, PathSet):
+            for dirname in self._dirs:
+                names = self._names(dirname)
+                other_names = other._names(dirname)
+                if other_names:
+                    other_names = set(other_names)
+                    names = tuple(x for x in names if x not in other_names)
+                if names:
+                    result._dirs[dirname] = names
+        else:
+            for path in self:
+                if path not in other:
+                    result.add(path)
+        return result
+
+    def groups(self):
+        """
+        Iterate over ``(dirname, basenames)`` of the directories in the
+        set, with `basenames` sorted.
+        """
+        for dirname in sorted(self._dirs):
+            names = self._names(dirname)
+            if names:
+                yield dirname, names
+
+    def dirs(self):
+        """
+        Return the directories containing paths in the set.
+        """
+        return [x for x in self._dirs if self._names(x)]
+
+    def _names(self, dirname):
+        names = self._dirs.get(dirname, ())
+        if isinstance(names, list):
+            names = tuple(sorted(set(names)))
+            self._dirs[dirname] = names
+        return names
+
+    def __contains__(self, path):
+        dirname, basename = os.path.split(path)
+        names = self._names(dirname)
+        j = bisect.bisect_left(names, basename)
+        return j < len(names) and names[j] == basename
+
+    def __iter__(self):
+        # Files in subdirectories can sort between the files of a
+        # directory, so merge the sorted contents of each directory
+        return heapq.merge(*[self._iter_dir(x) for x in self._dirs])
+
+    def _iter_dir(self, dirname):
+        for basename in self._names(dirname):
+            yield os.path.join(dirname, basename)
+
+    def __len__(self):
+        return sum(len(self._names(x)) for x in list(self._dirs))
+
+    def __repr__(self):
+        return "PathSet(%r)" % (list(self),)
+
+
+def _compact(name):
+    if isinstance(name, unicode):
+        try:
+            return name.encode('ascii')
+        except UnicodeError:
+            pass
+    return name
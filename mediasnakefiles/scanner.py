@@ -1,31 +1,92 @@
 import os
+import re
 import sys
+import fnmatch
 import logging
 import json
+import time
+import heapq
+import hashlib
+import itertools
+import resource
+import contextlib
+import threading
 import subprocess
 
 from django.conf import settings
+from django.db import transaction, connections
+from django.db.models import Q
 
 import django.utils.timezone
 
 from mediasnakefiles.lockfile import LockFile, LockFileError
+from mediasnakefiles.walker import walk_parallel, list_directory
+from mediasnakefiles.pathset import PathSet
+from mediasnakefiles.generation import publish_generation
+from mediasnakefiles.governor import get_governor, throttle_read, PROBE_READ_BYTES
 
 logger = logging.getLogger('mediasnake')
 
 SCAN_LOCKFILE = os.path.join(settings.DATA_DIR, 'rescan.lock')
+DEFERRED_LOCKFILE = os.path.join(settings.DATA_DIR, 'rescan-deferred.lock')
 SCAN_STATUS = os.path.join(settings.DATA_DIR, 'rescan.txt')
 
 SCAN_HOOKS = []
 
-def register_scanner(func):
+MIME_BATCH_SIZE = 256
+
+DB_CHUNK_SIZE = 5000
+
+# Directory modification times within this many seconds of the start of
+# a scan are not recorded: on file systems with coarse timestamps, a
+# file added in the same tick would leave the directory looking unchanged
+RACY_MTIME_SECONDS = 2
+
+_scan_status_lock = threading.Lock()
+
+# Progress of the scan running in this process
+_progress = None
+
+# Whether the scan running in this process has changed the library
+_library_changed = False
+
+_SCAN_PATTERNS = {}
+_SCAN_MODELS = {}
+
+def register_scanner(func=None, patterns=None, model=None):
+    """
+    Register a scanner hook, called as ``func(changes, mime_cache)``.
+
+    If `patterns` is given, the hook only receives files whose base
+    name matches one of the fnmatch patterns. The hook can return a
+    function, which is called for slow follow-up work after all hooks
+    have updated the database. It runs after the scan has released
+    its lock, so it may run concurrently with another scan.
+
+    `model` is the model the hook adds files to. It must have a
+    foreign key `media` to `MediaFile`; catalog entries not yet
+    referenced by it are passed to the hook again on later scans.
+    """
+    if func is None:
+        return lambda func: register_scanner(func, patterns=patterns, model=model)
     SCAN_HOOKS.append(func)
+    if patterns is not None:
+        _SCAN_PATTERNS[func] = tuple(patterns)
+    if model is not None:
+        _SCAN_MODELS[func] = model
+    return func
 
-def scan():
+def scan(full=False, paths=None):
     """
     Scan the video directories for files.
+
+    Only directories that changed since the previous scan are listed,
+    unless `full` is True. If `paths` is given, only the directory
+    trees under them are scanned, and the directories themselves are
+    always listed. The paths should be checked with `check_scan_paths`.
     """
     try:
-        return _scan()
+        return _scan(full=full, paths=paths)
     except:
         import traceback
         msg = traceback.format_exc()
@@ -33,42 +94,858 @@ def scan():
         set_scan_status(None)
         raise
 
-def _scan():
+def _scan(full=False, paths=None):
+    global _progress, _library_changed
+
+    from mediasnakefiles.models import ScanRun
+
     try:
-        fsencoding = sys.getfilesystemencoding()
-        
         with LockFile(SCAN_LOCKFILE, fail_if_active=True):
-            existing_files = set()
-            mime_cache = MimeCache()
-
-            # Scan for all files (batch operations are faster)
-            for root in settings.MEDIASNAKEFILES_DIRS:
-                for path, dirs, files in os.walk(root, topdown=True):
-                    msg = "Scanning directory: '%s'" % os.path.join(root, path)
-                    logger.info(msg)
-                    set_scan_status(msg)
-
-                    dirs.sort()
-                    files.sort()
-
-                    # Insert new files
-                    for basename in files:
-                        filename = os.path.normpath(os.path.join(root, path, basename))
-                        try:
-                            existing_files.add(filename.decode(fsencoding))
-                        except UnicodeError:
-                            scan_message("Invalid file name charset: %r" % (filename,))
-
-            # Process files
-            for hook in SCAN_HOOKS:
-                hook(existing_files, mime_cache)
-
-            scan_message("Scan complete")
-            set_scan_status(None)
-            return True
+            _progress = ScanProgress(settings.MEDIASNAKEFILES_SCAN_STATUS_INTERVAL)
+            _library_changed = False
+            get_governor().apply_priorities()
+            run = ScanRun.objects.create(started=django.utils.timezone.now(),
+                                         duration=0,
+                                         full=full,
+                                         paths=u"\n".join(asfsunicode(x) for x in paths or ()),
+                                         profile="{}")
+            try:
+                deferred = _scan_locked(full, paths, run.pk)
+            except:
+                _finish_scan(run)
+                raise
+            finally:
+                # Changes are published also if the scan failed midway
+                _publish_changes()
     except LockFileError:
         return False
 
+    # The slow follow-up work runs after releasing the scan lock, so
+    # that other scans need not wait for it, but one at a time
+    try:
+        with LockFile(DEFERRED_LOCKFILE, timeout=1):
+            for hook, func in deferred:
+                with _progress.timed(_hook_name(hook) + " (deferred)"):
+                    func()
+        scan_message("Scan complete")
+        run.success = True
+        return True
+    finally:
+        _publish_changes()
+        _finish_scan(run)
+
+
+def _publish_changes():
+    global _library_changed
+    if _library_changed:
+        publish_generation()
+        _library_changed = False
+
+
+def _finish_scan(run):
+    global _progress
+    _progress.finish()
+    _save_scan_run(run, _progress.profile())
+    _progress = None
+    # Another scan may have started meanwhile
+    if not LockFile.check(SCAN_LOCKFILE):
+        set_scan_status(None)
+
+
+def library_changed():
+    """
+    Note that the scan has changed the library, so that a new library
+    generation is published when it finishes.
+    """
+    global _library_changed
+    _library_changed = True
+
+
+def _save_scan_run(run, profile):
+    try:
+        run.duration = profile['wall']
+        run.profile = json.dumps(profile)
+        run.save()
+    except Exception:
+        import traceback
+        logger.error("Failed to save scan profile:\n" + traceback.format_exc())
+
+
+def _scan_locked(full, paths, scan_id):
+    from mediasnakefiles.models import ScannedDirectory, MediaFile
+
+    mime_cache = MimeCache()
+
+    if paths is None:
+        catalog = {}
+        if not full:
+            catalog = dict((asfsunicode(x.path), x)
+                           for x in ScannedDirectory.objects.all())
+
+        # Without a catalog, stale database entries can be anywhere
+        roots = settings.MEDIASNAKEFILES_DIRS
+        force = ()
+        dispatcher = ScanDispatcher(SCAN_HOOKS, full=(full or not catalog))
+    else:
+        # Only the catalog of the scanned subtrees is needed; with
+        # `full`, all directories in them are listed
+        roots = paths
+        force = set(asfsunicode(os.path.normpath(x)) for x in paths)
+        catalog = {}
+        for root in force:
+            q = Q(path=root) | Q(path__startswith=root.rstrip(os.path.sep) + os.path.sep)
+            catalog.update((asfsunicode(x.path), x)
+                           for x in ScannedDirectory.objects.filter(q))
+        dispatcher = ScanDispatcher(SCAN_HOOKS)
+
+    scan_phase("Scanning directories",
+               total=(len(catalog) or None) if paths is None else None)
+    listed, removed = _walk(roots, catalog, dispatcher, force=force,
+                            list_all=(full and paths is not None),
+                            partial=(paths is not None))
+
+    # Compare with the media catalog, and add the new files to it
+    scan_phase("Comparing with catalog")
+    combined = dispatcher.combined()
+    added_files, removed_files = _diff_catalog(combined)
+
+    # Files that were moved keep their catalog entries, and the
+    # objects referring to them
+    moves = _find_moves(added_files, removed_files, dispatcher)
+    if moves:
+        _apply_moves(moves)
+        added_files = added_files.difference(PathSet(x[1] for x in moves))
+        removed_files = removed_files.difference(PathSet(x[0].filename for x in moves))
+
+    scan_phase("Adding to catalog", total=len(added_files))
+    _add_to_catalog(added_files, dispatcher, scan_id)
+    dispatcher.route_changes(added_files, removed_files, scan_id,
+                             moved=[(x[0].filename, x[1]) for x in moves])
+
+    # Process files
+    deferred = []
+    for hook, changes in zip(dispatcher.hooks, dispatcher.changes):
+        with _progress.timed(_hook_name(hook)):
+            func = hook(changes, mime_cache)
+        if func is not None:
+            deferred.append((hook, func))
+
+    # Removing catalog entries also removes the objects referring to them
+    scan_phase("Updating catalog", total=len(removed_files))
+    writer = BulkWriter(MediaFile, field='path_hash')
+    for filename in removed_files:
+        scan_step()
+        writer.remove(path_hash(filename))
+    writer.flush()
+
+    mime_cache.cleanup(combined)
+
+    # Record the new directory states only after the hooks
+    # have processed them
+    with transaction.atomic():
+        if dispatcher.full:
+            ScannedDirectory.objects.all().delete()
+        else:
+            stale = [catalog[path].pk for path in removed]
+            stale += [catalog[path].pk for path in listed if path in catalog]
+            for j in range(0, len(stale), 500):
+                ScannedDirectory.objects.filter(pk__in=stale[j:j+500]).delete()
+
+        ScannedDirectory.objects.bulk_create(
+            ScannedDirectory(path=path, mtime=mtime, inode=inode)
+            for path, (mtime, inode) in listed.items())
+
+    # Run by the caller, after releasing the scan lock
+    return deferred
+
+
+def _diff_catalog(changes):
+    """
+    Compare the files found by a scan to the media catalog.
+
+    Returns ``(added, removed)``, PathSets of the files not yet in the
+    catalog, and of those in the catalog but no longer on disk.
+    """
+    from mediasnakefiles.models import MediaFile
+
+    added = PathSet()
+    removed = PathSet()
+    for filename, on_disk in changes.diff(MediaFile.objects, dir_hash_field='dir_hash'):
+        if on_disk:
+            added.add(filename)
+        else:
+            removed.add(filename)
+    return added, removed
+
+
+def _find_moves(added, removed, dispatcher):
+    """
+    Match files added in a scan to catalog entries of the same kind
+    removed in it, by inode and size, and failing that by content
+    hash.
+
+    Returns a list of ``(entry, filename, st)``: the removed catalog
+    entry, the new file name, and its stat result.
+    """
+    from mediasnakefiles.models import MediaFile, hash_content
+
+    if not added or not removed:
+        return []
+
+    by_inode = {}
+    by_size = {}
+    for batch in iter_batches(removed, 500):
+        hashes = [path_hash(x) for x in batch]
+        for entry in MediaFile.objects.filter(path_hash__in=hashes, size__gte=0):
+            entry.filename = asfsunicode(entry.filename)
+            by_inode.setdefault((entry.inode, entry.size, entry.kind), []).append(entry)
+            if entry.content_hash:
+                by_size.setdefault((entry.size, entry.kind), []).append(entry)
+
+    if not by_inode:
+        return []
+
+    scan_phase("Detecting moved files", total=len(added))
+
+    moves = []
+    matched = set()
+    unmatched = []
+    for filename in added:
+        scan_step()
+        try:
+            st = os.stat(filename)
+        except OSError:
+            continue
+
+        kind = dispatcher.kind(os.path.basename(filename))
+        for entry in by_inode.get((st.st_ino, st.st_size, kind), ()):
+            if entry.pk not in matched:
+                matched.add(entry.pk)
+                moves.append((entry, filename, st))
+                break
+        else:
+            if (st.st_size, kind) in by_size:
+                unmatched.append((filename, st, kind))
+
+    # Files copied to another file system get new inodes
+    for filename, st, kind in unmatched:
+        candidates = [x for x in by_size[(st.st_size, kind)] if x.pk not in matched]
+        if not candidates:
+            continue
+
+        try:
+            content_hash = hash_content(filename)
+        except (IOError, OSError):
+            continue
+
+        for entry in candidates:
+            if entry.content_hash == content_hash:
+                matched.add(entry.pk)
+                moves.append((entry, filename, st))
+                break
+
+    return moves
+
+
+def _apply_moves(moves):
+    """
+    Update the catalog entries of moved files, and the file names of
+    the objects referring to them. Models can derive other fields from
+    the file name, in a static method ``fields_for_filename(filename)``
+    returning a dict of the field values.
+    """
+    from mediasnakefiles.models import MediaFile
+
+    library_changed()
+    models = set(_SCAN_MODELS.values())
+    for batch in iter_batches(moves, 500):
+        with transaction.atomic():
+            for entry, filename, st in batch:
+                scan_message("Moved: %r -> %r" % (entry.filename, filename))
+                MediaFile.objects.filter(pk=entry.pk).update(
+                    path_hash=path_hash(filename),
+                    dir_hash=path_hash(os.path.dirname(filename)),
+                    filename=filename,
+                    mtime=st.st_mtime,
+                    inode=st.st_ino)
+                for model in models:
+                    if hasattr(model, 'fields_for_filename'):
+                        fields = model.fields_for_filename(filename)
+                    else:
+                        fields = dict(filename=filename)
+                    model.objects.filter(media=entry.pk).update(**fields)
+
+
+def _add_to_catalog(filenames, dispatcher, scan_id):
+    from mediasnakefiles.models import MediaFile
+
+    writer = BulkWriter(MediaFile)
+    for filename in filenames:
+        scan_step()
+        try:
+            st = os.stat(filename)
+        except OSError:
+            # Vanished during the scan
+            continue
+
+        writer.add(MediaFile(path_hash=path_hash(filename),
+                             dir_hash=path_hash(os.path.dirname(filename)),
+                             filename=filename,
+                             size=st.st_size,
+                             mtime=st.st_mtime,
+                             inode=st.st_ino,
+                             kind=dispatcher.kind(os.path.basename(filename)),
+                             scan=scan_id))
+    writer.flush()
+
+
+def get_media_ids(filenames):
+    """
+    Return a dict mapping file names to the ids of their `MediaFile`
+    catalog entries.
+    """
+    from mediasnakefiles.models import MediaFile
+
+    hashes = dict((path_hash(x), x) for x in filenames)
+    hash_list = list(hashes)
+    ids = {}
+    for j in range(0, len(hash_list), 500):
+        for pk, h in MediaFile.objects.filter(path_hash__in=hash_list[j:j+500]) \
+                                      .values_list('pk', 'path_hash'):
+            ids[hashes[h]] = pk
+    return ids
+
+
+def _hook_name(hook):
+    return "%s.%s" % (hook.__module__, hook.__name__)
+
+
+def _walk(roots, catalog, dispatcher, force=(), list_all=False, partial=False):
+    """
+    Walk the directory trees under `roots`, listing the directories
+    whose state differs from that recorded in `catalog`, or that are
+    in `force`. If `list_all` is True, all directories are listed.
+
+    Files in listed directories are passed to `dispatcher`. Returns
+    ``(listed, removed)``: the states of the listed directories, and
+    the catalog entries that no longer exist. If `partial` is True,
+    `roots` are only some of the video directories, and catalog
+    entries outside them are not considered removed; otherwise also
+    the entries of roots no longer configured are.
+
+    Directories modified around the start of the walk are recorded
+    with an mtime of -1, so that the next scan lists them again.
+    """
+    fsencoding = sys.getfilesystemencoding()
+    racy_after = time.time() - RACY_MTIME_SECONDS
+
+    children = {}
+    for path in catalog:
+        children.setdefault(os.path.dirname(path), []).append(path)
+
+    # Drop roots contained in other roots
+    roots = sorted(set(os.path.normpath(x) for x in roots))
+    roots = [x for x in roots
+             if not any(x.startswith(y.rstrip(os.path.sep) + os.path.sep) for y in roots)]
+    uroots = [x for x in (asfsunicode(y) for y in roots) if isinstance(x, unicode)]
+
+    def visit(path):
+        upath = asfsunicode(path)
+        if not isinstance(upath, unicode):
+            upath = None
+        entry = None
+        if upath not in force and not list_all:
+            entry = catalog.get(upath)
+
+        start = time.time()
+        try:
+            state, subdirs, files = _visit_directory(path, entry)
+        except OSError:
+            # Vanished during the scan, or not readable
+            return None, []
+
+        if files is None:
+            # Unchanged: descend to the subdirectories we know of
+            subpaths = sorted(x.encode(fsencoding) for x in children.get(upath, ()))
+        else:
+            scan_message("Scanning directory: '%s'" % (path,))
+            subpaths = [os.path.join(path, x) for x in subdirs]
+
+        scan_step(item=path, elapsed=time.time() - start)
+        return (upath, state, subdirs, files), subpaths
+
+    threads = settings.MEDIASNAKEFILES_SCAN_THREADS
+    if isinstance(threads, dict):
+        threads = dict((os.path.normpath(k), v) for k, v in threads.items())
+
+    listed = {}
+    visited = set()
+
+    for path, result in walk_parallel(roots, visit, threads):
+        if result is None:
+            continue
+
+        upath, state, subdirs, files = result
+
+        if upath is not None:
+            visited.add(upath)
+
+        if files is None:
+            continue
+
+        names = []
+        for basename in files:
+            try:
+                ubasename = basename.decode(fsencoding)
+            except UnicodeError:
+                ubasename = None
+            if upath is None or ubasename is None:
+                scan_message("Invalid file name charset: %r" % (os.path.join(path, basename),))
+                continue
+            names.append(ubasename)
+
+        if upath is not None:
+            dispatcher.add_files(upath, names)
+            dispatcher.add_dirs([upath])
+            if state[0] >= racy_after:
+                state = (-1.0,) + state[1:]
+            listed[upath] = state
+
+    removed = set(path for path in catalog
+                  if path not in visited and (not partial or _is_under(path, uroots)))
+    dispatcher.add_dirs(removed)
+
+    return listed, removed
+
+
+def _visit_directory(path, entry):
+    """
+    Stat a directory, and list its contents unless it matches the
+    catalog `entry`.
+
+    Returns ``((mtime, inode), subdirs, files)``, where `subdirs` and
+    `files` are sorted lists of base names, or None if the directory
+    was not listed.
+    """
+    st = os.stat(path)
+    state = (st.st_mtime, st.st_ino)
+
+    if entry is not None and (entry.mtime, entry.inode) == state:
+        return state, None, None
+
+    subdirs, files = list_directory(path)
+    return state, subdirs, files
+
+
+def check_scan_paths(paths):
+    """
+    Normalize paths to scan, checking that they are existing
+    directories inside the video directories.
+
+    Raises ValueError if not.
+    """
+    roots = [os.path.normpath(os.path.abspath(x)) for x in settings.MEDIASNAKEFILES_DIRS]
+    result = []
+    for path in paths:
+        path = os.path.normpath(os.path.abspath(path))
+        if not _is_under(path, roots):
+            raise ValueError("Path %r is not inside the video directories" % (path,))
+        if not os.path.isdir(path):
+            raise ValueError("Path %r is not a directory" % (path,))
+        result.append(path)
+    return result
+
+
+def _is_under(path, roots):
+    for root in roots:
+        if path == root or path.startswith(root.rstrip(os.path.sep) + os.path.sep):
+            return True
+    return False
+
+
+class BulkWriter(object):
+    """
+    Accumulate new objects and removed file names for `model`, and
+    write them to the database in batches, one transaction per batch.
+    """
+
+    def __init__(self, model, field='filename', batch_size=None):
+        if batch_size is None:
+            batch_size = settings.MEDIASNAKEFILES_SCAN_BATCH_SIZE
+        self.model = model
+        self.field = field
+        self.batch_size = batch_size
+        self._to_add = []
+        self._to_remove = []
+
+    def add(self, obj):
+        self._to_add.append(obj)
+        if len(self._to_add) >= self.batch_size:
+            self.flush()
+
+    def remove(self, filename):
+        self._to_remove.append(filename)
+        if len(self._to_remove) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._to_add and not self._to_remove:
+            return
+
+        library_changed()
+        with transaction.atomic():
+            if self._to_remove:
+                # This still sends post_delete for each removed object
+                lookup = {self.field + '__in': self._to_remove}
+                self.model.objects.filter(**lookup).delete()
+            if self._to_add:
+                self.model.objects.bulk_create(self._to_add)
+
+        self._to_add = []
+        self._to_remove = []
+
+
+def iter_chunked(queryset, chunk_size=DB_CHUNK_SIZE):
+    """
+    Iterate over the objects in `queryset`, fetching them in chunks
+    ordered by primary key, so that not all of them are in memory
+    at once.
+    """
+    queryset = queryset.order_by('pk')
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(chunk[:chunk_size])
+        for obj in chunk:
+            yield obj
+        if len(chunk) < chunk_size:
+            break
+        last = chunk[-1].pk
+
+
+def iter_values(queryset, field, chunk_size=DB_CHUNK_SIZE):
+    """
+    Iterate over the values of `field` in `queryset`, in chunks as
+    `iter_chunked` does.
+    """
+    queryset = queryset.order_by('pk').values_list('pk', field)
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(pk__gt=last)
+        chunk = list(chunk[:chunk_size])
+        for pk, value in chunk:
+            yield value
+        if len(chunk) < chunk_size:
+            break
+        last = chunk[-1][0]
+
+
+def iter_sorted_values(queryset, field, chunk_size=DB_CHUNK_SIZE):
+    """
+    Iterate over the values of `field` in `queryset` in sorted order,
+    fetching them in chunks.
+    """
+    queryset = queryset.order_by(field).values_list(field, flat=True)
+    last = None
+    while True:
+        chunk = queryset if last is None else queryset.filter(**{field + '__gt': last})
+        chunk = list(chunk[:chunk_size])
+        for value in chunk:
+            yield value
+        if len(chunk) < chunk_size:
+            break
+        last = chunk[-1]
+
+
+def merge_diff(files, values):
+    """
+    Merge-join two sorted iterables of file names.
+
+    Yields ``(filename, True)`` for names only in `files`, and
+    ``(filename, False)`` for names only in `values`. Duplicates in
+    `values` are skipped. Raises ValueError if `values` turns out not
+    to be sorted.
+    """
+    files = iter(files)
+    values = iter(values)
+    f = next(files, None)
+    v = next(values, None)
+    last = None
+
+    while f is not None or v is not None:
+        if v is not None and last is not None and v <= last:
+            if v != last:
+                raise ValueError("File names not in sorted order: %r after %r" % (v, last))
+            v = next(values, None)
+            continue
+
+        if v is None or (f is not None and f < v):
+            yield f, True
+            f = next(files, None)
+        else:
+            if f is None or v < f:
+                yield v, False
+            else:
+                f = next(files, None)
+            last = v
+            v = next(values, None)
+
+
+def iter_batches(iterable, size):
+    """
+    Split `iterable` into lists of at most `size` items.
+    """
+    it = iter(iterable)
+    while True:
+        batch = list(itertools.islice(it, size))
+        if not batch:
+            break
+        yield batch
+
+
+class FileClassifier(object):
+    """
+    Match base names of files against fnmatch patterns.
+
+    `patterns` is a sequence of ``(pattern, value)``. Patterns of the
+    form ``*.ext`` are matched with a single regular expression.
+    """
+
+    def __init__(self, patterns):
+        patterns = list(patterns)
+
+        suffixes = []
+        self._other = []
+        for pattern, value in patterns:
+            rest = pattern[1:]
+            if pattern.startswith('*') and not any(c in rest for c in '*?['):
+                suffixes.append((rest, value))
+            else:
+                self._other.append((re.compile(fnmatch.translate(pattern)), value))
+
+        # A name ending with a suffix also ends with its suffixes
+        self._values = {}
+        for suffix, value in suffixes:
+            if suffix not in self._values:
+                values = []
+                for other, v in suffixes:
+                    if suffix.endswith(other) and v not in values:
+                        values.append(v)
+                self._values[suffix] = values
+
+        if self._values:
+            # The match starting leftmost is the longest suffix
+            self._regex = re.compile(
+                '(?:' + '|'.join(re.escape(x) for x in self._values) + r')\Z',
+                re.S)
+        else:
+            self._regex = None
+
+    def match(self, basename):
+        """
+        Return the values of the patterns matching `basename`.
+        """
+        values = []
+        if self._regex is not None:
+            m = self._regex.search(basename)
+            if m:
+                values = self._values[m.group(0)]
+        if self._other:
+            values = values + [v for regex, v in self._other
+                               if regex.match(basename) and v not in values]
+        return values
+
+
+class ScanDispatcher(object):
+    """
+    Route the files found by a scan to the hooks whose patterns they
+    match, collecting a `ScanChanges` for each hook.
+    """
+
+    def __init__(self, hooks, full=False):
+        self.hooks = list(hooks)
+        self.full = full
+        self.changes = [ScanChanges(full=full, model=_SCAN_MODELS.get(hook))
+                        for hook in self.hooks]
+
+        patterns = []
+        self._catch_all = []
+        for hook, changes in zip(self.hooks, self.changes):
+            if hook in _SCAN_PATTERNS:
+                patterns.extend((pattern, changes) for pattern in _SCAN_PATTERNS[hook])
+            else:
+                self._catch_all.append(changes)
+
+        self._classifier = FileClassifier(patterns)
+
+    def add_file(self, filename, basename):
+        self.add_files(os.path.dirname(filename), [basename])
+
+    def add_files(self, dirname, basenames):
+        """
+        Add the files `basenames` in the directory `dirname`.
+        """
+        for changes, names in self._route(basenames):
+            changes.files.add_names(dirname, names)
+
+    def route_changes(self, added, removed, scan_id, moved=()):
+        """
+        Distribute the files added to and removed from the catalog to
+        the hooks. Catalog entries of a hook's kind from earlier scans
+        in the scanned part of the library, not yet taken up by its
+        model, are passed to it again.
+
+        `moved` are ``(old, new)`` file names of catalog entries that
+        were renamed in place. Hooks with a model get these in
+        `moved`, and other hooks as a removal and an addition.
+        """
+        from mediasnakefiles.models import MediaFile
+
+        for attr, paths in (('added', added), ('removed', removed)):
+            for dirname, basenames in paths.groups():
+                for changes, names in self._route(basenames):
+                    getattr(changes, attr).add_names(dirname, names)
+
+        for old, new in moved:
+            for changes, names in self._route([os.path.basename(new)]):
+                if changes.model is not None:
+                    changes.moved.append((old, new))
+                else:
+                    changes.removed.add(old)
+                    changes.added.add(new)
+
+        for changes in self.changes:
+            if changes.model is None:
+                continue
+            field = changes.model._meta.get_field('media')
+            unclaimed = MediaFile.objects.filter(scan__lt=scan_id,
+                                                 kind=changes.model._meta.model_name,
+                                                 **{field.related_query_name(): None})
+            for filename in changes.in_db(unclaimed, dir_hash_field='dir_hash'):
+                if filename in changes.files:
+                    changes.added.add(filename)
+
+    def kind(self, basename):
+        """
+        Return the kind of media of a file, the model name of the first
+        hook that accepts it.
+        """
+        for changes in self._classifier.match(basename) + self._catch_all:
+            if changes.model is not None:
+                return changes.model._meta.model_name
+        return u""
+
+    def _route(self, basenames):
+        if self._catch_all:
+            for changes in self._catch_all:
+                yield changes, basenames
+
+        matched = {}
+        for basename in basenames:
+            for changes in self._classifier.match(basename):
+                matched.setdefault(changes, []).append(basename)
+        for changes in self.changes:
+            if changes in matched:
+                yield changes, matched[changes]
+
+    def add_dirs(self, dirs):
+        for changes in self.changes:
+            changes.dirs.update(dirs)
+
+    def combined(self):
+        """
+        Return the changes of all hooks combined.
+        """
+        combined = ScanChanges(full=self.full)
+        for changes in self.changes:
+            combined.files.update(changes.files)
+            combined.dirs.update(changes.dirs)
+        return combined
+
+
+class ScanChanges(object):
+    """
+    Files found by a scan, as passed to the scanner hooks.
+
+    `files` is a `PathSet` of the files in the directories listed
+    during the scan, and `dirs` the listed directories plus those that
+    disappeared. Files directly inside other directories did not
+    change. If `full` is True, the whole library was listed.
+
+    `added` are the files the hook should add to its `model`: files
+    new to the media catalog, and those the model does not refer to
+    yet. `removed` are the files dropped from the catalog; objects
+    referring to them are deleted with the catalog entries after the
+    hooks have run. `moved` are ``(old, new)`` file names of files
+    whose catalog entries, and `model` objects, were renamed in place.
+    """
+
+    def __init__(self, full=False, model=None):
+        self.files = PathSet()
+        self.dirs = set()
+        self.full = full
+        self.model = model
+        self.added = PathSet()
+        self.removed = PathSet()
+        self.moved = []
+
+    def diff(self, queryset, field='filename', dir_hash_field=None):
+        """
+        Compare the files found by the scan to the file names stored in
+        `field` of `queryset`.
+
+        Yields ``(filename, on_disk)`` for each file that is only on
+        disk (`on_disk` is True) or only in the database.
+        `dir_hash_field` is as for `in_db`.
+        """
+        if self.full and connections[queryset.db].vendor == 'sqlite':
+            # SQLite sorts text in binary order, which is the same as
+            # the order of unicode strings here, so the database
+            # contents can be streamed rather than loaded in memory
+            values = (asfsunicode(x) for x in iter_sorted_values(queryset, field))
+            return merge_diff(self.files, values)
+        return self._diff_sets(queryset, field, dir_hash_field)
+
+    def _diff_sets(self, queryset, field, dir_hash_field):
+        files_in_db = self.in_db(queryset, field, dir_hash_field)
+        for filename in self.files.difference(files_in_db):
+            yield filename, True
+        for filename in files_in_db.difference(self.files):
+            yield filename, False
+
+    def in_db(self, queryset, field='filename', dir_hash_field=None):
+        """
+        Return the file names stored in `field` of `queryset` that are
+        in the part of the library covered by the scan, as a `PathSet`.
+
+        If `dir_hash_field` is given, it is an indexed field containing
+        the `path_hash` of the directory of each file, used for looking
+        up the files in the scanned directories.
+        """
+        if self.full:
+            return PathSet(asfsunicode(x) for x in iter_values(queryset, field))
+
+        files_in_db = PathSet()
+
+        if dir_hash_field is not None:
+            hashes = sorted(path_hash(x) for x in self.dirs)
+            for j in range(0, len(hashes), 500):
+                lookup = {dir_hash_field + '__in': hashes[j:j+500]}
+                for filename in iter_values(queryset.filter(**lookup), field):
+                    files_in_db.add(asfsunicode(filename))
+            return files_in_db
+
+        dirs = sorted(self.dirs)
+        for j in range(0, len(dirs), 50):
+            q = Q()
+            for dirname in dirs[j:j+50]:
+                q |= Q(**{field + '__startswith': dirname + os.path.sep})
+            for filename in iter_values(queryset.filter(q), field):
+                filename = asfsunicode(filename)
+                if os.path.dirname(filename) in self.dirs:
+                    files_in_db.add(filename)
+        return files_in_db
+
 
 def asfsunicode(s):
     if isinstance(s, unicode):
@@ -82,7 +959,180 @@ def asfsunicode(s):
 
 def scan_message(msg):
     logger.info(msg)
-    set_scan_status(msg)
+    if _progress is not None:
+        _progress.set_message(msg)
+
+
+def scan_phase(name, total=None):
+    """
+    Start a new phase of the current scan, with `total` items to
+    process, if known.
+    """
+    logger.info(name)
+    if _progress is not None:
+        _progress.start_phase(name, total)
+
+
+def scan_step(count=1, item=None, elapsed=None):
+    """
+    Mark items processed in the current phase of the scan. If `item`
+    is given, `elapsed` is the time in seconds spent on it.
+    """
+    if _progress is not None:
+        _progress.step(count, item, elapsed)
+
+
+@contextlib.contextmanager
+def scan_item(item):
+    """
+    Context manager for processing one item in the current phase of
+    the scan, recording the time spent.
+    """
+    start = time.time()
+    try:
+        yield
+    finally:
+        scan_step(item=item, elapsed=time.time() - start)
+
+
+def _cpu_times():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_usage.ru_utime + self_usage.ru_stime,
+            child_usage.ru_utime + child_usage.ru_stime)
+
+
+class ScanProgress(object):
+    """
+    Progress of a scan, written to the status file at most once per
+    `interval` seconds.
+
+    Also records a profile of the scan: wall and CPU times for each
+    phase and hook, and the slowest items of each phase.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.phases = []
+        self.hooks = []
+        self.message = None
+        self.sequence = 0
+        self.started = time.time()
+        self.finished = None
+        self._cpu_started = _cpu_times()
+        self._last_flush = 0
+        self._lock = threading.Lock()
+
+    def start_phase(self, name, total=None):
+        with self._lock:
+            self._finish_phase()
+            self.phases.append({'name': name, 'done': 0, 'total': total,
+                                'started': time.time(), 'finished': None,
+                                'cpu_started': _cpu_times(), 'cpu': None,
+                                'slowest': []})
+            self._changed(force=True)
+
+    def step(self, count=1, item=None, elapsed=None):
+        with self._lock:
+            if self.phases:
+                phase = self.phases[-1]
+                phase['done'] += count
+                if item is not None and elapsed is not None:
+                    slowest = phase['slowest']
+                    if len(slowest) < settings.MEDIASNAKEFILES_SCAN_PROFILE_SLOWEST:
+                        heapq.heappush(slowest, (elapsed, item))
+                    elif elapsed > slowest[0][0]:
+                        heapq.heapreplace(slowest, (elapsed, item))
+            self._changed()
+
+    def set_message(self, msg):
+        with self._lock:
+            self.message = msg
+            self._changed()
+
+    def flush(self):
+        with self._lock:
+            self._changed(force=True)
+
+    def finish(self):
+        with self._lock:
+            self._finish_phase()
+            self.finished = time.time()
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        """
+        Context manager recording the time spent in a scanner hook.
+        """
+        start = time.time()
+        cpu_start = _cpu_times()
+        try:
+            yield
+        finally:
+            cpu = _cpu_times()
+            self.hooks.append({'name': name,
+                               'wall': time.time() - start,
+                               'cpu': cpu[0] - cpu_start[0],
+                               'cpu_children': cpu[1] - cpu_start[1]})
+
+    def _finish_phase(self):
+        if self.phases and self.phases[-1]['finished'] is None:
+            self.phases[-1]['finished'] = time.time()
+            self.phases[-1]['cpu'] = _cpu_times()
+
+    def _changed(self, force=False):
+        now = time.time()
+        if force or now - self._last_flush >= self.interval:
+            self._last_flush = now
+            self.sequence += 1
+            set_scan_status(self.as_dict(now))
+
+    def as_dict(self, now=None):
+        if now is None:
+            now = time.time()
+
+        phases = []
+        for phase in self.phases:
+            elapsed = (phase['finished'] or now) - phase['started']
+            rate = phase['done'] / elapsed if elapsed > 0 else None
+            eta = None
+            if phase['finished'] is None and phase['total'] is not None and rate:
+                eta = max(0, phase['total'] - phase['done']) / rate
+            phases.append({'name': phase['name'],
+                           'done': phase['done'],
+                           'total': phase['total'],
+                           'elapsed': elapsed,
+                           'rate': rate,
+                           'eta': eta,
+                           'complete': phase['finished'] is not None})
+
+        return {'status': self.message,
+                'sequence': self.sequence,
+                'phases': phases}
+
+    def profile(self):
+        """
+        Return the profile of the scan, as a JSON-compatible dict.
+        """
+        now = self.finished or time.time()
+        cpu = _cpu_times()
+
+        phases = []
+        for phase in self.phases:
+            phase_cpu = phase['cpu'] or cpu
+            phases.append({'name': phase['name'],
+                           'count': phase['done'],
+                           'wall': (phase['finished'] or now) - phase['started'],
+                           'cpu': phase_cpu[0] - phase['cpu_started'][0],
+                           'cpu_children': phase_cpu[1] - phase['cpu_started'][1],
+                           'slowest': [[asfsunicode(item), elapsed]
+                                       for elapsed, item in sorted(phase['slowest'], reverse=True)]})
+
+        return {'wall': now - self.started,
+                'cpu': cpu[0] - self._cpu_started[0],
+                'cpu_children': cpu[1] - self._cpu_started[1],
+                'phases': phases,
+                'hooks': list(self.hooks)}
 
 
 def set_scan_status(status):
@@ -93,32 +1143,96 @@ def set_scan_status(status):
             pass
         return
 
+    if not isinstance(status, dict):
+        status = {'status': status}
+
     now = django.utils.timezone.now()
-    timestamp = now.strftime('%Y-%m-%d %H:%M:%S %Z')
+    status['timestamp'] = now.strftime('%Y-%m-%d %H:%M:%S %Z')
 
-    with open(SCAN_STATUS, 'wb') as f:
-        obj = {'status': status, 'timestamp': timestamp}
-        json.dump(obj, f)
+    # Replace atomically, so that readers never see partial contents
+    with _scan_status_lock:
+        tmpfn = SCAN_STATUS + '.new'
+        with open(tmpfn, 'wb') as f:
+            json.dump(status, f)
+        os.rename(tmpfn, SCAN_STATUS)
 
 
 def get_scan_status():
-    if LockFile.check(SCAN_LOCKFILE):
-        with open(SCAN_STATUS, 'rb') as f:
-            return f.read()
+    if LockFile.check(SCAN_LOCKFILE) or LockFile.check(DEFERRED_LOCKFILE):
+        try:
+            with open(SCAN_STATUS, 'rb') as f:
+                return f.read()
+        except IOError:
+            return '{"status": null, "sequence": 0, "phases": []}'
     return None
-  
+
+
+def wait_scan_status(since, timeout):
+    """
+    Wait until the scan status sequence number differs from `since`,
+    or the scan completes. Returns the status as get_scan_status.
+    """
+    end = time.time() + timeout
+    while True:
+        status = get_scan_status()
+        if status is None:
+            return None
+        try:
+            if json.loads(status).get('sequence') != since:
+                return status
+        except ValueError:
+            pass
+        if time.time() >= end:
+            return status
+        time.sleep(0.25)
+
 
 def get_mime_type(filename):
-    p = subprocess.Popen(['file', '-b', '--mime-type', filename],
-                         stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = p.communicate()
-    if p.returncode != 0:
-        return u""
-    else:
-        return out.strip()
+    return get_mime_types([filename])[0]
+
+
+def get_mime_types(filenames):
+    """
+    Detect the MIME types of files, running ``file`` once per batch.
+    Returns a list with an empty string for undetectable files.
+    """
+    fsencoding = sys.getfilesystemencoding()
+    mimetypes = []
+
+    for j in range(0, len(filenames), MIME_BATCH_SIZE):
+        batch = [x.encode(fsencoding) if isinstance(x, unicode) else x
+                 for x in filenames[j:j+MIME_BATCH_SIZE]]
+        throttle_read(len(batch) * PROBE_READ_BYTES)
+        p = subprocess.Popen(['file', '-b', '--mime-type', '--'] + batch,
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = p.communicate()
+        lines = out.splitlines()
+        if p.returncode != 0 or len(lines) != len(batch):
+            mimetypes.extend(u"" for x in batch)
+            continue
+        for line in lines:
+            line = line.strip().decode('ascii', 'replace')
+            if '/' not in line or ' ' in line:
+                # "cannot open ..." etc.
+                line = u""
+            mimetypes.append(line)
+
+    return mimetypes
+
+
+def path_hash(filename):
+    """
+    Hex digest of a file name, for indexed lookups.
+    """
+    if isinstance(filename, unicode):
+        filename = filename.encode('utf-8')
+    return hashlib.sha1(filename).hexdigest()
 
 
-def spawn_rescan():
+def spawn_manage_command(*args):
+    """
+    Run a manage.py command in the background.
+    """
     base_dir = os.path.abspath(os.path.join(settings.PROJECT_DIR, '..'))
     manage_py = os.path.join(base_dir, 'manage.py')
 
@@ -130,18 +1244,90 @@ def spawn_rescan():
     if os.path.isfile(env_python):
         python = env_python
 
-    subprocess.Popen([python, manage_py, 'rescan'],
+    subprocess.Popen([python, manage_py] + list(args),
                      stdin=devnull_r, stdout=devnull_w, stderr=devnull_r,
                      cwd=base_dir, close_fds=True)
 
 
 class MimeCache(object):
+    """
+    MIME types of files, persisted in the database for files whose
+    size and modification time have not changed.
+    """
+
     def __init__(self):
         self._cache = {}
 
     def get(self, filename):
         mimetype = self._cache.get(filename)
         if mimetype is None:
-            mimetype = get_mime_type(filename)
-            self._cache[mimetype] = mimetype
+            self.prefetch([filename])
+            mimetype = self._cache.get(filename, u"")
         return mimetype
+
+    def release(self, filenames):
+        """
+        Drop the cached MIME types of files no longer needed.
+        """
+        for filename in filenames:
+            self._cache.pop(filename, None)
+
+    def prefetch(self, filenames):
+        """
+        Detect the MIME types of several files at once.
+        """
+        from mediasnakefiles.models import FileMimeType
+
+        stats = {}
+        for filename in filenames:
+            if filename in self._cache or filename in stats:
+                continue
+            try:
+                st = os.stat(filename)
+            except OSError:
+                self._cache[filename] = u""
+                continue
+            stats[filename] = (st.st_size, st.st_mtime)
+
+        # Look up known files
+        hashes = dict((path_hash(x), x) for x in stats)
+        known = {}
+        hash_list = list(hashes)
+        for j in range(0, len(hash_list), 500):
+            for entry in FileMimeType.objects.filter(path_hash__in=hash_list[j:j+500]):
+                filename = hashes[entry.path_hash]
+                known[filename] = entry
+                if (entry.size, entry.mtime) == stats[filename]:
+                    self._cache[filename] = entry.mimetype
+
+        # Detect the rest
+        new_files = sorted(x for x in stats if x not in self._cache)
+        if not new_files:
+            return
+
+        mimetypes = get_mime_types(new_files)
+
+        with transaction.atomic():
+            stale = [known[x].pk for x in new_files if x in known]
+            for j in range(0, len(stale), 500):
+                FileMimeType.objects.filter(pk__in=stale[j:j+500]).delete()
+
+            entries = []
+            for filename, mimetype in zip(new_files, mimetypes):
+                self._cache[filename] = mimetype
+                size, mtime = stats[filename]
+                entries.append(FileMimeType(path_hash=path_hash(filename), filename=filename,
+                                            size=size, mtime=mtime, mimetype=mimetype))
+            FileMimeType.objects.bulk_create(entries)
+
+    def cleanup(self, changes):
+        """
+        Forget files that are no longer present.
+        """
+        from mediasnakefiles.models import FileMimeType
+
+        to_remove = [path_hash(x) for x in changes.in_db(FileMimeType.objects)
+                     if x not in changes.files]
+        with transaction.atomic():
+            for j in range(0, len(to_remove), 500):
+                FileMimeType.objects.filter(path_hash__in=to_remove[j:j+500]).delete()
@@ -0,0 +1,161 @@
+"""
+Queue of scans for a persistent scan worker process.
+
+Scan requests are stored in the database. The worker (``manage.py
+scanworker``) takes up all pending requests at once and runs them as
+a single scan, so that duplicate requests are coalesced. Requests
+arriving during a scan are left pending, and run as a follow-up scan.
+Requests whose scan failed are kept with the error, for showing in the
+scan status, until the next request.
+"""
+
+import os
+import time
+import logging
+
+from django.conf import settings
+from django.db import transaction, close_old_connections
+
+import django.utils.timezone
+
+from mediasnakefiles.lockfile import LockFile, LockFileError
+from mediasnakefiles.scanner import scan, asfsunicode, spawn_manage_command
+
+logger = logging.getLogger('mediasnake')
+
+SCAN_WORKER_LOCKFILE = os.path.join(settings.DATA_DIR, 'scanworker.lock')
+
+
+def request_scan(paths=None, full=False, start_worker=True):
+    """
+    Queue a scan of the library, or of the directory trees under
+    `paths`. An equal request still pending is reused.
+
+    If `start_worker` is True and no scan worker is running, one is
+    started in the background.
+    """
+    from mediasnakefiles.models import ScanRequest
+
+    paths = u"\n".join(sorted(set(asfsunicode(x) for x in paths or ())))
+
+    with transaction.atomic():
+        ScanRequest.objects.exclude(error='').delete()
+        pending = ScanRequest.objects.filter(started=None, full=full, paths=paths)[:1]
+        if pending:
+            request = pending[0]
+        else:
+            request = ScanRequest.objects.create(created=django.utils.timezone.now(),
+                                                 full=full, paths=paths)
+
+    if start_worker and not worker_running():
+        args = ['scanworker']
+        if settings.MEDIASNAKEFILES_SCAN_WORKER_EXIT_IDLE is not None:
+            args += ['--exit-idle', str(settings.MEDIASNAKEFILES_SCAN_WORKER_EXIT_IDLE)]
+        spawn_manage_command(*args)
+
+    return request
+
+
+def worker_running():
+    return LockFile.check(SCAN_WORKER_LOCKFILE)
+
+
+def scan_pending():
+    """
+    Return True if there are scan requests not yet finished.
+    """
+    from mediasnakefiles.models import ScanRequest
+    return ScanRequest.objects.filter(error='').exists()
+
+
+def scan_error():
+    """
+    Return the error of the last failed scan request, or None.
+    """
+    from mediasnakefiles.models import ScanRequest
+    errors = list(ScanRequest.objects.exclude(error='').order_by('-pk')
+                                     .values_list('error', flat=True)[:1])
+    return errors[0] if errors else None
+
+
+def merge_requests(requests):
+    """
+    Combine scan requests to ``(full, paths)`` of a single scan
+    covering all of them. `paths` is None for the whole library.
+    """
+    full = any(x.full for x in requests)
+    paths = set()
+    for request in requests:
+        request_paths = request.get_paths()
+        if request_paths is None:
+            return full, None
+        paths.update(request_paths)
+    return full, sorted(paths)
+
+
+def process_requests():
+    """
+    Run a scan covering all pending requests.
+
+    Returns True if there were requests to process.
+    """
+    from mediasnakefiles.models import ScanRequest
+
+    with transaction.atomic():
+        requests = list(ScanRequest.objects.filter(started=None).order_by('pk'))
+        ScanRequest.objects.filter(pk__in=[x.pk for x in requests]) \
+                           .update(started=django.utils.timezone.now())
+
+    if not requests:
+        return False
+
+    full, paths = merge_requests(requests)
+    try:
+        ok = scan(full=full, paths=paths)
+    except Exception as exc:
+        # Already logged by the scanner; don't retry failing scans
+        error = u"%s: %s" % (exc.__class__.__name__, exc)
+        ScanRequest.objects.filter(pk__in=[x.pk for x in requests]).update(error=error)
+        return True
+
+    if ok:
+        ScanRequest.objects.filter(pk__in=[x.pk for x in requests]).delete()
+    else:
+        # Another scan is running; try again later
+        ScanRequest.objects.filter(pk__in=[x.pk for x in requests]).update(started=None)
+
+    return True
+
+
+def run_worker(poll_interval, exit_idle=None):
+    """
+    Process scan requests until there have been none for `exit_idle`
+    seconds, or forever if it is None.
+
+    Returns False if another worker is already running.
+    """
+    from mediasnakefiles.models import ScanRequest
+
+    while True:
+        try:
+            with LockFile(SCAN_WORKER_LOCKFILE, fail_if_active=True):
+                # Requests taken up by a worker that died
+                ScanRequest.objects.exclude(started=None).filter(error='').update(started=None)
+
+                idle_since = time.time()
+                while True:
+                    close_old_connections()
+
+                    if process_requests():
+                        idle_since = time.time()
+                    elif exit_idle is not None and time.time() - idle_since >= exit_idle:
+                        break
+
+                    time.sleep(poll_interval)
+        except LockFileError:
+            return False
+
+        # A request made just before the lock was released did not
+        # start a new worker, as this one was still running
+        if not ScanRequest.objects.filter(started=None).exists():
+            return True
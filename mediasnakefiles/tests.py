@@ -5,7 +5,40 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+import os
+import re
+import json
+import time
+import shutil
+import struct
+import tempfile
+import subprocess
+
+from unittest import SkipTest
+
+from django.conf import settings
+from django.db import connection
+from django.test import TestCase, Client
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.test.utils import override_settings
+
+import django.utils.timezone
+
+from mediasnakefiles import scanner, scanqueue, views
+from mediasnakefiles.models import (VideoFile, VideoFolder, MediaFile, ScanRun, ScanRequest,
+                                    ScannedDirectory, get_thumbnail_filename, create_thumbnails,
+                                    hash_content, update_video_folders, folder_changed,
+                                    parse_probe, probe_videos, make_storyboard, create_storyboards,
+                                    create_folder_atlases, make_folder_atlas, get_atlas_filename)
+from mediasnakefiles.watcher import InotifyWatcher, WatcherError
+from mediasnakefiles.walker import walk_parallel, list_directory
+from mediasnakefiles.workers import find_program
+from mediasnakefiles.pathset import PathSet
+from mediasnakefiles.generation import get_generation, media_version
+from mediasnakefiles.governor import TokenBucket, ResourceGovernor
+from mediasnakefiles import generation as generation_module
+from mediasnakefiles import governor as governor_module
 
 
 class SimpleTest(TestCase):
@@ -14,3 +47,978 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class DataDirTestCase(TestCase):
+    """
+    Keep the lock, status and marker files of DATA_DIR in a temporary
+    directory, so that tests do not touch those of a live install.
+    """
+
+    DATA_FILES = [
+        (scanner, 'SCAN_LOCKFILE'),
+        (scanner, 'DEFERRED_LOCKFILE'),
+        (scanner, 'SCAN_STATUS'),
+        (scanqueue, 'SCAN_WORKER_LOCKFILE'),
+        (generation_module, 'LIBRARY_GENERATION'),
+        (governor_module, 'STREAM_ACTIVITY'),
+    ]
+
+    def setUp(self):
+        super(DataDirTestCase, self).setUp()
+        self.data_dir = tempfile.mkdtemp()
+        self._data_files = []
+        for module, name in self.DATA_FILES:
+            filename = getattr(module, name)
+            self._data_files.append((module, name, filename))
+            setattr(module, name, os.path.join(self.data_dir, os.path.basename(filename)))
+
+    def tearDown(self):
+        for module, name, filename in self._data_files:
+            setattr(module, name, filename)
+        shutil.rmtree(self.data_dir)
+        super(DataDirTestCase, self).tearDown()
+
+
+class ScannerTestCase(DataDirTestCase):
+    def setUp(self):
+        super(ScannerTestCase, self).setUp()
+        self.root = tempfile.mkdtemp()
+        self.seen = []
+        self._mtime = int(time.time()) - 1000
+
+        self._hooks = list(scanner.SCAN_HOOKS)
+        scanner.SCAN_HOOKS[:] = [self._record]
+
+        self._settings = override_settings(MEDIASNAKEFILES_DIRS=[self.root])
+        self._settings.enable()
+
+    def tearDown(self):
+        self._settings.disable()
+        scanner.SCAN_HOOKS[:] = self._hooks
+        shutil.rmtree(self.root)
+        super(ScannerTestCase, self).tearDown()
+
+    def _record(self, changes, mime_cache):
+        self.seen.append(changes)
+
+    def make_file(self, *parts):
+        filename = os.path.join(self.root, *parts)
+        changed = [os.path.dirname(filename)]
+        while not os.path.isdir(changed[-1]):
+            changed.append(os.path.dirname(changed[-1]))
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(b'x')
+
+        # Directories modified just now would be listed again by every
+        # scan (see scanner.RACY_MTIME_SECONDS), so date them back
+        self._mtime += 1
+        for dirname in changed:
+            os.utime(dirname, (self._mtime, self._mtime))
+        return filename
+
+    def bump_mtime(self, *parts):
+        dirname = os.path.join(self.root, *parts)
+        st = os.stat(dirname)
+        os.utime(dirname, (st.st_atime, st.st_mtime + 10))
+
+
+class TestIncrementalScan(ScannerTestCase):
+    def test_unchanged_directories_skipped(self):
+        a = self.make_file('a', 'one.dat')
+        b = self.make_file('b', 'c', 'two.dat')
+
+        self.assertTrue(scanner.scan())
+        changes = self.seen[-1]
+        self.assertTrue(changes.full)
+        self.assertEqual(changes.files, set([a, b]))
+
+        self.assertTrue(scanner.scan())
+        changes = self.seen[-1]
+        self.assertFalse(changes.full)
+        self.assertEqual(changes.files, set())
+        self.assertEqual(changes.dirs, set())
+
+        c = self.make_file('b', 'c', 'three.dat')
+        self.bump_mtime('b', 'c')
+        self.assertTrue(scanner.scan())
+        changes = self.seen[-1]
+        self.assertEqual(changes.files, set([b, c]))
+        self.assertEqual(changes.dirs, set([os.path.dirname(b)]))
+
+    def test_racy_mtime(self):
+        a = self.make_file('a', 'one.dat')
+        dirname = os.path.dirname(a)
+        now = time.time()
+        os.utime(dirname, (now, now))
+        self.assertTrue(scanner.scan())
+
+        # A file added within the same tick keeps the directory mtime
+        b = self.make_file('a', 'two.dat')
+        os.utime(dirname, (now, now))
+        self.assertTrue(scanner.scan())
+        self.assertEqual(self.seen[-1].files, set([a, b]))
+        self.assertIn(dirname, self.seen[-1].dirs)
+
+    def test_removed_directory(self):
+        a = self.make_file('a', 'one.dat')
+        self.make_file('b', 'two.dat')
+        self.assertTrue(scanner.scan())
+
+        shutil.rmtree(os.path.join(self.root, 'b'))
+        self.assertTrue(scanner.scan())
+        changes = self.seen[-1]
+        self.assertEqual(changes.files, set())
+        self.assertEqual(changes.dirs, set([self.root, os.path.join(self.root, 'b')]))
+
+        self.assertTrue(scanner.scan(full=True))
+        self.assertEqual(self.seen[-1].files, set([a]))
+
+    def test_scan_paths(self):
+        a = self.make_file('a', 'one.dat')
+        b = self.make_file('b', 'two.dat')
+        self.assertTrue(scanner.scan())
+
+        c = self.make_file('a', 'd', 'three.dat')
+        os.unlink(b)
+        self.assertTrue(scanner.scan(paths=[os.path.join(self.root, 'a')]))
+        changes = self.seen[-1]
+        self.assertFalse(changes.full)
+        self.assertEqual(changes.files, set([a, c]))
+        self.assertEqual(changes.dirs, set([os.path.dirname(a), os.path.dirname(c)]))
+
+        # Full scan of a subtree lists the unchanged directories in it
+        self.assertTrue(scanner.scan(full=True, paths=[os.path.join(self.root, 'a')]))
+        changes = self.seen[-1]
+        self.assertFalse(changes.full)
+        self.assertEqual(changes.files, set([a, c]))
+        self.assertEqual(ScannedDirectory.objects.filter(path=os.path.dirname(c)).count(), 1)
+
+    def test_deferred_after_lock(self):
+        from mediasnakefiles.lockfile import LockFile
+
+        locks = []
+        def hook(changes, mime_cache):
+            def later():
+                locks.append((LockFile.check(scanner.SCAN_LOCKFILE),
+                              LockFile.check(scanner.DEFERRED_LOCKFILE)))
+            return later
+        scanner.SCAN_HOOKS[:] = [hook]
+
+        self.make_file('a', 'one.dat')
+        self.assertTrue(scanner.scan())
+        self.assertEqual(locks, [(False, True)])
+        self.assertFalse(LockFile.check(scanner.DEFERRED_LOCKFILE))
+
+    def test_check_scan_paths(self):
+        self.make_file('a', 'one.dat')
+        self.assertEqual(scanner.check_scan_paths([os.path.join(self.root, 'a', '')]),
+                         [os.path.join(self.root, 'a')])
+        self.assertRaises(ValueError, scanner.check_scan_paths,
+                          [os.path.join(self.root, 'a', '..', '..')])
+        self.assertRaises(ValueError, scanner.check_scan_paths,
+                          [os.path.join(self.root, 'b')])
+
+
+class TestMediaCatalog(ScannerTestCase):
+    def setUp(self):
+        super(TestMediaCatalog, self).setUp()
+        scanner.SCAN_HOOKS[:] = [self._add_first]
+        scanner._SCAN_MODELS[self._add_first] = VideoFile
+
+    def tearDown(self):
+        del scanner._SCAN_MODELS[self._add_first]
+        super(TestMediaCatalog, self).tearDown()
+
+    def _add_first(self, changes, mime_cache):
+        # Take up only the first of the added files
+        self.seen.append(changes)
+        ids = scanner.get_media_ids(changes.added)
+        for filename in sorted(changes.added)[:1]:
+            VideoFile(filename=filename, media_id=ids[filename]).save()
+
+    def test_catalog(self):
+        a = self.make_file('a.avi')
+        b = self.make_file('b.avi')
+
+        self.assertTrue(scanner.scan())
+        self.assertEqual(self.seen[-1].added, set([a, b]))
+        entries = MediaFile.objects.order_by('filename')
+        self.assertEqual([(x.filename, x.kind, x.size) for x in entries],
+                         [(a, 'videofile', 1), (b, 'videofile', 1)])
+        self.assertEqual(VideoFile.objects.get().media, entries[0])
+
+        # Files not taken up are passed again
+        self.assertTrue(scanner.scan(full=True))
+        self.assertEqual(self.seen[-1].added, set([b]))
+        self.assertEqual(VideoFile.objects.count(), 2)
+
+        # Removing the catalog entry removes the video
+        os.unlink(a)
+        self.assertTrue(scanner.scan())
+        self.assertEqual(self.seen[-1].added, set())
+        self.assertEqual(self.seen[-1].removed, set([a]))
+        self.assertEqual(list(MediaFile.objects.values_list('filename', flat=True)), [b])
+        self.assertEqual(list(VideoFile.objects.values_list('filename', flat=True)), [b])
+
+    def test_removed_root(self):
+        a = self.make_file('a', 'x.avi')
+        b = self.make_file('b', 'y.avi')
+        with override_settings(MEDIASNAKEFILES_DIRS=[os.path.join(self.root, 'a'),
+                                                     os.path.join(self.root, 'b')]):
+            self.assertTrue(scanner.scan())
+        self.assertEqual(VideoFile.objects.count(), 1)
+
+        # Files of a root no longer configured are removed
+        with override_settings(MEDIASNAKEFILES_DIRS=[os.path.join(self.root, 'a')]):
+            self.assertTrue(scanner.scan())
+        self.assertEqual(self.seen[-1].removed, set([b]))
+        self.assertEqual(list(MediaFile.objects.values_list('filename', flat=True)), [a])
+        self.assertEqual(list(ScannedDirectory.objects.values_list('path', flat=True)),
+                         [os.path.dirname(a)])
+
+    def test_filename_index(self):
+        # Full scans on SQLite read the catalog in file name order
+        if connection.vendor != 'sqlite':
+            raise SkipTest("SQLite only")
+        table = MediaFile._meta.db_table
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s",
+                       [table])
+        self.assertIn(table + '_filename', [x[0] for x in cursor.fetchall()])
+
+        sql, params = MediaFile.objects.filter(filename__gt=u'a').order_by('filename') \
+                                       .values_list('filename').query.sql_with_params()
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        plan = u' '.join(unicode(x[-1]) for x in cursor.fetchall())
+        self.assertIn(table + '_filename', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_move(self):
+        a = self.make_file('a', 'x.avi')
+        self.assertTrue(scanner.scan())
+        VideoFile.objects.update(thumbnail='abc')
+        video = VideoFile.objects.get()
+
+        # Renamed file keeps its inode
+        b = os.path.join(self.root, 'b', 'y.avi')
+        os.makedirs(os.path.dirname(b))
+        os.rename(a, b)
+        self.bump_mtime('a')
+        self.bump_mtime()
+        self.assertTrue(scanner.scan())
+        self.assertEqual(self.seen[-1].moved, [(a, b)])
+        self.assertEqual(self.seen[-1].added, set())
+        self.assertEqual(self.seen[-1].removed, set())
+        self.assertEqual(list(VideoFile.objects.values_list('pk', 'filename', 'thumbnail',
+                                                            'relative_dirname')),
+                         [(video.pk, b, 'abc', 'b')])
+        self.assertEqual(MediaFile.objects.get().filename, b)
+
+        # Copied file is recognized by content
+        MediaFile.objects.update(content_hash=hash_content(b))
+        c = self.make_file('a', 'z.avi')
+        os.unlink(b)
+        self.bump_mtime('b')
+        self.assertTrue(scanner.scan())
+        self.assertEqual(self.seen[-1].moved, [(b, c)])
+        self.assertEqual(list(VideoFile.objects.values_list('pk', 'filename')),
+                         [(video.pk, c)])
+
+        # Different content is not a move
+        MediaFile.objects.update(content_hash='0' * 40)
+        d = self.make_file('b', 'w.avi')
+        os.unlink(c)
+        self.bump_mtime('a')
+        self.assertTrue(scanner.scan())
+        self.assertEqual(self.seen[-1].moved, [])
+        self.assertEqual(self.seen[-1].added, set([d]))
+        self.assertEqual(list(VideoFile.objects.values_list('filename', flat=True)), [d])
+
+
+class TestVideoFields(TestCase):
+    def test_sort_key(self):
+        root = os.path.normpath(settings.MEDIASNAKEFILES_DIRS[0])
+        names = [u'Show 2.avi', u'Show 10.avi', u'Show 1 [x].mkv', u'Show 1.avi', u'b/a.avi',
+                 u'a/Show 02.avi', u'a/Show 2.avi', u'a b/x.avi', u'a/b/c.avi', u'Other.avi']
+        videos = [VideoFile(**VideoFile.fields_for_filename(os.path.join(root, x)))
+                  for x in names]
+
+        def tuple_key(video_file):
+            title = video_file.title
+            numbers = tuple(int(x) for x in re.sub(r'[^0-9 \t]', '', title).split())
+            return (video_file.relative_dirname.split(os.path.sep), numbers, title,
+                    video_file.basename)
+
+        self.assertEqual([x.filename for x in sorted(videos, key=lambda x: x.sort_key)],
+                         [x.filename for x in sorted(videos, key=tuple_key)])
+
+        # Not cut short in long directory names
+        dirname = os.path.join(root, u'x' * 200, u'y' * 200)
+        videos = [VideoFile(**VideoFile.fields_for_filename(os.path.join(dirname, x)))
+                  for x in [u'Show 10.avi', u'Show 2.avi']]
+        self.assertEqual([x.basename for x in sorted(videos, key=lambda x: x.sort_key)],
+                         [u'Show 2.avi', u'Show 10.avi'])
+
+        video = VideoFile(**VideoFile.fields_for_filename(os.path.join(root, names[2])))
+        self.assertEqual((video.root, video.relative_dirname, video.title, video.group_base),
+                         (0, u'.', u'Show 1', u'Show 1 [x]'))
+
+    def test_versions(self):
+        root = os.path.normpath(settings.MEDIASNAKEFILES_DIRS[0])
+        for name in [u'Show 1.avi', u'Show 1.mkv', u'Show 1.720p.mkv', u'a/Show 1.avi']:
+            VideoFile.objects.create(thumbnail='',
+                                     **VideoFile.fields_for_filename(os.path.join(root, name)))
+
+        video = VideoFile.objects.get(filename=os.path.join(root, u'Show 1.mkv'))
+        self.assertEqual([x.basename for x in video.get_all_versions()],
+                         [u'Show 1.avi', u'Show 1.mkv'])
+
+    def test_folders(self):
+        root = os.path.normpath(settings.MEDIASNAKEFILES_DIRS[0])
+        for name in [u'x.avi', u'a/b/Show 1.avi', u'a/b/Show 1.mkv', u'a/b/Show 2.avi',
+                     u'a/c/y.avi']:
+            VideoFile.objects.create(thumbnail='',
+                                     **VideoFile.fields_for_filename(os.path.join(root, name)))
+        update_video_folders()
+        self.assertEqual(sorted((x.path, x.video_count) for x in VideoFolder.objects.all()),
+                         [(u'.', 5), (u'a', 4), (u'a/b', 3), (u'a/c', 1)])
+
+        VideoFile.objects.filter(relative_dirname=u'a/c').delete()
+        update_video_folders()
+        self.assertEqual(sorted((x.path, x.video_count) for x in VideoFolder.objects.all()),
+                         [(u'.', 4), (u'a', 3), (u'a/b', 3)])
+
+        User.objects.create_user('user', password='pass')
+        client = Client()
+        client.login(username='user', password='pass')
+
+        data = json.loads(client.get(reverse('folder', args=[''])).content)
+        self.assertEqual(data['folders'], [dict(path=u'a', name=u'a', videos=3)])
+        self.assertEqual([x['title'] for x in data['groups']], [u'X'])
+
+        data = json.loads(client.get(reverse('folder', args=[u'a/b'])).content)
+        self.assertEqual(data['folders'], [])
+        self.assertEqual([(x['title'], x['files']) for x in data['groups']],
+                         [(u'Show 1', [u'a/b / Show 1.avi', u'a/b / Show 1.mkv']),
+                          (u'Show 2', [u'a/b / Show 2.avi'])])
+
+        self.assertEqual(client.get(reverse('folder', args=[u'a/c'])).status_code, 404)
+
+    def test_folder_versions(self):
+        root = os.path.normpath(settings.MEDIASNAKEFILES_DIRS[0])
+
+        def add(name):
+            fields = VideoFile.fields_for_filename(os.path.join(root, name))
+            VideoFile.objects.create(thumbnail='', **fields)
+            folder_changed(fields['folder_key'])
+
+        def versions():
+            return dict(VideoFolder.objects.values_list('path', 'version'))
+
+        for name in [u'x.avi', u'a/b/Show 1.avi', u'a/c/y.avi', u'd/z.avi']:
+            add(name)
+        update_video_folders()
+        old = versions()
+
+        # Only the folder changed and the ones showing its count change
+        add(u'a/b/Show 2.avi')
+        update_video_folders()
+        new = versions()
+        self.assertEqual(sorted(x for x in new if new[x] != old[x]), [u'.', u'a', u'a/b'])
+
+        update_video_folders()
+        self.assertEqual(versions(), new)
+
+
+class TestProbe(TestCase):
+    def test_parse(self):
+        data = {
+            'format': {'duration': '3725.5', 'bit_rate': '2500000'},
+            'streams': [
+                {'index': 0, 'codec_type': 'video', 'codec_name': 'mjpeg',
+                 'width': 100, 'height': 100, 'disposition': {'attached_pic': 1}},
+                {'index': 1, 'codec_type': 'video', 'codec_name': 'h264',
+                 'width': 1280, 'height': 720},
+                {'index': 2, 'codec_type': 'audio', 'codec_name': 'aac',
+                 'tags': {'language': 'jpn'}},
+                {'index': 3, 'codec_type': 'audio', 'codec_name': 'aac',
+                 'tags': {'LANGUAGE': 'eng'}},
+                {'index': 4, 'codec_type': 'subtitle', 'codec_name': 'ass',
+                 'tags': {'language': 'und'}},
+            ],
+        }
+        fields = parse_probe(data)
+        self.assertEqual(fields, dict(duration=3725.5, bitrate=2500, video_codec='h264',
+                                      width=1280, height=720, audio_codecs=u'aac',
+                                      audio_languages=u'jpn,eng', subtitle_languages=u''))
+
+        video = VideoFile(**fields)
+        self.assertEqual(video.duration_text, u'1:02:06')
+        self.assertTrue(video.html5_playable)
+
+        # Bitrate estimated from the size
+        fields = parse_probe({'format': {'duration': '10'}, 'streams': []}, size=125000)
+        self.assertEqual(fields['bitrate'], 100)
+        self.assertEqual(VideoFile(**fields).html5_playable, None)
+
+    def test_failures_recorded(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ffprobe = os.path.join(tmpdir, 'ffprobe')
+            with open(ffprobe, 'w') as f:
+                f.write('#!/bin/sh\nexec sleep 10\n')
+            os.chmod(ffprobe, 0o755)
+
+            video = VideoFile.objects.create(filename=os.path.join(tmpdir, 'video.avi'))
+            with override_settings(MEDIASNAKEFILES_FFPROBE=ffprobe,
+                                   MEDIASNAKEFILES_PROBE_TIMEOUT=0.2):
+                probe_videos(VideoFile.objects.all())
+            video = VideoFile.objects.get(pk=video.pk)
+            self.assertFalse(video.probed)
+            self.assertEqual(video.probe_failures, 1)
+            self.assertTrue(video.probe_retry > django.utils.timezone.now())
+
+            # Not attempted without ffprobe
+            with override_settings(MEDIASNAKEFILES_FFPROBE=os.path.join(tmpdir, 'missing')):
+                probe_videos(VideoFile.objects.all())
+            self.assertEqual(VideoFile.objects.get(pk=video.pk).probe_failures, 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_best_versions_first(self):
+        a = VideoFile(filename=u'a.avi', video_codec='mpeg4', audio_codecs='mp3', bitrate=5000)
+        b = VideoFile(filename=u'b.mp4', video_codec='h264', audio_codecs='aac', bitrate=1000)
+        c = VideoFile(filename=u'c.webm', video_codec='vp9', audio_codecs='opus', bitrate=3000)
+        d = VideoFile(filename=u'd.mkv')
+        self.assertEqual([x.filename for x in views._best_versions_first([a, b, c, d], '')],
+                         [u'c.webm', u'b.mp4', u'd.mkv', u'a.avi'])
+        self.assertEqual([x.filename for x in views._best_versions_first([a, b, c, d],
+                                                                         'Android Mobile')],
+                         [u'b.mp4', u'c.webm', u'd.mkv', u'a.avi'])
+
+
+class TestStoryboard(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+        # Stand-in for ffmpeg, writing the output file
+        self.ffmpeg = os.path.join(self.tmpdir, 'ffmpeg')
+        with open(self.ffmpeg, 'w') as f:
+            f.write('#!/bin/sh\nfor x; do :; done; echo jpeg > "$x"\n')
+        os.chmod(self.ffmpeg, 0o755)
+
+        self.video = os.path.join(self.tmpdir, 'video.avi')
+        with open(self.video, 'wb') as f:
+            f.write(b'x' * 1000)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_make(self):
+        root = os.path.join(self.tmpdir, 'sendfile')
+        with override_settings(MEDIASNAKEFILES_FFMPEG=self.ffmpeg, SENDFILE_ROOT=root,
+                               MEDIASNAKEFILES_STORYBOARD_FRAMES=3,
+                               MEDIASNAKEFILES_STORYBOARD_COLUMNS=2,
+                               MEDIASNAKEFILES_STORYBOARD_WIDTH=160):
+            storyboard, ok = make_storyboard(self.video, 30, width=640, height=360)
+            self.assertTrue(ok)
+            self.assertEqual(storyboard, hash_content(self.video))
+
+            video = VideoFile(storyboard=storyboard)
+            sprite, track = video.storyboard_filenames
+            self.assertTrue(os.path.isfile(sprite))
+            with open(track, 'rb') as f:
+                cues = f.read().decode('utf-8')
+
+        self.assertEqual(cues.split(u"\n\n"), [
+            u"WEBVTT",
+            u"00:00:00.000 --> 00:00:10.000\n%s.jpg#xywh=0,0,160,90" % storyboard,
+            u"00:00:10.000 --> 00:00:20.000\n%s.jpg#xywh=160,0,160,90" % storyboard,
+            u"00:00:20.000 --> 00:00:30.000\n%s.jpg#xywh=0,90,160,90\n" % storyboard,
+        ])
+
+    def test_failures_recorded(self):
+        with open(self.ffmpeg, 'w') as f:
+            f.write('#!/bin/sh\nexit 1\n')
+
+        root = os.path.join(self.tmpdir, 'sendfile')
+        video = VideoFile.objects.create(filename=self.video, duration=30)
+        with override_settings(MEDIASNAKEFILES_FFMPEG=self.ffmpeg, SENDFILE_ROOT=root,
+                               MEDIASNAKEFILES_STORYBOARD_FRAMES=3):
+            create_storyboards(VideoFile.objects.all())
+        video = VideoFile.objects.get(pk=video.pk)
+        self.assertEqual(video.storyboard, u'')
+        self.assertEqual(video.storyboard_failures, 1)
+        self.assertTrue(video.storyboard_retry > django.utils.timezone.now())
+
+
+    def test_folder_atlas(self):
+        root = os.path.join(self.tmpdir, 'sendfile')
+        os.makedirs(root)
+        with override_settings(MEDIASNAKEFILES_FFMPEG=self.ffmpeg, SENDFILE_ROOT=root,
+                               MEDIASNAKEFILES_ATLAS_COLUMNS=2, MEDIASNAKEFILES_ATLAS_ROWS=1):
+            videos_root = os.path.normpath(settings.MEDIASNAKEFILES_DIRS[0])
+            for name, thumbnail in [(u'a/1.avi', 'aa'), (u'a/1.mkv', 'bb'), (u'a/2.avi', 'cc'),
+                                    (u'a/3.avi', ''), (u'a/4.avi', 'dd')]:
+                VideoFile.objects.create(thumbnail=thumbnail, **VideoFile.fields_for_filename(
+                    os.path.join(videos_root, name)))
+                if thumbnail:
+                    with open(get_thumbnail_filename(thumbnail), 'wb') as f:
+                        f.write(b'jpeg')
+            update_video_folders()
+
+            create_folder_atlases(VideoFolder.objects.all())
+            folder = VideoFolder.objects.get(path=u'a')
+            self.assertEqual(folder.atlas_version, folder.version)
+            self.assertEqual(folder.get_atlas(), {u'aa': [0, 0, 0], u'cc': [0, 190, 0],
+                                                  u'dd': [1, 0, 0]})
+            old = get_atlas_filename(folder.path_key, folder.version, 1)
+            self.assertTrue(os.path.isfile(old))
+
+            User.objects.create_user('user', password='pass')
+            client = Client()
+            client.login(username='user', password='pass')
+            data = json.loads(client.get(reverse('folder', args=[u'a'])).content)
+            self.assertEqual([x['atlas'] and x['atlas']['url'] for x in data['groups']],
+                             ['/atlas/%s-%s-0.jpg' % (folder.path_key, folder.version),
+                              '/atlas/%s-%s-0.jpg' % (folder.path_key, folder.version),
+                              None,
+                              '/atlas/%s-%s-1.jpg' % (folder.path_key, folder.version)])
+
+            # Rebuilt for a new version, and old atlases are removed
+            folder_changed(folder.path_key)
+            update_video_folders()
+            create_folder_atlases(VideoFolder.objects.all())
+            folder = VideoFolder.objects.get(path=u'a')
+            self.assertEqual(folder.atlas_version, folder.version)
+            self.assertFalse(os.path.isfile(old))
+            self.assertTrue(os.path.isfile(get_atlas_filename(folder.path_key,
+                                                              folder.version, 1)))
+
+
+    def test_folder_atlas_ffmpeg(self):
+        # Thumbnails of different sizes end up in one atlas
+        ffmpeg = find_program('ffmpeg')
+        if ffmpeg is None:
+            raise SkipTest("ffmpeg not installed")
+
+        root = os.path.join(self.tmpdir, 'sendfile')
+        os.makedirs(root)
+        with override_settings(MEDIASNAKEFILES_FFMPEG=ffmpeg, SENDFILE_ROOT=root,
+                               MEDIASNAKEFILES_ATLAS_COLUMNS=2, MEDIASNAKEFILES_ATLAS_ROWS=1):
+            for thumbnail, size in [('aa', '320x180'), ('bb', '128x128')]:
+                subprocess.check_call([ffmpeg, '-v', 'error', '-f', 'lavfi',
+                                       '-i', 'color=red:size=%s' % size, '-frames:v', '1',
+                                       get_thumbnail_filename(thumbnail)])
+            cells = make_folder_atlas('key', 'version', ['aa', 'bb'])
+            self.assertEqual(cells, {'aa': [0, 0, 0], 'bb': [0, 190, 0]})
+            self.assertEqual(_jpeg_size(get_atlas_filename('key', 'version', 0)), (380, 110))
+
+
+def _jpeg_size(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    pos = 2
+    while pos < len(data):
+        marker, length = struct.unpack('>xBH', data[pos:pos + 4])
+        if 0xc0 <= marker <= 0xc2:
+            height, width = struct.unpack('>HH', data[pos + 5:pos + 9])
+            return width, height
+        pos += 2 + length
+    return None
+
+
+class TestFileClassifier(TestCase):
+    def test_match(self):
+        classifier = scanner.FileClassifier([('*.gz', 'gz'),
+                                             ('*.tar.gz', 'tar'),
+                                             ('*.avi', 'avi'),
+                                             ('video?.*', 'video')])
+        self.assertEqual(classifier.match(u'foo.tar.gz'), ['gz', 'tar'])
+        self.assertEqual(classifier.match(u'foo.gz'), ['gz'])
+        self.assertEqual(classifier.match(u'foo.AVI'), [])
+        self.assertEqual(classifier.match(u'video1.avi'), ['avi', 'video'])
+        self.assertEqual(classifier.match(u'foo.avi.txt'), [])
+
+    def test_dispatch(self):
+        a, b, c = object(), object(), object()
+        scanner._SCAN_PATTERNS[a] = ('*.epub',)
+        scanner._SCAN_PATTERNS[b] = ('*.avi', '*.epub')
+        try:
+            dispatcher = scanner.ScanDispatcher([a, b, c])
+            for filename in [u'/x/1.epub', u'/x/2.avi', u'/x/3.txt']:
+                dispatcher.add_file(filename, os.path.basename(filename))
+        finally:
+            del scanner._SCAN_PATTERNS[a]
+            del scanner._SCAN_PATTERNS[b]
+
+        self.assertEqual([x.files for x in dispatcher.changes],
+                         [set([u'/x/1.epub']),
+                          set([u'/x/1.epub', u'/x/2.avi']),
+                          set([u'/x/1.epub', u'/x/2.avi', u'/x/3.txt'])])
+
+
+class TestPathSet(TestCase):
+    def test_operations(self):
+        a = PathSet([u'/x/b.avi', u'/x/a.avi', u'/x/y/\xe4.avi', u'/z.avi'])
+        a.add(u'/x/a.avi')
+        self.assertEqual(len(a), 4)
+        self.assertEqual(list(a), [u'/x/a.avi', u'/x/b.avi', u'/x/y/\xe4.avi', u'/z.avi'])
+        self.assertTrue(u'/x/y/\xe4.avi' in a)
+        self.assertFalse(u'/x/c.avi' in a)
+        self.assertFalse(u'/y/a.avi' in a)
+
+        b = PathSet()
+        b.add_names(u'/x', [u'a.avi', u'c.avi'])
+        self.assertEqual(a.difference(b), set([u'/x/b.avi', u'/x/y/\xe4.avi', u'/z.avi']))
+        self.assertEqual(b.difference(a), set([u'/x/c.avi']))
+        self.assertEqual(a.difference(set([u'/z.avi'])), a - set([u'/z.avi']))
+        self.assertEqual(sorted(b.difference(a).dirs()), [u'/x'])
+
+        b.update(a)
+        self.assertEqual(b, set(a) | set([u'/x/c.avi']))
+
+
+    def test_sorted(self):
+        paths = [u'/x/a', u'/x/a.b', u'/x/a/b', u'/x/a0', u'/x/\xe4', u'/x/\xe4/a', u'/y']
+        self.assertEqual(list(PathSet(reversed(paths))), sorted(paths))
+
+
+class TestDiff(ScannerTestCase):
+    def test_merge_diff(self):
+        self.assertEqual(list(scanner.merge_diff([u'a', u'c', u'd'], [u'b', u'b', u'c', u'e'])),
+                         [(u'a', True), (u'b', False), (u'd', True), (u'e', False)])
+        self.assertEqual(list(scanner.merge_diff([], [u'a'])), [(u'a', False)])
+        self.assertRaises(ValueError, list, scanner.merge_diff([u'a'], [u'b', u'a']))
+
+    def test_diff(self):
+        for name in [u'/x/a.avi', u'/x/b.avi', u'/x/c/d.avi', u'/y/e.avi']:
+            VideoFile(filename=name).save()
+
+        for full in (True, False):
+            changes = scanner.ScanChanges(full=full)
+            changes.files.update([u'/x/b.avi', u'/x/c.avi', u'/x/c/d.avi', u'/x/\xe4.avi'])
+            changes.dirs.update([u'/x', u'/x/c'])
+            self.assertEqual(sorted(changes.diff(VideoFile.objects)),
+                             [(u'/x/a.avi', False), (u'/x/c.avi', True), (u'/x/\xe4.avi', True)]
+                             + ([(u'/y/e.avi', False)] if full else []))
+
+
+class TestChunkedQueries(ScannerTestCase):
+    def test_iter_values(self):
+        for j in range(5):
+            VideoFile(filename=u'/x/%d.avi' % j).save()
+        VideoFile.objects.filter(filename=u'/x/1.avi').delete()
+
+        self.assertEqual(list(scanner.iter_values(VideoFile.objects.all(), 'filename',
+                                                  chunk_size=2)),
+                         [u'/x/0.avi', u'/x/2.avi', u'/x/3.avi', u'/x/4.avi'])
+        self.assertEqual(list(scanner.iter_sorted_values(VideoFile.objects.all(), 'filename',
+                                                         chunk_size=2)),
+                         [u'/x/0.avi', u'/x/2.avi', u'/x/3.avi', u'/x/4.avi'])
+        self.assertEqual([x.filename for x in scanner.iter_chunked(VideoFile.objects.all(),
+                                                                   chunk_size=3)],
+                         [u'/x/0.avi', u'/x/2.avi', u'/x/3.avi', u'/x/4.avi'])
+
+
+class TestBulkWriter(ScannerTestCase):
+    def test_add_remove(self):
+        with override_settings(SENDFILE_ROOT=self.root):
+            writer = scanner.BulkWriter(VideoFile, batch_size=2)
+            for j in range(3):
+                writer.add(VideoFile(filename=u'/x/%d.avi' % j, thumbnail='%040x' % j))
+            self.assertEqual(VideoFile.objects.count(), 2)
+            writer.flush()
+            self.assertEqual(VideoFile.objects.count(), 3)
+
+            thumbnail = get_thumbnail_filename('%040x' % 1)
+            with open(thumbnail, 'wb') as f:
+                f.write(b'x')
+
+            writer.remove(u'/x/0.avi')
+            writer.remove(u'/x/1.avi')
+            self.assertEqual(list(VideoFile.objects.values_list('filename', flat=True)),
+                             [u'/x/2.avi'])
+            self.assertFalse(os.path.exists(thumbnail))
+
+
+class TestThumbnails(ScannerTestCase):
+    def make_thumbnailer(self, command):
+        thumbnailer = os.path.join(self.root, 'thumbnailer.sh')
+        with open(thumbnailer, 'wb') as f:
+            f.write(b'#!/bin/sh\n' + command + b'\n')
+        os.chmod(thumbnailer, 0o755)
+        return thumbnailer
+
+    def make_videos(self, count):
+        video_files = []
+        for j in range(count):
+            filename = os.path.join(self.root, 'video%d.avi' % j)
+            with open(filename, 'wb') as f:
+                f.write(os.urandom(200000))
+            video_file = VideoFile(filename=filename, mimetype='video/avi')
+            video_file.save()
+            video_files.append(video_file)
+        return video_files
+
+    def test_create_thumbnails(self):
+        # Writes the argument of -o to the output file
+        thumbnailer = self.make_thumbnailer(b'out=${4#-o}; echo jpeg > "$out"')
+        sendfile_root = os.path.join(self.root, 'streaming')
+
+        with override_settings(SENDFILE_ROOT=sendfile_root,
+                               MEDIASNAKEFILES_FFMPEGTHUMBNAILER=thumbnailer,
+                               MEDIASNAKEFILES_THUMBNAIL_WORKERS=3):
+            self.make_videos(5)
+            create_thumbnails(VideoFile.objects.all())
+
+            for video_file in VideoFile.objects.all():
+                self.assertTrue(video_file.thumbnail)
+                self.assertTrue(os.path.isfile(video_file.thumbnail_filename))
+
+    def test_timeout(self):
+        thumbnailer = self.make_thumbnailer(b'exec sleep 10')
+        sendfile_root = os.path.join(self.root, 'streaming')
+
+        with override_settings(SENDFILE_ROOT=sendfile_root,
+                               MEDIASNAKEFILES_FFMPEGTHUMBNAILER=thumbnailer,
+                               MEDIASNAKEFILES_THUMBNAIL_TIMEOUT=0.2):
+            self.make_videos(1)
+            create_thumbnails(VideoFile.objects.all())
+            self.assertEqual(os.listdir(sendfile_root), [])
+
+
+class TestScanQueue(ScannerTestCase):
+    def test_coalesce(self):
+        a = os.path.join(self.root, 'a')
+        b = os.path.join(self.root, 'b')
+        r1 = scanqueue.request_scan([a], start_worker=False)
+        r2 = scanqueue.request_scan([a], start_worker=False)
+        r3 = scanqueue.request_scan([b, a], full=True, start_worker=False)
+        self.assertEqual(r1.pk, r2.pk)
+        self.assertEqual(ScanRequest.objects.count(), 2)
+        self.assertEqual(scanqueue.merge_requests([r1, r3]), (True, [a, b]))
+
+        r4 = scanqueue.request_scan(start_worker=False)
+        self.assertEqual(scanqueue.merge_requests([r1, r4]), (False, None))
+
+    def test_process(self):
+        a = self.make_file('a', 'one.dat')
+        b = self.make_file('b', 'two.dat')
+        scanqueue.request_scan([os.path.dirname(a)], start_worker=False)
+        scanqueue.request_scan([os.path.dirname(b)], start_worker=False)
+
+        self.assertTrue(scanqueue.process_requests())
+        self.assertEqual(len(self.seen), 1)
+        self.assertEqual(self.seen[-1].files, set([a, b]))
+        self.assertFalse(scanqueue.scan_pending())
+        self.assertFalse(scanqueue.process_requests())
+
+    def test_failed(self):
+        def fail(changes, mime_cache):
+            raise ValueError("broken")
+        scanner.SCAN_HOOKS[:] = [fail]
+
+        self.make_file('a', 'one.dat')
+        scanqueue.request_scan(start_worker=False)
+        self.assertTrue(scanqueue.process_requests())
+        self.assertFalse(scanqueue.scan_pending())
+        self.assertEqual(scanqueue.scan_error(), u"ValueError: broken")
+        self.assertFalse(scanqueue.process_requests())
+
+        # Cleared by the next request
+        scanner.SCAN_HOOKS[:] = [self._record]
+        scanqueue.request_scan(start_worker=False)
+        self.assertEqual(scanqueue.scan_error(), None)
+        self.assertTrue(scanqueue.run_worker(0, exit_idle=0))
+        self.assertEqual(len(self.seen), 1)
+        self.assertFalse(scanqueue.scan_pending())
+
+
+class TestGeneration(ScannerTestCase):
+    def test_publish(self):
+        generation = get_generation()
+        self.make_file('a', 'one.avi')
+        self.assertTrue(scanner.scan())
+        self.assertEqual(get_generation(), generation + 1)
+
+        # Only scans changing the library publish a generation
+        self.assertTrue(scanner.scan(full=True))
+        self.assertEqual(get_generation(), generation + 1)
+
+    def test_media_version(self):
+        self.assertEqual(media_version(VideoFile, 1), None)
+        a = self.make_file('a.avi')
+        video = VideoFile.objects.create(filename=a)
+        old = media_version(VideoFile, video.pk)
+        self.assertEqual(old, media_version(VideoFile, video.pk))
+
+        media = MediaFile.objects.create(path_hash='x', dir_hash='y', filename=a,
+                                         size=1, mtime=0, inode=0, scan=3)
+        VideoFile.objects.filter(pk=video.pk).update(media=media)
+        new = media_version(VideoFile, video.pk)
+        self.assertNotEqual(new, old)
+
+        # Modified in place
+        with open(a, 'ab') as f:
+            f.write(b'y')
+        self.assertNotEqual(media_version(VideoFile, video.pk), new)
+
+        os.unlink(a)
+        self.assertEqual(media_version(VideoFile, video.pk), None)
+
+
+class TestGovernor(DataDirTestCase):
+    def test_token_bucket(self):
+        now = [0.0]
+        def sleep(t):
+            now[0] += t
+        bucket = TokenBucket(100, clock=lambda: now[0], sleep=sleep)
+
+        # Full burst is available at once, then limited to the rate
+        bucket.consume(100)
+        self.assertEqual(now[0], 0)
+        bucket.consume(50)
+        self.assertAlmostEqual(now[0], 0.5)
+        bucket.consume(50)
+        self.assertAlmostEqual(now[0], 1.0)
+
+        # Lower rate also limits the burst
+        now[0] += 100
+        bucket.consume(20, rate=10)
+        self.assertAlmostEqual(now[0], 102.0)
+
+    def test_streaming(self):
+        governor = ResourceGovernor(read_rate=None, streaming_read_rate=1000, stream_idle=60)
+        self.assertFalse(governor.streaming())
+        governor_module.note_streaming()
+        governor._streaming = (0, False)
+        self.assertTrue(governor.streaming())
+        self.assertTrue(governor_module.STREAM_ACTIVITY.startswith(self.data_dir))
+
+
+class TestScanProgress(ScannerTestCase):
+    def read_status(self):
+        with open(scanner.SCAN_STATUS, 'rb') as f:
+            return json.load(f)
+
+    def test_progress(self):
+        progress = scanner.ScanProgress(interval=1000)
+        try:
+            progress.start_phase('Walking', total=None)
+            progress.start_phase('Adding', total=10)
+            status = self.read_status()
+            self.assertEqual(status['sequence'], 2)
+
+            # Updates are throttled
+            for j in range(4):
+                progress.step()
+            self.assertEqual(self.read_status()['sequence'], 2)
+
+            progress.flush()
+            status = self.read_status()
+            self.assertEqual(status['sequence'], 3)
+            self.assertEqual([x['name'] for x in status['phases']], ['Walking', 'Adding'])
+            self.assertTrue(status['phases'][0]['complete'])
+            adding = status['phases'][1]
+            self.assertFalse(adding['complete'])
+            self.assertEqual((adding['done'], adding['total']), (4, 10))
+            self.assertTrue(adding['eta'] >= 0)
+        finally:
+            scanner.set_scan_status(None)
+
+    def test_profile(self):
+        self.make_file('a', 'one.dat')
+        self.assertTrue(scanner.scan(full=True))
+
+        run = ScanRun.objects.get()
+        self.assertTrue(run.full)
+        self.assertTrue(run.success)
+
+        profile = run.get_profile()
+        walk = profile['phases'][0]
+        self.assertEqual(walk['name'], 'Scanning directories')
+        self.assertEqual(walk['count'], 2)
+        self.assertEqual(len(walk['slowest']), 2)
+        self.assertEqual([x['name'] for x in profile['hooks']],
+                         ['mediasnakefiles.tests._record'])
+        self.assertTrue('Scanning directories' in run.format_report())
+
+
+class TestWalker(ScannerTestCase):
+    def test_deterministic(self):
+        for j in range(5):
+            for k in range(5):
+                self.make_file('d%d' % j, 'e%d' % k, 'file.dat')
+
+        def visit(path):
+            subdirs, files = list_directory(path)
+            return files, [os.path.join(path, x) for x in subdirs]
+
+        expected = walk_parallel([self.root], visit, 1)
+        self.assertEqual(len(expected), 1 + 5 + 25)
+        self.assertEqual(expected[1], (os.path.join(self.root, 'd0'), []))
+        self.assertEqual(expected[2], (os.path.join(self.root, 'd0', 'e0'), ['file.dat']))
+
+        for threads in (2, 8):
+            self.assertEqual(walk_parallel([self.root], visit, threads), expected)
+
+
+class TestWatcher(ScannerTestCase):
+    def test_inotify(self):
+        try:
+            watcher = InotifyWatcher([self.root])
+        except WatcherError:
+            raise SkipTest("inotify not available")
+
+        try:
+            a = self.make_file('a', 'one.dat')
+            changed = set()
+            for j in range(10):
+                changed.update(watcher.wait(0.1))
+            self.assertEqual(changed, set([self.root, os.path.dirname(a)]))
+
+            # New directories are watched
+            b = self.make_file('a', 'two.dat')
+            self.assertEqual(watcher.wait(1), set([os.path.dirname(b)]))
+        finally:
+            watcher.close()
+
+
+class TestMimeCache(ScannerTestCase):
+    def test_persistent(self):
+        a = self.make_file('one.txt')
+        b = self.make_file('two.txt')
+
+        calls = []
+        get_mime_types = scanner.get_mime_types
+        def counting_get_mime_types(filenames):
+            calls.append(list(filenames))
+            return get_mime_types(filenames)
+
+        scanner.get_mime_types = counting_get_mime_types
+        try:
+            cache = scanner.MimeCache()
+            cache.prefetch([a, b])
+            mimetype = cache.get(a)
+            self.assertTrue(mimetype)
+            self.assertEqual(calls, [sorted([a, b])])
+
+            # Unchanged files are not sniffed again
+            cache = scanner.MimeCache()
+            self.assertEqual(cache.get(b), mimetype)
+            self.assertEqual(len(calls), 1)
+
+            # Modified files are
+            with open(b, 'wb') as f:
+                f.write(b'')
+            os.utime(b, (0, 0))
+            cache = scanner.MimeCache()
+            cache.prefetch([a, b])
+            self.assertEqual(calls[-1], [b])
+            self.assertEqual(len(calls), 2)
+        finally:
+            scanner.get_mime_types = get_mime_types
@@ -4,7 +4,11 @@ from . import views
 
 urlpatterns = patterns('',
     url(r'^$', views.index, name='index'),
+    url(r'^folder/(?P<path>.*)$', views.folder, name='folder'),
     url(r'^thumbnail/(?P<thumbnail>[a-f0-9]+)/$', views.thumbnail, name='thumbnail'),
+    url(r'^atlas/(?P<name>[a-f0-9]+-[a-f0-9]+-\d+)\.jpg$', views.atlas, name='atlas'),
+    url(r'^storyboard/(?P<storyboard>[a-f0-9]+)\.(?P<ext>jpg|vtt)$', views.storyboard,
+        name='storyboard'),
     url(r'^stream/(?P<id>\d+)/$', views.stream, name='stream'),
     url(r'^ticket/(?P<secret>[a-z0-9.]+)/.*$', views.ticket_stream, name='ticket'),
     url(r'^rescan/$', views.rescan, name='rescan'),
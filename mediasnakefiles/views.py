@@ -1,72 +1,103 @@
 import os
 import re
-import time
+import json
 
 from django.conf import settings
-from django.http import HttpResponse, Http404, HttpResponseForbidden, StreamingHttpResponse
+from django.http import (HttpResponse, Http404, HttpResponseForbidden, HttpResponseBadRequest,
+                         StreamingHttpResponse)
 from django.core.cache import cache
 from django.views.decorators.cache import cache_page
 from django.views.decorators.cache import cache_control
 from django.shortcuts import render, redirect
+from django.core.urlresolvers import reverse
 from django.contrib.auth.decorators import login_required
 
 from mediasnake_sendfile import sendfile
 
-from mediasnakefiles.models import VideoFile, StreamingTicket, get_thumbnail_filename
-from mediasnakefiles.scanner import get_scan_status, spawn_rescan
-
-
-def _sort_key(video_file):
-    dirname = video_file.relative_dirname
-    basename = video_file.basename
-    title = video_file.title
-    numbers = tuple(int(x) for x in re.sub(r'[^0-9 \t]', '', title).split())
-    return (dirname.split(os.path.sep), numbers, title, basename)
-
-
-class Folder(object):
-    def __init__(self, name, groups):
-        self.groups = groups
-        self.name = name
-
-
-class VideoGroup(object):
-    def __init__(self, base_file, video_files):
-        self.video_files = video_files
-        self.base_file = base_file
+from mediasnakefiles.models import (VideoFile, VideoFolder, StreamingTicket,
+                                    get_thumbnail_filename, get_storyboard_filename,
+                                    get_atlas_filename, sort_video_files)
+from mediasnakefiles.scanner import (get_scan_status, wait_scan_status, check_scan_paths,
+                                     path_hash)
+from mediasnakefiles.scanqueue import request_scan, scan_pending, scan_error
+from mediasnakefiles.generation import cache_page_versioned
+from mediasnakefiles.governor import note_streaming
 
 
 @login_required
-@cache_page(30*24*60*60)
 def index(request):
-    # Note: the cache will be invalidated by rescanning, so we can use
-    # a long caching time
+    # The folders are loaded by Javascript from the folder view one
+    # level at a time, so the page does not depend on the library size
+    context = {}
+    return render(request, "mediasnakefiles/index.html", context)
 
-    video_files = VideoFile.objects.all()
-    folders = []
 
-    if video_files:
-        folder = None
-        group = None
-        last_base = None
-        for video_file in sorted(video_files, key=_sort_key):
-            if folder is None or video_file.relative_dirname != folder.name:
-                folder = Folder(video_file.relative_dirname, [])
-                last_base = None
-                folders.append(folder)
+def _folder_version(path, *args, **kwargs):
+    # Each folder has its own version, so that a scan changing one
+    # folder does not invalidate the cached listings of the others
+    key = path_hash(path or u'.')
+    versions = list(VideoFolder.objects.filter(path_key=key)
+                                       .values_list('version', 'atlas_version')[:1])
+    if not versions:
+        return None
+    return "video-folder-%s-%s-%s" % (key, versions[0][0], versions[0][1])
 
-            base, ext = os.path.splitext(
-                os.path.join(video_file.relative_dirname, video_file.basename))
 
-            if group is None or base != last_base:
-                group = VideoGroup(video_file, [])
-                last_base = base
-                folder.groups.append(group)
-
-            group.video_files.append(video_file)
+@login_required
+@cache_page_versioned(30*24*60*60, _folder_version)
+def folder(request, path):
+    """
+    JSON listing of a folder of the video index: its subfolders with
+    video counts, and the groups of video versions in it.
+    """
+    # Note: changes to the folder change the cache version, so we can
+    # use a long caching time
+
+    path = path or u'.'
+    key = path_hash(path)
+    try:
+        folder = VideoFolder.objects.get(path_key=key)
+    except VideoFolder.DoesNotExist:
+        if path != u'.':
+            raise Http404
+        folder = None
 
-    context = {'folders': folders}
-    return render(request, "mediasnakefiles/index.html", context)
+    # Thumbnails are shown from the atlas images of the folder
+    atlas = folder.get_atlas() if folder is not None else None
+    atlas = atlas or {}
+
+    folders = [dict(path=x.path, name=x.name, videos=x.video_count)
+               for x in sorted(VideoFolder.objects.filter(parent_key=key),
+                               key=lambda x: x.name)]
+
+    groups = []
+    group = None
+    video_files = sort_video_files(
+        VideoFile.objects.filter(folder_key=key)
+                         .only('filename', 'thumbnail', 'relative_dirname', 'title', 'group_key',
+                               'duration', 'sort_key'))
+    for video_file in video_files:
+        if group is None or video_file.group_key != group_key:
+            group_key = video_file.group_key
+            group = dict(id=video_file.id,
+                         title=video_file.title,
+                         duration=video_file.duration_text,
+                         thumbnail=video_file.thumbnail or None,
+                         stream_url=reverse('stream', args=[video_file.id]),
+                         thumbnail_url=(reverse('thumbnail', args=[video_file.thumbnail])
+                                        if video_file.thumbnail else None),
+                         atlas=None,
+                         files=[])
+            cell = atlas.get(video_file.thumbnail)
+            if cell is not None:
+                page, x, y = cell
+                name = "%s-%s-%d" % (key, folder.atlas_version, page)
+                group['atlas'] = dict(url=reverse('atlas', args=[name]), x=x, y=y)
+            groups.append(group)
+        group['files'].append(u"%s / %s" % (video_file.relative_dirname, video_file.basename))
+
+    content = json.dumps(dict(path=path, folders=folders, groups=groups))
+    return HttpResponse(content, content_type="application/json")
 
 
 @login_required
@@ -84,12 +115,58 @@ def thumbnail(request, thumbnail):
     return sendfile(request, fn, mimetype="image/jpeg")
 
 
+@login_required
+@cache_control(private=True, max_age=30*24*60*60)
+def atlas(request, name):
+    # Named by the folder version, so can be cached long
+
+    path_key, version, page = name.split('-')
+    fn = get_atlas_filename(path_key, version, page)
+
+    if not os.path.isfile(fn):
+        raise Http404
+
+    return sendfile(request, fn, mimetype="image/jpeg")
+
+
+@login_required
+@cache_control(private=True, max_age=30*24*60*60)
+def storyboard(request, storyboard, ext):
+    # Named by content hash like the thumbnails, so can be cached long
+
+    fn = get_storyboard_filename(storyboard, ext)
+
+    if not os.path.isfile(fn):
+        raise Http404
+
+    mimetype = "image/jpeg" if ext == "jpg" else "text/vtt"
+    return sendfile(request, fn, mimetype=mimetype)
+
+
 class StreamEntry(object):
     def __init__(self, video_file, ticket):
         self.video_file = video_file
         self.ticket = ticket
 
 
+def _best_versions_first(video_files, user_agent):
+    """
+    Order versions of a video for the client: the ones browsers can
+    play first, then the highest bitrate, or the lowest on mobile
+    devices. Browsers play the first <source> they support.
+    """
+    mobile = 'Mobi' in user_agent or 'Android' in user_agent
+
+    # Playable, not yet probed, not playable
+    rank = {True: 0, None: 1, False: 2}
+
+    def key(video_file):
+        bitrate = video_file.bitrate or 0
+        return (rank[video_file.html5_playable], bitrate if mobile else -bitrate)
+
+    return sorted(video_files, key=key)
+
+
 @login_required
 def stream(request, id):
     try:
@@ -99,7 +176,8 @@ def stream(request, id):
 
     base, ext = os.path.splitext(video_file.filename)
 
-    videos = video_file.get_all_versions()
+    videos = _best_versions_first(video_file.get_all_versions(),
+                                  request.META.get('HTTP_USER_AGENT', ''))
     entries = [StreamEntry(x, StreamingTicket.new_for_video(x, request.META['REMOTE_ADDR']))
                for x in videos]
     for entry in entries:
@@ -108,9 +186,12 @@ def stream(request, id):
     # Do some housekeeping at the same time
     StreamingTicket.cleanup()
 
+    storyboards = [x for x in videos if x.storyboard]
+
     context = {
         'title': videos[0].title,
         'entries': entries,
+        'storyboard': storyboards[0].storyboard if storyboards else None,
     }
 
     return render(request, "mediasnakefiles/stream.html", context)
@@ -126,6 +207,9 @@ def ticket_stream(request, secret):
     if not ticket.is_valid(request.META['REMOTE_ADDR']):
         return HttpResponseForbidden()
 
+    # Scans back off while videos are being played
+    note_streaming()
+
     video_file = ticket.video_file
     filename = ticket.create_symlink()
     response = sendfile(request, filename, mimetype=video_file.mimetype,
@@ -142,9 +226,14 @@ def rescan(request):
     if request.method != 'POST':
         return redirect(index)
 
-    spawn_rescan()
+    # Optionally, scan only the directory trees under the given paths
+    paths = [x.strip() for x in request.POST.getlist('path') if x.strip()]
+    try:
+        paths = check_scan_paths(paths)
+    except ValueError as exc:
+        return HttpResponseBadRequest(str(exc), content_type="text/plain")
 
-    time.sleep(0.5)
+    request_scan(paths or None)
 
     context = {}
     return render(request, "mediasnakefiles/rescan.html", context)
@@ -155,7 +244,21 @@ def rescan_status(request):
     if not request.user.is_staff:
         return HttpResponseForbidden()
 
-    status = get_scan_status()
+    # Long poll: wait for the status to change from what the client has
+    since = request.GET.get('since')
+    if since is not None:
+        try:
+            status = wait_scan_status(int(since), timeout=25)
+        except ValueError:
+            return HttpResponseBadRequest()
+    else:
+        status = get_scan_status()
+
     if status is None:
-        return HttpResponse('{"complete": true}', content_type="application/json")
+        if scan_pending():
+            return HttpResponse('{"status": "Waiting for the scan to start", '
+                                '"timestamp": "queued", "sequence": 0, "phases": []}',
+                                content_type="application/json")
+        return HttpResponse(json.dumps(dict(complete=True, error=scan_error())),
+                            content_type="application/json")
     return HttpResponse(status, content_type="application/json")
@@ -0,0 +1,157 @@
+"""
+Parallel directory tree enumeration.
+
+Listing directories on network mounts is dominated by latency, so
+several directories are listed concurrently in a pool of threads.
+"""
+
+import os
+import sys
+import threading
+
+from Queue import Queue
+
+try:
+    from scandir import scandir
+except ImportError:
+    scandir = None
+
+
+def list_directory(path):
+    """
+    List a directory. Returns ``(subdirs, files)``, sorted lists of
+    base names. Like os.walk, symlinks to directories are not
+    included in either.
+    """
+    subdirs = []
+    files = []
+
+    if scandir is not None:
+        for entry in scandir(path):
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                is_dir = False
+            if not is_dir:
+                files.append(entry.name)
+            elif not entry.is_symlink():
+                subdirs.append(entry.name)
+    else:
+        for basename in os.listdir(path):
+            filename = os.path.join(path, basename)
+            if not os.path.isdir(filename):
+                files.append(basename)
+            elif not os.path.islink(filename):
+                subdirs.append(basename)
+
+    subdirs.sort()
+    files.sort()
+    return subdirs, files
+
+
+def walk_parallel(roots, visit, threads=1):
+    """
+    Visit all directories in the trees under `roots`.
+
+    ``visit(path)`` is called for each directory, concurrently in
+    `threads` threads per root, and should return ``(result,
+    subpaths)`` where `subpaths` are the directories to visit next.
+
+    Returns a list of ``(path, result)`` in depth-first order,
+    independent of the number of threads.
+    """
+    if isinstance(threads, dict):
+        get_threads = lambda root: threads.get(root, 1)
+    else:
+        get_threads = lambda root: threads
+
+    walks = [_TreeWalk(root, visit, get_threads(root)) for root in roots]
+
+    for walk in walks:
+        walk.start()
+
+    items = []
+    for walk in walks:
+        items.extend(walk.join())
+    return items
+
+
+class _TreeWalk(object):
+    def __init__(self, root, visit, threads):
+        self.root = root
+        self.visit = visit
+        self.threads = max(1, threads)
+
+        self._results = {}
+        self._queue = Queue()
+        self._lock = threading.Lock()
+        self._pending = 1
+        self._done = threading.Event()
+        self._error = None
+        self._workers = []
+
+    def start(self):
+        self._queue.put(self.root)
+
+        if self.threads == 1:
+            return
+
+        for j in range(self.threads):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def join(self):
+        if self.threads == 1:
+            self._work()
+        else:
+            while not self._done.wait(1.0):
+                # Wait with a timeout, to remain interruptible
+                pass
+            for worker in self._workers:
+                self._queue.put(None)
+            for worker in self._workers:
+                worker.join()
+
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+        # Assemble in depth-first order
+        items = []
+        stack = [self.root]
+        while stack:
+            path = stack.pop()
+            result, subpaths = self._results[path]
+            items.append((path, result))
+            stack.extend(reversed(subpaths))
+        return items
+
+    def _work(self):
+        while True:
+            if self.threads == 1 and self._queue.empty():
+                return
+
+            path = self._queue.get()
+            if path is None:
+                return
+
+            try:
+                if self._error is None:
+                    result, subpaths = self.visit(path)
+                    subpaths = list(subpaths)
+                else:
+                    result, subpaths = None, []
+            except:
+                result, subpaths = None, []
+                with self._lock:
+                    if self._error is None:
+                        self._error = sys.exc_info()
+
+            with self._lock:
+                self._results[path] = (result, subpaths)
+                self._pending += len(subpaths) - 1
+                for subpath in subpaths:
+                    self._queue.put(subpath)
+                if self._pending == 0:
+                    self._done.set()
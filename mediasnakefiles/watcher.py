@@ -0,0 +1,205 @@
+"""
+Filesystem change notification (Linux inotify), with a polling fallback.
+"""
+
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import logging
+
+logger = logging.getLogger('mediasnake')
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_NONBLOCK = 0x800
+IN_CLOEXEC = 0x80000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class WatcherError(RuntimeError):
+    pass
+
+
+class PollingWatcher(object):
+    """
+    Watcher that reports everything as changed at regular intervals.
+    """
+
+    def __init__(self, roots, interval):
+        self.roots = list(roots)
+        self.interval = interval
+        self._next = time.time()
+
+    def wait(self, timeout):
+        """
+        Wait at most `timeout` seconds for changes.
+
+        Returns a set of directories whose contents changed, or None
+        if everything should be rescanned.
+        """
+        delay = self._next - time.time()
+        if delay > timeout:
+            time.sleep(timeout)
+            return set()
+        time.sleep(max(0, delay))
+        self._next = time.time() + self.interval
+        return None
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Watcher for directory trees using inotify.
+    """
+
+    def __init__(self, roots):
+        libc_name = ctypes.util.find_library('c')
+        if not libc_name:
+            raise WatcherError("C library not found")
+        self._libc = ctypes.CDLL(libc_name, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise WatcherError("inotify is not available")
+
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise WatcherError("inotify_init1 failed: %s"
+                               % os.strerror(ctypes.get_errno()))
+
+        self._paths = {}
+        self._wds = {}
+
+        try:
+            for root in roots:
+                if isinstance(root, unicode):
+                    root = root.encode(sys.getfilesystemencoding())
+                self.add_tree(os.path.normpath(root))
+        except:
+            self.close()
+            raise
+
+    def close(self):
+        if self.fd is not None and self.fd >= 0:
+            os.close(self.fd)
+        self.fd = None
+
+    def add_tree(self, root):
+        """
+        Watch all directories under `root`.
+        """
+        for path, dirs, files in os.walk(root):
+            self._add_watch(path)
+
+    def remove_tree(self, root):
+        """
+        Stop watching the directories under `root`.
+        """
+        prefix = root.rstrip(os.path.sep) + os.path.sep
+        for path in list(self._wds):
+            if path == root or path.startswith(prefix):
+                wd = self._wds.pop(path)
+                self._paths.pop(wd, None)
+                self._libc.inotify_rm_watch(self.fd, wd)
+
+    def _add_watch(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR, errno.EACCES):
+                # Vanished, or not accessible
+                return
+            raise WatcherError("Cannot watch %r: %s" % (path, os.strerror(err)))
+        self._paths[wd] = path
+        self._wds[path] = wd
+
+    def wait(self, timeout):
+        """
+        Wait at most `timeout` seconds for changes.
+
+        Returns a set of directories whose contents changed, or None
+        if events were lost and everything should be rescanned.
+        """
+        r, w, x = select.select([self.fd], [], [], timeout)
+        if not r:
+            return set()
+
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return set()
+            raise
+
+        changed = set()
+        overflow = False
+        pos = 0
+
+        while pos + _EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = data[pos:pos+length].rstrip(b'\0')
+            pos += length
+
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+
+            path = self._paths.get(wd)
+            if path is None:
+                continue
+
+            if mask & IN_IGNORED:
+                self._paths.pop(wd, None)
+                if self._wds.get(path) == wd:
+                    del self._wds[path]
+                continue
+
+            changed.add(path)
+
+            if mask & IN_ISDIR and name:
+                subdir = os.path.join(path, name)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(subdir)
+                    changed.add(subdir)
+                elif mask & IN_MOVED_FROM:
+                    self.remove_tree(subdir)
+                    changed.add(subdir)
+
+        if overflow:
+            logger.warning("inotify event queue overflowed")
+            return None
+
+        return changed
+
+
+def get_watcher(roots, poll_interval):
+    """
+    Return an inotify watcher for `roots`, or a polling watcher if
+    inotify cannot be used.
+    """
+    try:
+        return InotifyWatcher(roots)
+    except WatcherError as err:
+        logger.warning("Falling back to polling: %s" % (err,))
+        return PollingWatcher(roots, poll_interval)
@@ -0,0 +1,135 @@
+"""
+Background worker threads for slow per-file jobs (thumbnails etc.)
+"""
+
+import os
+import sys
+import threading
+import subprocess
+
+from Queue import Queue, Empty
+
+
+class CommandTimeout(RuntimeError):
+    pass
+
+
+def run_command(cmd, timeout=None, **kw):
+    """
+    Run a command, killing it if it runs longer than `timeout` seconds.
+
+    Returns ``(returncode, output)``, with stderr included in the output.
+    Raises CommandTimeout if the command was killed.
+    """
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                         stderr=subprocess.STDOUT, **kw)
+
+    killed = []
+    def kill():
+        killed.append(True)
+        try:
+            p.kill()
+        except OSError:
+            pass
+
+    timer = None
+    if timeout is not None:
+        timer = threading.Timer(timeout, kill)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        out, err = p.communicate()
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+    if killed:
+        raise CommandTimeout("Command %r timed out after %s s" % (cmd[0], timeout))
+
+    return p.returncode, out
+
+
+def find_program(name):
+    """
+    Return the path of the executable `name`, searched for in PATH if
+    it has no directory part, or None if there is no such executable.
+    """
+    if os.path.dirname(name):
+        dirs = ['']
+    else:
+        dirs = os.environ.get('PATH', os.defpath).split(os.pathsep)
+
+    for dirname in dirs:
+        filename = os.path.join(dirname, name)
+        if os.path.isfile(filename) and os.access(filename, os.X_OK):
+            return filename
+    return None
+
+
+class WorkerPool(object):
+    """
+    Bounded pool of threads running jobs.
+
+    Jobs are added with `submit`, and their outcomes are obtained in
+    the order of completion from `results`, which should be called
+    from a single thread.
+    """
+
+    def __init__(self, workers):
+        self._jobs = Queue()
+        self._done = Queue()
+        self._pending = 0
+        self._threads = []
+
+        for j in range(max(1, workers)):
+            thread = threading.Thread(target=self._work)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, func, *args):
+        self._pending += 1
+        self._jobs.put((func, args))
+
+    def results(self):
+        """
+        Yield ``(args, result, exc_info)`` for each submitted job, as
+        they complete. `exc_info` is None if the job succeeded.
+        """
+        while self._pending > 0:
+            item = self._done.get()
+            self._pending -= 1
+            yield item
+
+    def close(self):
+        # Drop jobs not yet started
+        try:
+            while True:
+                self._jobs.get_nowait()
+        except Empty:
+            pass
+
+        for thread in self._threads:
+            self._jobs.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+
+            func, args = job
+            try:
+                self._done.put((args, func(*args), None))
+            except:
+                self._done.put((args, None, sys.exc_info()))
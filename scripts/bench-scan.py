@@ -0,0 +1,307 @@
+#!/usr/bin/env python
+"""
+bench-scan.py [-n COUNT,...] [-s SHAPE,...] [-m MIX] [-o OUTPUT]
+
+Benchmark the library scanner on synthetic libraries created in a
+temporary directory, against a throwaway SQLite database.
+
+For each library size and tree shape, the following scans are timed:
+
+  initial       first scan, adding every file to the database
+  rescan        incremental scan with no changes
+  full-rescan   full scan (--full) with no changes
+
+Each scan runs in a separate process, so that its peak RSS can be
+measured. The thumbnailer, ffprobe and ffmpeg are not run. Results
+are written as JSON to OUTPUT (default: stdout), and summarized on
+stderr.
+
+Tree shapes:
+
+  deep    4 subdirectories and 20 files per directory
+  flat    1000 files per directory, all directories under the root
+
+"""
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import zipfile
+import argparse
+import tempfile
+import resource
+import platform
+import subprocess
+
+from collections import deque
+from io import BytesIO
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+SCANS = (
+    ('initial', False),
+    ('rescan', False),
+    ('full-rescan', True),
+)
+
+SHAPES = {
+    'deep': (4, 20),
+    'flat': (None, 1000),
+}
+
+
+def main():
+    p = argparse.ArgumentParser(usage=__doc__.lstrip())
+    p.add_argument("-n", "--count", type=str, default="10000",
+                   help="Comma-separated numbers of files in the library [default: 10000]")
+    p.add_argument("-s", "--shape", type=str, default="deep,flat",
+                   help="Comma-separated tree shapes [default: deep,flat]")
+    p.add_argument("-m", "--mix", type=str, default="video=8,book=1,comic=1",
+                   help="Relative numbers of each kind of file [default: video=8,book=1,comic=1]")
+    p.add_argument("-o", "--output", type=str, default=None,
+                   help="File to write JSON results to [default: stdout]")
+    p.add_argument("--child", type=str, default=None, help=argparse.SUPPRESS)
+    args = p.parse_args()
+
+    if args.child is not None:
+        run_child(args.child)
+        return
+
+    mix = []
+    for item in args.mix.split(','):
+        kind, weight = item.split('=')
+        if kind not in STUBS:
+            p.error("unknown file kind %r" % (kind,))
+        mix.extend([kind] * int(weight))
+
+    results = []
+    for count in [int(x) for x in args.count.split(',')]:
+        for shape in args.shape.split(','):
+            if shape not in SHAPES:
+                p.error("unknown shape %r" % (shape,))
+            results.extend(run_benchmark(count, shape, mix))
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'mix': args.mix,
+        'results': results,
+    }
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+
+
+def run_benchmark(count, shape, mix):
+    tmpdir = tempfile.mkdtemp()
+    try:
+        root = os.path.join(tmpdir, 'library')
+        data_dir = os.path.join(tmpdir, 'data')
+        os.makedirs(data_dir)
+
+        start = time.time()
+        ndirs = make_library(root, count, shape, mix)
+        print("%s, %d files, %d directories (created in %.1f s)"
+              % (shape, count, ndirs, time.time() - start), file=sys.stderr)
+
+        results = []
+        for name, full in SCANS:
+            config = {'root': root, 'data_dir': data_dir, 'full': full}
+            p = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                  '--child', json.dumps(config)],
+                                 stdout=subprocess.PIPE)
+            out, _ = p.communicate()
+            if p.returncode != 0:
+                raise SystemExit("ERROR: %s scan failed" % (name,))
+
+            result = json.loads(out.decode('utf-8'))
+            result.update(scan=name, shape=shape, files=count, dirs=ndirs)
+            results.append(result)
+
+            print("  %-12s %9.2f s  peak RSS %8.1f MB  %7d queries"
+                  % (name, result['time'], result['peak_rss_kb'] / 1024.0,
+                     result['queries']), file=sys.stderr)
+        return results
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def run_child(config):
+    config = json.loads(config)
+
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mediasnake.settings")
+
+    import django
+    from django.conf import settings
+
+    settings.DEBUG = False
+    settings.DATA_DIR = config['data_dir']
+    settings.SENDFILE_ROOT = os.path.join(config['data_dir'], 'streaming')
+    settings.MEDIASNAKEFILES_DIRS = [config['root']]
+    settings.DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(config['data_dir'], 'mediasnake.db'),
+        }
+    }
+    settings.LOGGING = {'version': 1, 'disable_existing_loggers': False}
+    # No storyboards: they would dominate the time
+    settings.MEDIASNAKEFILES_STORYBOARD_FRAMES = 0
+
+    django.setup()
+
+    from django.core.management import call_command
+    from django.db.backends import utils
+    from mediasnakefiles import scanner
+    from mediasnakefiles import models
+    from mediasnakefiles.models import ScanRun, VideoFile, VideoFolder
+    from mediasnakebooks.models import Ebook
+    from mediasnakecomics.models import Comic
+
+    call_command('migrate', verbosity=0, interactive=False)
+
+    # Count queries without keeping them around as DEBUG would
+    queries = [0]
+    def counting(method):
+        def wrapper(self, *args, **kw):
+            queries[0] += 1
+            return method(self, *args, **kw)
+        return wrapper
+    utils.CursorWrapper.execute = counting(utils.CursorWrapper.execute)
+    utils.CursorWrapper.executemany = counting(utils.CursorWrapper.executemany)
+
+    # Skip running the thumbnailer, but record the thumbnails as done
+    def create_thumbnails(video_files, total=None):
+        for batch in scanner.iter_batches(video_files, 500):
+            VideoFile.objects.filter(pk__in=[x.pk for x in batch]).update(thumbnail='0' * 40)
+    models.create_thumbnails = create_thumbnails
+
+    # Likewise for ffprobe and the folder atlases made with ffmpeg
+    def probe_videos(video_files, total=None):
+        for batch in scanner.iter_batches(video_files, 500):
+            VideoFile.objects.filter(pk__in=[x.pk for x in batch]).update(probed=True)
+    models.probe_videos = probe_videos
+
+    def create_folder_atlases(folders, total=None):
+        for batch in scanner.iter_batches(folders, 500):
+            for folder in batch:
+                VideoFolder.objects.filter(pk=folder.pk).update(atlas_version=folder.version)
+    models.create_folder_atlases = create_folder_atlases
+
+    baseline_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if not scanner.scan(full=config['full']):
+        raise SystemExit("ERROR: scan lock file exists")
+    elapsed = time.time() - start
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    count = queries[0]
+
+    profile = ScanRun.objects.order_by('-started')[0].get_profile()
+
+    json.dump({
+        'time': elapsed,
+        'cpu': profile['cpu'],
+        'baseline_rss_kb': baseline_rss,
+        'peak_rss_kb': peak_rss,
+        'queries': count,
+        'rows': {
+            'video': VideoFile.objects.count(),
+            'book': Ebook.objects.count(),
+            'comic': Comic.objects.count(),
+        },
+        'phases': dict((x['name'], x['wall']) for x in profile['phases']),
+    }, sys.stdout)
+
+
+def make_library(root, count, shape, mix):
+    branching, per_dir = SHAPES[shape]
+    ndirs = max(1, (count + per_dir - 1) // per_dir)
+    if branching is None:
+        branching = ndirs
+
+    os.makedirs(root)
+    dirs = [root]
+    queue = deque(dirs)
+    while len(dirs) < ndirs:
+        parent = queue.popleft()
+        for j in range(branching):
+            if len(dirs) >= ndirs:
+                break
+            subdir = os.path.join(parent, "dir%03d" % (j,))
+            os.mkdir(subdir)
+            dirs.append(subdir)
+            queue.append(subdir)
+
+    stubs = dict((kind, func()) for kind, func in STUBS.items())
+
+    for j in range(count):
+        kind = mix[j % len(mix)]
+        ext, data = stubs[kind]
+        filename = os.path.join(dirs[j % ndirs], "%s%07d%s" % (kind, j, ext))
+        with open(filename, 'wb') as f:
+            f.write(data)
+
+    # Date the directories back, as the scanner lists directories
+    # modified just before a scan again on the next one
+    old = time.time() - 3600
+    for dirname in dirs:
+        os.utime(dirname, (old, old))
+
+    return ndirs
+
+
+def _zip(files):
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, 'w') as f:
+        for name, data in files:
+            f.writestr(name, data)
+    return buf.getvalue()
+
+
+def _video_stub():
+    # Enough of a RIFF header for `file` to detect video/x-msvideo
+    return ".avi", b"RIFF\x00\x00\x00\x00AVI LIST" + b"\x00" * 64
+
+
+def _book_stub():
+    container = (
+        '<?xml version="1.0"?>\n'
+        '<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">'
+        '<rootfiles><rootfile full-path="content.opf" media-type="application/oebps-package+xml"/>'
+        '</rootfiles></container>')
+    opf = (
+        '<?xml version="1.0"?>\n'
+        '<package xmlns="http://www.idpf.org/2007/opf" version="2.0" unique-identifier="id">'
+        '<metadata xmlns:dc="http://purl.org/dc/elements/1.1/">'
+        '<dc:title>Title</dc:title><dc:creator>Some Author</dc:creator>'
+        '<dc:identifier id="id">bench</dc:identifier><dc:language>en</dc:language></metadata>'
+        '<manifest><item id="text" href="text.html" media-type="application/xhtml+xml"/></manifest>'
+        '<spine><itemref idref="text"/></spine></package>')
+    return ".epub", _zip([('mimetype', 'application/epub+zip'),
+                          ('META-INF/container.xml', container),
+                          ('content.opf', opf),
+                          ('text.html', '<html><body><p>Text</p></body></html>')])
+
+
+def _comic_stub():
+    return ".cbz", _zip([('page001.jpg', b'\xff\xd8\xff\xd9')])
+
+
+STUBS = {
+    'video': _video_stub,
+    'book': _book_stub,
+    'comic': _comic_stub,
+}
+
+
+if __name__ == "__main__":
+    main()
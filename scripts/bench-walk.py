@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+"""
+bench-walk.py [-d DEPTH] [-b BRANCHING] [-f FILES] [-l LATENCY] [-j THREADS,...]
+
+Benchmark the parallel directory enumeration used by the scanner, on
+a synthetic deep directory tree created in a temporary directory.
+
+Network mounts are emulated by sleeping LATENCY seconds per
+directory listing.
+
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from mediasnakefiles.walker import walk_parallel, list_directory
+
+
+def main():
+    p = argparse.ArgumentParser(usage=__doc__.lstrip())
+    p.add_argument("-d", "--depth", type=int, default=4,
+                   help="Depth of the directory tree [default: 4]")
+    p.add_argument("-b", "--branching", type=int, default=6,
+                   help="Number of subdirectories per directory [default: 6]")
+    p.add_argument("-f", "--files", type=int, default=10,
+                   help="Number of files per directory [default: 10]")
+    p.add_argument("-l", "--latency", type=float, default=0.002,
+                   help="Emulated latency per directory listing, in seconds [default: 0.002]")
+    p.add_argument("-j", "--threads", type=str, default="1,2,4,8,16",
+                   help="Comma-separated thread counts to try [default: 1,2,4,8,16]")
+    args = p.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        ndirs = make_tree(tmpdir, args.depth, args.branching, args.files)
+        print("Tree: %d directories, %d files" % (ndirs, ndirs * args.files))
+
+        def visit(path):
+            if args.latency:
+                time.sleep(args.latency)
+            subdirs, files = list_directory(path)
+            return files, [os.path.join(path, x) for x in subdirs]
+
+        baseline = None
+        reference = None
+        for threads in [int(x) for x in args.threads.split(',')]:
+            start = time.time()
+            items = walk_parallel([tmpdir], visit, threads)
+            elapsed = time.time() - start
+
+            if reference is None:
+                reference = items
+                baseline = elapsed
+            elif items != reference:
+                print("ERROR: result differs with %d threads" % (threads,))
+                raise SystemExit(1)
+
+            print("threads=%-3d  %8.3f s  speedup %5.2fx" % (threads, elapsed,
+                                                             baseline / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+def make_tree(path, depth, branching, files):
+    count = 1
+    for j in range(files):
+        with open(os.path.join(path, "video%03d.mkv" % (j,)), 'wb'):
+            pass
+    if depth > 0:
+        for j in range(branching):
+            subdir = os.path.join(path, "dir%03d" % (j,))
+            os.mkdir(subdir)
+            count += make_tree(subdir, depth - 1, branching, files)
+    return count
+
+
+if __name__ == "__main__":
+    main()